@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+"""
+قياس أداء المصادقة داخل عملية واحدة (بدون خادم خارجي)
+
+عاصفة تسجيل دخول: زمن GET /patients (p50/p99) أثناء طلبات دخول متزامنة، مرة مع bcrypt داخل
+حلقة الأحداث (السلوك السابق) ومرة مع مجمع خيوط التشفير. يتطلب MongoDB يعمل (كما في test_system.py) و httpx.
+الاستخدام: python benchmark_auth.py [--seconds 5] [--login-clients 20]
+
+كلفة middleware المصادقة: طلبات/ثانية لمسار محمي وآخر عام بدون middleware، وبالتنفيذ السابق
+(BaseHTTPMiddleware مع مطابقة خطية)، وبالتنفيذ الحالي (ASGI مباشر). يتطلب MongoDB للمستخدم الافتراضي فقط
+(بعد أول طلب يُقرأ من الذاكرة المؤقتة).
+الاستخدام: python benchmark_auth.py --middleware [--requests 20000]
+"""
+
+import argparse
+import asyncio
+import statistics
+import time
+from typing import Dict, List
+
+import httpx
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
+
+from main import app
+from middleware.auth_middleware import AuthMiddleware
+from services.auth_service import auth_service
+from services.database import db_service
+from services.password_service import password_service
+from services.simple_auth_service import simple_auth_service
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    """النسبة المئوية من قائمة أزمنة (بالملّي ثانية)"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summary(latencies: List[float]) -> str:
+    """ملخص الأزمنة: العدد، p50، p99، الأقصى"""
+    return (f"{len(latencies)} طلب، p50 {statistics.median(latencies):.1f} ms، "
+            f"p99 {percentile(latencies, 0.99):.1f} ms، الأقصى {max(latencies):.1f} ms")
+
+
+async def read_patients(client: httpx.AsyncClient, headers: Dict[str, str], deadline: float) -> List[float]:
+    """طلبات GET /patients متتالية حتى الموعد، وإرجاع زمن كل طلب"""
+    latencies = []
+    while time.perf_counter() < deadline:
+        started = time.perf_counter()
+        response = await client.get("/patients/", params={"limit": 20}, headers=headers)
+        latencies.append((time.perf_counter() - started) * 1000)
+        assert response.status_code == 200, response.text
+    return latencies
+
+
+async def login_storm(client: httpx.AsyncClient, deadline: float) -> Dict[int, int]:
+    """طلبات دخول متتالية من عميل واحد حتى الموعد، وإرجاع عدد الاستجابات لكل رمز حالة"""
+    codes: Dict[int, int] = {}
+    while time.perf_counter() < deadline:
+        response = await client.post("/auth/login", json={"username": "admin", "password": "admin123"})
+        codes[response.status_code] = codes.get(response.status_code, 0) + 1
+        if response.status_code == 429:
+            await asyncio.sleep(0.05)
+    return codes
+
+
+async def run_scenario(client: httpx.AsyncClient, headers: Dict[str, str], seconds: float, login_clients: int):
+    """قياس زمن القراءة مع عدد من عملاء الدخول المتزامنين (0 = بدون عاصفة)"""
+    deadline = time.perf_counter() + seconds
+    storms = [asyncio.create_task(login_storm(client, deadline)) for _ in range(login_clients)]
+    latencies = await read_patients(client, headers, deadline)
+
+    codes: Dict[int, int] = {}
+    for result in await asyncio.gather(*storms):
+        for code, count in result.items():
+            codes[code] = codes.get(code, 0) + count
+    return latencies, codes
+
+
+BENCHMARK_PROTECTED_PATHS = ["/patients", "/auth/me"]
+BENCHMARK_EXCLUDED_PATHS = ["/health", "/docs", "/redoc", "/openapi.json",
+                            "/auth/login", "/auth/register", "/auth/refresh"]
+
+
+class LegacyAuthMiddleware(BaseHTTPMiddleware):
+    """التنفيذ السابق للمقارنة: BaseHTTPMiddleware ومطابقة خطية بالبادئات
+
+    "/" محذوفة من المستثناة (كانت تستثني كل المسارات) حتى يتحقق من الرمز مثل التنفيذ الحالي.
+    """
+
+    def __init__(self, app, protected_paths: list, excluded_paths: list):
+        super().__init__(app)
+        self.protected_paths = protected_paths
+        self.excluded_paths = excluded_paths
+        self.checker = AuthMiddleware(app, protected_paths, excluded_paths)
+
+    async def dispatch(self, request, call_next):
+        path = request.url.path
+        if not any(path.startswith(excluded) for excluded in self.excluded_paths) and \
+                any(path.startswith(protected) for protected in self.protected_paths):
+            response = await self.checker._authenticate(request.scope)
+            if response is not None:
+                return response
+        return await call_next(request)
+
+
+def middleware_app(middleware: List[Middleware]) -> Starlette:
+    """تطبيق صغير بمسار محمي وآخر عام حتى يظهر أثر الـ middleware وحده"""
+    async def ok(request):
+        return PlainTextResponse("ok")
+
+    return Starlette(routes=[Route("/patients/ping", ok), Route("/health", ok)], middleware=middleware)
+
+
+async def requests_per_second(asgi_app, path: str, headers: Dict[str, str], count: int) -> float:
+    """طلبات/ثانية باستدعاء التطبيق مباشرة (دون كلفة عميل HTTP)"""
+    raw_headers = [(key.lower().encode("latin-1"), value.encode("latin-1")) for key, value in headers.items()]
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            assert message["status"] == 200, message
+
+    started = time.perf_counter()
+    for _ in range(count):
+        scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET",
+                 "scheme": "http", "path": path, "raw_path": path.encode(), "root_path": "",
+                 "query_string": b"", "headers": raw_headers, "client": ("127.0.0.1", 0),
+                 "server": ("benchmark", 80)}
+        body_sent = []
+
+        async def receive():
+            # مثل الخادم: الجسم ثم انتظار حتى قطع الاتصال (لا يحدث هنا)
+            if not body_sent:
+                body_sent.append(True)
+                return {"type": "http.request", "body": b"", "more_body": False}
+            await asyncio.Event().wait()
+
+        await asgi_app(scope, receive, send)
+    return count / (time.perf_counter() - started)
+
+
+async def admin_headers() -> Dict[str, str]:
+    """ترويسة Authorization برمز وصول للمدير الافتراضي (يُنشأ إن لم يكن موجوداً)"""
+    await auth_service.create_default_admin()
+    admin = await auth_service.get_user_by_username("admin")
+    token = simple_auth_service.create_access_token({"sub": admin.username, "user_id": str(admin.id)})
+    return {"Authorization": f"Bearer {token}"}
+
+
+async def middleware_benchmark(count: int):
+    """مقارنة طلبات/ثانية بدون middleware، بالتنفيذ السابق، وبالتنفيذ الحالي"""
+    headers = await admin_headers()
+    paths = {"/patients/ping": "مسار محمي", "/health": "مسار عام"}
+    variants = {
+        "بدون middleware": [],
+        "BaseHTTPMiddleware (السابق)": [Middleware(LegacyAuthMiddleware, protected_paths=BENCHMARK_PROTECTED_PATHS,
+                                                   excluded_paths=BENCHMARK_EXCLUDED_PATHS)],
+        "ASGI مباشر (الحالي)": [Middleware(AuthMiddleware)],
+    }
+
+    for path, label in paths.items():
+        baseline = None
+        for name, middleware in variants.items():
+            asgi_app = middleware_app(middleware)
+            await requests_per_second(asgi_app, path, headers, min(count, 500))
+            rate = await requests_per_second(asgi_app, path, headers, count)
+            overhead = "" if baseline is None else f"، كلفة الـ middleware {(1 / rate - 1 / baseline) * 1e6:.0f} µs/طلب"
+            baseline = baseline or rate
+            print(f"{label} {path} — {name}: {rate:,.0f} طلب/ثانية{overhead}")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="قياس أداء المصادقة: عاصفة تسجيل الدخول أو كلفة الـ middleware")
+    parser.add_argument("--seconds", type=float, default=5.0, help="مدة كل سيناريو")
+    parser.add_argument("--login-clients", type=int, default=20, help="عدد عملاء الدخول المتزامنين")
+    parser.add_argument("--middleware", action="store_true", help="قياس كلفة middleware المصادقة بدل عاصفة الدخول")
+    parser.add_argument("--requests", type=int, default=20000, help="عدد الطلبات لكل حالة في قياس الـ middleware")
+    args = parser.parse_args()
+
+    await db_service.connect()
+    if args.middleware:
+        try:
+            await middleware_benchmark(args.requests)
+        finally:
+            await db_service.disconnect()
+        return
+
+    await password_service.calibrate_async()
+    try:
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+            headers = await admin_headers()
+            await client.get("/patients/", params={"limit": 20}, headers=headers)
+
+            latencies, _ = await run_scenario(client, headers, args.seconds, 0)
+            print(f"بدون عاصفة دخول:        {summary(latencies)}")
+
+            # السلوك السابق: التشفير داخل حلقة الأحداث
+            pooled = password_service._run
+
+            async def inline(func, *func_args):
+                return func(*func_args)
+
+            password_service._run = inline
+            try:
+                latencies, codes = await run_scenario(client, headers, args.seconds, args.login_clients)
+                print(f"bcrypt في حلقة الأحداث: {summary(latencies)}، الدخول {codes}")
+            finally:
+                password_service._run = pooled
+
+            latencies, codes = await run_scenario(client, headers, args.seconds, args.login_clients)
+            print(f"bcrypt في مجمع الخيوط:  {summary(latencies)}، الدخول {codes}")
+            print(f"سياسة التشفير: {password_service.policy}، "
+                  f"طلبات مرفوضة لامتلاء المجمع: {password_service.rejected}")
+    finally:
+        await db_service.disconnect()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -31,7 +31,18 @@ class Config:
     )
 
     # إعدادات الأمان الأخرى
-    BCRYPT_ROUNDS: int = int(os.getenv("BCRYPT_ROUNDS", "12"))
+    # تشفير كلمات المرور: bcrypt أو argon2 (يتطلب argon2-cffi)، والكلفة تُعاير عند البدء لتقارب
+    # زمن التحقق المستهدف؛ BCRYPT_ROUNDS أكبر من 0 يثبّت كلفة bcrypt بدل المعايرة
+    PASSWORD_HASH_SCHEME: str = os.getenv("PASSWORD_HASH_SCHEME", "bcrypt")
+    PASSWORD_HASH_TARGET_MS: float = float(os.getenv("PASSWORD_HASH_TARGET_MS", "250"))
+    BCRYPT_ROUNDS: int = int(os.getenv("BCRYPT_ROUNDS", "0"))
+    # خيوط تشفير كلمات المرور، وعدد الطلبات المنتظرة قبل رفض تسجيل الدخول بـ 429
+    PASSWORD_HASH_WORKERS: int = int(os.getenv("PASSWORD_HASH_WORKERS", "2"))
+    PASSWORD_HASH_QUEUE: int = int(os.getenv("PASSWORD_HASH_QUEUE", "8"))
+
+    # كشوفات الحساب PDF: خط يدعم العربية (اختياري) وعدد عمليات الرسم (0 = عدد أنوية المعالج)
+    STATEMENT_FONT_PATH: Optional[str] = os.getenv("STATEMENT_FONT_PATH")
+    STATEMENT_WORKERS: int = int(os.getenv("STATEMENT_WORKERS", "0"))
 
 
 # إنشاء نسخة من الإعدادات لاستخدامها عبر المشروع
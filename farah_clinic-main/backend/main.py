@@ -1,12 +1,24 @@
-from fastapi import FastAPI, HTTPException
+import asyncio
+import json
+from fastapi import FastAPI, HTTPException, Depends, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from contextlib import asynccontextmanager
 
 from services.database import db_service
 from services.simple_auth_service import simple_auth_service
+from services.patient_service import patient_service
+from services.sync_service import sync_service
+from services.statistics_service import statistics_service
+from services.typeahead_service import typeahead_service
+from services.statement_service import statement_service
+from services.password_service import password_service
  
 from router.patient_router import router as patient_router
 from router.auth_router import router as auth_router
+from router.admin_router import router as admin_router
+from router.auth_router import get_current_user_dependency
+from models.user import User
 from middleware.auth_middleware import AuthMiddleware
 
 
@@ -16,7 +28,35 @@ async def lifespan(app: FastAPI):
     # بداية التطبيق
     print("🚀 بدء تشغيل تطبيق عيادة الدكتورة فرح الأسنان...")
     await db_service.connect()
+
+    # عدّاد إصدارات المزامنة يُهيأ قبل أي كتابة
+    await sync_service.initialize_counter()
+
+    # ترحيل ملخص المدفوعات للمرضى القدامى
+    migrated = await patient_service.backfill_payment_summaries()
+    if migrated:
+        print(f"✅ تم حساب ملخص المدفوعات لـ {migrated} مريض")
+    indexed = await patient_service.backfill_search_fields()
+    if indexed:
+        print(f"✅ تم حساب حقول البحث لـ {indexed} مريض")
+    versioned = await sync_service.backfill_versions()
+    if versioned:
+        print(f"✅ تمت إضافة إصدارات المزامنة لـ {versioned} وثيقة")
+
+    # بناء فهرس الاقتراحات في الذاكرة
+    suggested = await typeahead_service.build()
+    print(f"✅ تم بناء فهرس الاقتراحات لـ {suggested} مريض")
+
+    # مطابقة عدّادات الإحصائيات عند البدء ثم بشكل دوري
+    await statistics_service.reconcile()
+    reconcile_task = asyncio.create_task(statistics_service.run_periodic_reconciliation())
+    # تنظيف سجلات الحذف القديمة عند البدء ثم يومياً
+    prune_task = asyncio.create_task(sync_service.run_periodic_pruning())
     
+    # معايرة كلفة تشفير كلمات المرور على هذا الخادم
+    policy = await password_service.calibrate_async()
+    print(f"✅ تشفير كلمات المرور: {policy['scheme']} بكلفة {policy['rounds']} (تحقق ~{policy['verify_ms']} ms)")
+
     # إنشاء المدير الافتراضي
     await simple_auth_service.create_default_admin()
     # إنشاء مستخدم عادي افتراضي
@@ -26,6 +66,10 @@ async def lifespan(app: FastAPI):
 
     # نهاية التطبيق
     print("🛑 إيقاف التطبيق...")
+    reconcile_task.cancel()
+    prune_task.cancel()
+    await statistics_service.flush()
+    statement_service.shutdown()
     await db_service.disconnect()
 
 
@@ -37,6 +81,9 @@ app = FastAPI(
     lifespan=lifespan
 )
 
+# إضافة middleware للمصادقة (يُضاف قبل CORS حتى تحمل ردود 401 ترويسات CORS أيضاً)
+app.add_middleware(AuthMiddleware)
+
 # إعداد CORS
 app.add_middleware(
     CORSMiddleware,
@@ -44,14 +91,13 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
-# إضافة middleware للمصادقة
-app.add_middleware(AuthMiddleware)
-
 # تضمين المعالجات
 app.include_router(auth_router)
 app.include_router(patient_router)
+app.include_router(admin_router)
 
  
 
@@ -91,75 +137,153 @@ async def health_check():
         }
 
 
+class _BootstrapUser:
+    """مستخدم داخلي لاستدعاء معالج الإحصائيات من bootstrap"""
+
+    def __init__(self):
+        self.id = "bootstrap_user"
+        self.username = "bootstrap"
+        self.is_admin = True
+
+
+def _bootstrap_patient_record(patient) -> dict:
+    """تحويل مريض إلى سجل bootstrap"""
+    return {
+        "id": str(patient.id),
+        "name": patient.name,
+        "phone": patient.phone,
+        "total_amount": patient.total_amount,
+        "installments_months": patient.installments_months,
+        "notes": patient.notes,
+        "registration_date": patient.registration_date.isoformat(),
+        "is_completed": patient.is_completed,
+        "total_paid": patient.total_paid,
+        "remaining_amount": patient.remaining_amount,
+        "monthly_installment": patient.calculate_monthly_installment(),
+        "next_payment_date": patient.get_next_payment_date().isoformat(),
+        "payments_count": patient.payments_count
+    }
+
+
+def _bootstrap_payment_record(payment, patient_name: str) -> dict:
+    """تحويل دفعة إلى سجل bootstrap"""
+    return {
+        "id": str(payment.id),
+        "patient_id": str(payment.patient_id),
+        "patient_name": patient_name,  # إضافة اسم المريض
+        "amount": payment.amount,
+        "payment_date": payment.payment_date.isoformat(),
+        "notes": payment.notes
+    }
+
+
 @app.get("/bootstrap")
 async def bootstrap_data():
     """جلب جميع البيانات المطلوبة للتطبيق دفعة واحدة"""
     try:
-        from services.patient_service import patient_service
-        
-        # جلب جميع المرضى
-        patients_data = await patient_service.get_all_patients()
-        
-        # جلب الإحصائيات
         from router.patient_router import get_patients_statistics
-        from models.user import User
-        from router.auth_router import get_current_user_dependency
-        
-        # إنشاء مستخدم مؤقت للحصول على الإحصائيات
-        class MockUser:
-            def __init__(self):
-                self.id = "bootstrap_user"
-                self.username = "bootstrap"
-                self.is_admin = True
-        
+
         # جلب الإحصائيات
-        stats_response = await get_patients_statistics(MockUser())
-        
-        # تحويل المرضى إلى تنسيق مناسب
+        stats_response = await get_patients_statistics(_BootstrapUser())
+
+        # مؤشر المزامنة يُقرأ قبل البيانات ليُستخدم لاحقاً مع /sync
+        cursor = await sync_service.current_version()
+
         patients = []
         payments = []
-        
-        for patient_data in patients_data:
-            # جلب المريض الكامل مع المدفوعات
-            full_patient = await patient_service.get_patient_by_id(str(patient_data.id))
-            if full_patient:
-                patients.append({
-                    "id": str(full_patient.id),
-                    "name": full_patient.name,
-                    "phone": full_patient.phone,
-                    "total_amount": full_patient.total_amount,
-                    "installments_months": full_patient.installments_months,
-                    "notes": full_patient.notes,
-                    "registration_date": full_patient.registration_date.isoformat(),
-                    "is_completed": full_patient.is_completed,
-                    "total_paid": full_patient.total_paid,
-                    "remaining_amount": full_patient.remaining_amount,
-                    "monthly_installment": full_patient.calculate_monthly_installment(),
-                    "next_payment_date": full_patient.get_next_payment_date().isoformat(),
-                    "payments_count": len(full_patient.payments)
-                })
-                
-                # إضافة المدفوعات
-                for payment in full_patient.payments:
-                    payments.append({
-                        "id": str(payment.id),
-                        "patient_id": str(payment.patient_id),
-                        "patient_name": full_patient.name,  # إضافة اسم المريض
-                        "amount": payment.amount,
-                        "payment_date": payment.payment_date.isoformat(),
-                        "notes": payment.notes
-                    })
-        
+
+        # مؤشر واحد يجلب المرضى مع مدفوعاتهم
+        async for patient in patient_service.iter_patients_with_payments():
+            patients.append(_bootstrap_patient_record(patient))
+
+            # إضافة المدفوعات
+            for payment in patient.payments:
+                payments.append(_bootstrap_payment_record(payment, patient.name))
+
         return {
             "patients": patients,
             "payments": payments,
-            "statistics": stats_response
+            "statistics": stats_response,
+            "cursor": cursor
         }
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"خطأ في جلب بيانات النظام: {str(e)}")
 
 
+@app.get("/bootstrap/stream")
+async def bootstrap_stream(current_user: User = Depends(get_current_user_dependency)):
+    """نسخة متدفقة من bootstrap بصيغة NDJSON (سجل JSON في كل سطر)
+
+    السجلات تُرسل فور قراءتها من مؤشر واحد:
+      {"type": "patient", "data": {...}}
+      {"type": "payment", "data": {...}}
+      {"type": "statistics", "data": {...}}
+      {"type": "end", "data": {"patients": N, "payments": M, "cursor": C}}
+    سجل end يؤكد للعميل أن البث اكتمل دون انقطاع، ويحمل مؤشر /sync التالي.
+    """
+    from router.patient_router import get_patients_statistics
+
+    def ndjson_line(record_type: str, data: dict) -> bytes:
+        return (json.dumps({"type": record_type, "data": data}, ensure_ascii=False, default=str) + "\n").encode("utf-8")
+
+    async def generate():
+        patients_count = 0
+        payments_count = 0
+        cursor = await sync_service.current_version()
+
+        try:
+            async for patient in patient_service.iter_patients_with_payments():
+                patients_count += 1
+                yield ndjson_line("patient", _bootstrap_patient_record(patient))
+
+                for payment in patient.payments:
+                    payments_count += 1
+                    yield ndjson_line("payment", _bootstrap_payment_record(payment, patient.name))
+
+            stats_response = await get_patients_statistics(_BootstrapUser())
+            yield ndjson_line("statistics", stats_response)
+            yield ndjson_line("end", {"patients": patients_count, "payments": payments_count, "cursor": cursor})
+
+        except Exception as e:
+            # لا يمكن تغيير رمز الحالة بعد بدء البث، لذلك يُرسل الخطأ كسجل
+            yield ndjson_line("error", {"detail": f"خطأ في جلب بيانات النظام: {str(e)}"})
+
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
+
+
+@app.get("/sync")
+async def sync_changes(
+    since: int = Query(0, ge=0, description="مؤشر آخر مزامنة (0 = مزامنة كاملة)"),
+    current_user: User = Depends(get_current_user_dependency)
+):
+    """المزامنة التفاضلية: إرجاع ما تغيّر بعد المؤشر since فقط
+
+    الاستجابة تحتوي المرضى والدفعات المعدّلة، ومعرفات المحذوفات، والمؤشر التالي.
+    full=true تعني مزامنة كاملة (since=0 أو مؤشر أقدم من سجلات الحذف المحتفظ بها)، فيستبدل العميل بياناته.
+    """
+    try:
+        from router.patient_router import get_patients_statistics
+
+        changes = await sync_service.get_changes(since)
+        stats_response = await get_patients_statistics(_BootstrapUser())
+
+        return {
+            "cursor": changes["cursor"],
+            "full": changes["full"],
+            "patients": [_bootstrap_patient_record(patient) for patient in changes["patients"]],
+            "payments": [
+                _bootstrap_payment_record(payment, patient_name)
+                for payment, patient_name in changes["payments"]
+            ],
+            "deleted": changes["deleted"],
+            "statistics": stats_response
+        }
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"خطأ في مزامنة البيانات: {str(e)}")
+
+
 if __name__ == "__main__":
     import uvicorn
 
@@ -1,23 +1,72 @@
-from fastapi import Request, HTTPException, status
+import re
+from typing import Iterable, Optional
+
+from fastapi import status
 from fastapi.responses import JSONResponse
-from starlette.middleware.base import BaseHTTPMiddleware
-from starlette.types import ASGIApp
+from starlette.types import ASGIApp, Receive, Scope, Send
 
 from services.simple_auth_service import simple_auth_service
 
 
-class AuthMiddleware(BaseHTTPMiddleware):
-    """Middleware للتحقق من المصادقة"""
+class PathMatcher:
+    """مطابقة المسار مع مجموعة بادئات بتعبير نمطي واحد مُجمّع مسبقاً
+
+    البادئة تطابق المسار نفسه وما تحته فقط ("/patients" تطابق "/patients/1" لا "/patientsx")،
+    و"/" تطابق الصفحة الرئيسية وحدها لا كل المسارات.
+    """
+
+    def __init__(self, prefixes: Iterable[str]):
+        self.prefixes = list(prefixes)
+        alternatives = []
+        for prefix in self.prefixes:
+            prefix = prefix.rstrip("/")
+            alternatives.append(re.escape(prefix) + r"(?:/|$)" if prefix else "/$")
+        # نمط لا يطابق شيئاً عند عدم وجود بادئات
+        self._pattern = re.compile("|".join(alternatives) or r"(?!)")
+
+    def matches(self, path: str) -> bool:
+        """هل المسار ضمن إحدى البادئات"""
+        return self._pattern.match(path) is not None
+
+
+def _header(scope: Scope, name: bytes) -> Optional[str]:
+    """قيمة ترويسة من الطلب دون بناء كائن Request"""
+    for key, value in scope["headers"]:
+        if key == name:
+            return value.decode("latin-1")
+    return None
+
+
+def _error(status_code: int, detail: str, error_code: str, headers: dict = None) -> JSONResponse:
+    """استجابة خطأ موحدة للـ middleware"""
+    return JSONResponse(
+        status_code=status_code,
+        content={"detail": detail, "error_code": error_code},
+        headers=headers
+    )
 
-    def __init__(self, app: ASGIApp, protected_paths: list = None):
-        super().__init__(app)
+
+def _unauthorized(detail: str, error_code: str) -> JSONResponse:
+    """استجابة 401 مع ترويسة WWW-Authenticate"""
+    return _error(status.HTTP_401_UNAUTHORIZED, detail, error_code, {"WWW-Authenticate": "Bearer"})
+
+
+class AuthMiddleware:
+    """Middleware للتحقق من المصادقة
+
+    ASGI مباشر (لا BaseHTTPMiddleware): لا مهمة إضافية ولا تغليف لتدفق الاستجابة لكل طلب،
+    فتمر الاستجابات المتدفقة (التصدير، NDJSON) كما هي.
+    """
+
+    def __init__(self, app: ASGIApp, protected_paths: list = None, excluded_paths: list = None):
+        self.app = app
         # المسارات المحمية (تتطلب مصادقة)
-        self.protected_paths = protected_paths or [
+        self.protected_paths = PathMatcher(protected_paths or [
             "/patients",
             "/auth/me"
-        ]
+        ])
         # المسارات المستثناة من المصادقة
-        self.excluded_paths = [
+        self.excluded_paths = PathMatcher(excluded_paths or [
             "/",
             "/health",
             "/docs",
@@ -26,122 +75,97 @@ class AuthMiddleware(BaseHTTPMiddleware):
             "/auth/login",
             "/auth/register",
             "/auth/refresh"
-        ]
+        ])
 
-    async def dispatch(self, request: Request, call_next):
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
         """معالجة الطلب والتحقق من المصادقة"""
-        
-        # التحقق من المسار
-        if self._is_excluded_path(request.url.path):
-            return await call_next(request)
-        
-        # التحقق من المسارات المحمية
-        if self._is_protected_path(request.url.path):
-            # التحقق من وجود Authorization header
-            authorization = request.headers.get("Authorization")
-            
-            if not authorization:
-                return JSONResponse(
-                    status_code=status.HTTP_401_UNAUTHORIZED,
-                    content={
-                        "detail": "مطلوب رمز مصادقة",
-                        "error_code": "MISSING_TOKEN"
-                    },
-                    headers={"WWW-Authenticate": "Bearer"}
-                )
-            
-            # التحقق من تنسيق Bearer Token
-            if not authorization.startswith("Bearer "):
-                return JSONResponse(
-                    status_code=status.HTTP_401_UNAUTHORIZED,
-                    content={
-                        "detail": "تنسيق رمز المصادقة غير صحيح",
-                        "error_code": "INVALID_TOKEN_FORMAT"
-                    },
-                    headers={"WWW-Authenticate": "Bearer"}
-                )
-            
-            # استخراج الرمز المميز
-            token = authorization.split(" ")[1]
-            
-            # التحقق من صحة الرمز المميز
-            token_data = simple_auth_service.verify_token(token)
-            
-            if not token_data:
-                return JSONResponse(
-                    status_code=status.HTTP_401_UNAUTHORIZED,
-                    content={
-                        "detail": "رمز مميز غير صحيح أو منتهي الصلاحية",
-                        "error_code": "INVALID_TOKEN"
-                    },
-                    headers={"WWW-Authenticate": "Bearer"}
-                )
-            
-            # إضافة بيانات المستخدم إلى الطلب
-            request.state.user_id = token_data.user_id
-            request.state.username = token_data.username
-        
-        return await call_next(request)
-
-    def _is_excluded_path(self, path: str) -> bool:
-        """التحقق من أن المسار مستثنى من المصادقة"""
-        return any(path.startswith(excluded) for excluded in self.excluded_paths)
-
-    def _is_protected_path(self, path: str) -> bool:
-        """التحقق من أن المسار محمي ويتطلب مصادقة"""
-        return any(path.startswith(protected) for protected in self.protected_paths)
-
-
-class AdminMiddleware(BaseHTTPMiddleware):
-    """Middleware للتحقق من صلاحيات المدير"""
+
+        # طلبات HTTP فقط، وطلبات OPTIONS (CORS preflight) لا تحمل رمزاً
+        if scope["type"] != "http" or scope["method"] == "OPTIONS":
+            await self.app(scope, receive, send)
+            return
+
+        path = scope["path"]
+        if self.excluded_paths.matches(path) or not self.protected_paths.matches(path):
+            await self.app(scope, receive, send)
+            return
+
+        response = await self._authenticate(scope)
+        if response is not None:
+            await response(scope, receive, send)
+            return
+
+        await self.app(scope, receive, send)
+
+    async def _authenticate(self, scope: Scope) -> Optional[JSONResponse]:
+        """التحقق من الرمز ووضع بياناته في request.state، أو استجابة 401"""
+
+        # التحقق من وجود Authorization header
+        authorization = _header(scope, b"authorization")
+        if not authorization:
+            return _unauthorized("مطلوب رمز مصادقة", "MISSING_TOKEN")
+
+        # التحقق من تنسيق Bearer Token
+        if not authorization.startswith("Bearer "):
+            return _unauthorized("تنسيق رمز المصادقة غير صحيح", "INVALID_TOKEN_FORMAT")
+
+        # التحقق من صحة الرمز المميز
+        token_data = simple_auth_service.verify_token(authorization[len("Bearer "):])
+        if not token_data:
+            return _unauthorized("رمز مميز غير صحيح أو منتهي الصلاحية", "INVALID_TOKEN")
+
+        user = await simple_auth_service.get_user_by_username(token_data.username)
+        if not user:
+            return _unauthorized("المستخدم غير موجود", "USER_NOT_FOUND")
+
+        # scope["state"] هو ما يقرأه request.state (تعيد الاعتمادات استخدامه دون تحقق ثانٍ)
+        state = scope.setdefault("state", {})
+        state["user_id"] = token_data.user_id
+        state["username"] = token_data.username
+        state["token_data"] = token_data
+        state["user"] = user
+        return None
+
+
+class AdminMiddleware:
+    """Middleware للتحقق من صلاحيات المدير (يُضاف بعد AuthMiddleware)"""
 
     def __init__(self, app: ASGIApp, admin_paths: list = None):
-        super().__init__(app)
+        self.app = app
         # المسارات التي تتطلب صلاحيات مدير
-        self.admin_paths = admin_paths or [
+        self.admin_paths = PathMatcher(admin_paths or [
             "/admin",
             "/users"
-        ]
+        ])
 
-    async def dispatch(self, request: Request, call_next):
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
         """معالجة الطلب والتحقق من صلاحيات المدير"""
-        
-        # التحقق من المسار
-        if not self._is_admin_path(request.url.path):
-            return await call_next(request)
-        
+
+        if scope["type"] != "http" or scope["method"] == "OPTIONS" or not self.admin_paths.matches(scope["path"]):
+            await self.app(scope, receive, send)
+            return
+
+        response = await self._check_admin(scope.get("state") or {})
+        if response is not None:
+            await response(scope, receive, send)
+            return
+
+        await self.app(scope, receive, send)
+
+    async def _check_admin(self, state: dict) -> Optional[JSONResponse]:
+        """استجابة خطأ إذا لم يكن المستخدم مديراً، أو None"""
+
         # التحقق من وجود بيانات المستخدم
-        if not hasattr(request.state, 'username'):
-            return JSONResponse(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                content={
-                    "detail": "مطلوب تسجيل دخول",
-                    "error_code": "AUTHENTICATION_REQUIRED"
-                }
-            )
-        
+        if "username" not in state:
+            return _error(status.HTTP_401_UNAUTHORIZED, "مطلوب تسجيل دخول", "AUTHENTICATION_REQUIRED")
+
         # التحقق من صلاحيات المدير
         try:
-            user = await simple_auth_service.get_user_by_username(request.state.username)
+            user = state.get("user") or await simple_auth_service.get_user_by_username(state["username"])
             if not user or not user.is_admin:
-                return JSONResponse(
-                    status_code=status.HTTP_403_FORBIDDEN,
-                    content={
-                        "detail": "ليس لديك صلاحية للوصول إلى هذا المورد",
-                        "error_code": "INSUFFICIENT_PERMISSIONS"
-                    }
-                )
-        except Exception as e:
-            return JSONResponse(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                content={
-                    "detail": "خطأ في التحقق من الصلاحيات",
-                    "error_code": "PERMISSION_CHECK_ERROR"
-                }
-            )
-        
-        return await call_next(request)
-
-    def _is_admin_path(self, path: str) -> bool:
-        """التحقق من أن المسار يتطلب صلاحيات مدير"""
-        return any(path.startswith(admin_path) for admin_path in self.admin_paths)
+                return _error(status.HTTP_403_FORBIDDEN, "ليس لديك صلاحية للوصول إلى هذا المورد",
+                              "INSUFFICIENT_PERMISSIONS")
+        except Exception:
+            return _error(status.HTTP_500_INTERNAL_SERVER_ERROR, "خطأ في التحقق من الصلاحيات",
+                          "PERMISSION_CHECK_ERROR")
+        return None
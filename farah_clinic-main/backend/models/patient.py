@@ -9,9 +9,13 @@ class Payment(BaseModel):
     id: Union[str, ObjectId] = Field(default_factory=ObjectId, alias="_id")
     patient_id: Union[str, ObjectId]
     amount: float = Field(..., gt=0, description="المبلغ المدفوع")
-    payment_date: datetime = Field(default_factory=datetime.now)
+    payment_date: datetime = Field(default_factory=datetime.utcnow)
     notes: Optional[str] = None
 
+    # بيانات المزامنة التفاضلية
+    version: int = Field(default=0, description="إصدار التغيير")
+    updated_at: Optional[datetime] = Field(None, description="آخر تعديل")
+
     @field_validator('id', 'patient_id', mode='before')
     @classmethod
     def validate_objectid(cls, v):
@@ -36,13 +40,28 @@ class Patient(BaseModel):
     total_amount: float = Field(..., gt=0, description="المبلغ الكلي للكمبياله")
     installments_months: int = Field(..., gt=0, le=120, description="عدد أشهر التقسيط")
     notes: Optional[str] = Field(None, max_length=500, description="ملاحظات")
-    registration_date: datetime = Field(default_factory=datetime.now, description="تاريخ التسجيل")
+    registration_date: datetime = Field(default_factory=datetime.utcnow, description="تاريخ التسجيل")
     is_completed: bool = Field(default=False, description="هل تم إكمال التقسيط")
 
+    # حقول البحث المحسوبة عند الكتابة
+    phone_normalized: Optional[str] = Field(None, description="رقم الهاتف بأرقام فقط بدون رمز الدولة (للبحث بالبادئة)")
+    name_search: Optional[str] = Field(None, description="الاسم بعد التوحيد (بدون تشكيل، أ/إ/آ=ا، ى=ي، ة=ه)")
+    name_tokens: List[str] = Field(default_factory=list, description="كلمات الاسم بعد التوحيد")
+    name_trigrams: List[str] = Field(default_factory=list, description="المقاطع الثلاثية لكلمات الاسم")
+
     # حساب المبالغ
     total_paid: float = Field(default=0.0, description="إجمالي المبالغ المدفوعة")
     remaining_amount: float = Field(default=0.0, description="المبلغ المتبقي")
 
+    # ملخص المدفوعات المخزّن في وثيقة المريض (يُحدَّث مع كل عملية على الدفعات)
+    payments_count: int = Field(default=0, ge=0, description="عدد الدفعات")
+    last_payment_date: Optional[datetime] = Field(None, description="تاريخ آخر دفعة")
+    next_due_date: Optional[datetime] = Field(None, description="تاريخ الاستحقاق التالي")
+
+    # بيانات المزامنة التفاضلية
+    version: int = Field(default=0, description="إصدار التغيير")
+    updated_at: Optional[datetime] = Field(None, description="آخر تعديل")
+
     # قائمة المدفوعات
     payments: List[Payment] = Field(default_factory=list, description="قائمة المدفوعات")
 
@@ -77,29 +96,37 @@ class Patient(BaseModel):
         أي أن الدفعة رقم N تجعل الاستحقاق عند (تاريخ التسجيل + N أشهر).
         التالي دائماً (عدد الدفعات + 1) شهر من تاريخ التسجيل.
         """
-        payments_count = len(self.payments) if self.payments else 0
-        base_date = self.registration_date
+        payments_count = len(self.payments) if self.payments else self.payments_count
+        return Patient.compute_next_due_date(self.registration_date, payments_count)
 
-        def add_months(d: datetime, months: int) -> datetime:
-            total_months = (d.month - 1) + months
-            year = d.year + (total_months // 12)
-            month = (total_months % 12) + 1
+    @staticmethod
+    def compute_next_due_date(registration_date: datetime, payments_count: int) -> datetime:
+        """تاريخ الاستحقاق التالي = تاريخ التسجيل + (عدد الدفعات + 1) شهر.
 
-            if month == 12:
-                next_month_first = datetime(year + 1, 1, 1)
-            else:
-                next_month_first = datetime(year, month + 1, 1)
-            last_day = (next_month_first - timedelta(days=1)).day
+        يطابق حساب next_due_date المخزّن في قاعدة البيانات ($dateAdd بوحدة الشهر).
+        """
+        return Patient.add_months(registration_date, payments_count + 1)
+
+    @staticmethod
+    def add_months(d: datetime, months: int) -> datetime:
+        """إضافة أشهر مع تثبيت اليوم على آخر أيام الشهر عند الحاجة (31 يناير + 1 = 28 فبراير)"""
+        total_months = (d.month - 1) + months
+        year = d.year + (total_months // 12)
+        month = (total_months % 12) + 1
 
-            day = min(d.day, last_day)
-            return d.replace(year=year, month=month, day=day)
+        if month == 12:
+            next_month_first = datetime(year + 1, 1, 1)
+        else:
+            next_month_first = datetime(year, month + 1, 1)
+        last_day = (next_month_first - timedelta(days=1)).day
 
-        return add_months(base_date, payments_count + 1)
+        day = min(d.day, last_day)
+        return d.replace(year=year, month=month, day=day)
 
     def is_overdue(self, days_threshold: int = 1):
         """التحقق من وجود متأخرات"""
         next_payment_date = self.get_next_payment_date()
-        days_overdue = (datetime.now() - next_payment_date).days
+        days_overdue = (datetime.utcnow() - next_payment_date).days
         return days_overdue > days_threshold and not self.is_completed
 
 
@@ -2,10 +2,8 @@ from datetime import datetime
 from typing import Optional
 from pydantic import BaseModel, Field, EmailStr
 from bson import ObjectId
-from passlib.context import CryptContext
 
-# إعداد تشفير كلمات المرور
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+from services.password_service import password_service
 
 
 class User(BaseModel):
@@ -27,12 +25,12 @@ class User(BaseModel):
 
     @staticmethod
     def hash_password(password: str) -> str:
-        """تشفير كلمة المرور"""
-        return pwd_context.hash(password)
+        """تشفير كلمة المرور (متزامن؛ داخل الطلبات استخدم password_service.hash)"""
+        return password_service.hash_sync(password)
 
     def verify_password(self, password: str) -> bool:
-        """التحقق من كلمة المرور"""
-        return pwd_context.verify(password, self.hashed_password)
+        """التحقق من كلمة المرور (متزامن؛ داخل الطلبات استخدم password_service.verify)"""
+        return password_service.verify_sync(password, self.hashed_password)
 
     def to_dict(self) -> dict:
         """تحويل إلى قاموس مع استبعاد كلمة المرور"""
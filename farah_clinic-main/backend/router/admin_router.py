@@ -0,0 +1,128 @@
+import json
+from fastapi import APIRouter, HTTPException, Depends, File, UploadFile
+from fastapi.responses import FileResponse, StreamingResponse
+
+from models.user import User
+from services.database import db_service
+from services.patient_service import patient_service
+from services.auth_service import auth_service
+from services.simple_auth_service import simple_auth_service
+from services.statistics_service import statistics_service
+from services.typeahead_service import typeahead_service
+from services.statement_service import statement_service
+from utils.spreadsheet_utils import SpreadsheetUtils
+from router.auth_router import get_admin_user
+
+
+router = APIRouter(prefix="/admin", tags=["admin"])
+
+
+@router.post("/indexes")
+async def ensure_indexes(current_user: User = Depends(get_admin_user)):
+    """إنشاء الفهارس المعلنة (آمن عند التكرار)"""
+    try:
+        created = await db_service.ensure_indexes()
+        return {"indexes": created}
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"خطأ في إنشاء الفهارس: {str(e)}")
+
+
+@router.get("/indexes")
+async def get_index_report(current_user: User = Depends(get_admin_user)):
+    """تقرير استخدام الفهارس ($indexStats) والاستعلامات التي تلجأ إلى COLLSCAN"""
+    try:
+        return await db_service.index_usage_report(
+            patient_service.QUERY_SHAPES + auth_service.QUERY_SHAPES
+        )
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"خطأ في إنشاء تقرير الفهارس: {str(e)}")
+
+
+@router.post("/statistics/reconcile")
+async def reconcile_statistics(current_user: User = Depends(get_admin_user)):
+    """مطابقة عدّادات الإحصائيات مع البيانات الفعلية وإرجاع الانحراف الذي تم إصلاحه"""
+    try:
+        return await statistics_service.reconcile()
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"خطأ في مطابقة الإحصائيات: {str(e)}")
+
+
+@router.get("/cache")
+async def get_cache_stats(current_user: User = Depends(get_admin_user)):
+    """إحصائيات الذاكرة المؤقتة للمرضى وكشوفات PDF ورموز الوصول والمستخدمين (الإصابات والإخفاقات والحجم) وحجم فهرس الاقتراحات"""
+    return {
+        "patients": patient_service.cache_stats(),
+        "statements": statement_service.cache_stats(),
+        "tokens": simple_auth_service.token_cache_stats(),
+        "users": auth_service.cache_stats(),
+        "typeahead": typeahead_service.stats(),
+    }
+
+
+@router.post("/import/patients")
+async def import_patients(
+    file: UploadFile = File(..., description="ملف CSV أو XLSX بسطر عناوين (الاسم، الهاتف، المبلغ الكلي، عدد الأشهر...)"),
+    current_user: User = Depends(get_admin_user)
+):
+    """استيراد المرضى من ملف CSV أو XLSX بشكل متدفق
+
+    يُرجع application/x-ndjson: سجل error لكل صف مرفوض، وسجل progress بعد كل دفعة، وسجل end بالمجاميع.
+    """
+    try:
+        SpreadsheetUtils.check_extension(file.filename)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    def ndjson_line(record: dict) -> bytes:
+        return (json.dumps(record, ensure_ascii=False, default=str) + "\n").encode("utf-8")
+
+    async def generate():
+        try:
+            rows = SpreadsheetUtils.iter_rows(file.filename, file.file)
+            async for event in patient_service.import_patients(rows):
+                yield ndjson_line(event)
+        except Exception as e:
+            # لا يمكن تغيير رمز الحالة بعد بدء البث، لذلك يُرسل الخطأ كسجل
+            yield ndjson_line({"type": "error", "data": {"detail": f"خطأ في استيراد المرضى: {str(e)}"}})
+
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
+
+
+@router.post("/statements/batch", status_code=202)
+async def start_statements_batch(current_user: User = Depends(get_admin_user)):
+    """بدء دفعة كشوفات نهاية الشهر لجميع المرضى غير المكتملين (تعمل في الخلفية)
+
+    يُرجع حالة المهمة؛ تُتابع عبر /admin/statements/batch/{job_id} ويُحمّل الملف عند اكتمالها.
+    """
+    try:
+        return statement_service.start_batch()
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"خطأ في بدء دفعة الكشوفات: {str(e)}")
+
+
+@router.get("/statements/batch/{job_id}")
+async def get_statements_batch(job_id: str, current_user: User = Depends(get_admin_user)):
+    """حالة دفعة الكشوفات: عدد المرضى، ما تم رسمه، الأخطاء، والزمن"""
+    status = statement_service.job_status(job_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="المهمة غير موجودة")
+    return status
+
+
+@router.get("/statements/batch/{job_id}/download")
+async def download_statements_batch(job_id: str, current_user: User = Depends(get_admin_user)):
+    """تحميل ملف ZIP للكشوفات (يُرسل من القرص على أجزاء) بعد اكتمال المهمة"""
+    status = statement_service.job_status(job_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="المهمة غير موجودة")
+
+    archive = statement_service.job_file(job_id)
+    if archive is None:
+        raise HTTPException(status_code=409, detail=f"المهمة لم تكتمل بعد (الحالة: {status['status']})")
+
+    path, filename = archive
+    return FileResponse(path, media_type="application/zip", filename=filename)
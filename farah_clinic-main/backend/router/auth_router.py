@@ -1,24 +1,86 @@
 from datetime import timedelta
-from fastapi import APIRouter, HTTPException, Depends, status
+from fastapi import APIRouter, HTTPException, Depends, Request, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from typing import Optional
 
-from models.user import UserCreate, UserLogin, UserResponse, Token, TokenPair, RefreshRequest
+from models.user import User, UserCreate, UserLogin, UserResponse, Token, TokenPair, RefreshRequest
 from config import config
 from services.simple_auth_service import simple_auth_service
+from services.password_service import PasswordHashBusyError
 
 router = APIRouter(prefix="/auth", tags=["authentication"])
 
 # إعداد Bearer Token
 security = HTTPBearer()
 
+# الثواني المقترحة للعميل قبل إعادة المحاولة عند امتلاء مجمع تشفير كلمات المرور
+PASSWORD_HASH_RETRY_AFTER_SECONDS = 1
+
+
+def _password_hash_busy(e: PasswordHashBusyError) -> HTTPException:
+    """استجابة 429 عند امتلاء مجمع تشفير كلمات المرور"""
+    return HTTPException(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        detail=str(e),
+        headers={"Retry-After": str(PASSWORD_HASH_RETRY_AFTER_SECONDS)},
+    )
+
+
+# دالة للحصول على المستخدم الحالي (للاستخدام في endpoints أخرى)
+async def get_current_user_dependency(request: Request, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """اعتماد للحصول على المستخدم الحالي
+
+    إذا كان AuthMiddleware قد تحقق من الرمز ووضع المستخدم في request.state يُعاد كما هو
+    دون فك الرمز أو البحث عن المستخدم مرة ثانية.
+    """
+    user = getattr(request.state, "user", None)
+    if user is not None:
+        return user
+
+    token_data = simple_auth_service.verify_token(credentials.credentials)
+    
+    if not token_data:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="رمز مميز غير صحيح أو منتهي الصلاحية",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    
+    user = await simple_auth_service.get_user_by_username(token_data.username)
+    if not user:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="المستخدم غير موجود",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+
+    request.state.token_data = token_data
+    request.state.user = user
+    return user
+
+
+# دالة للتحقق من صلاحيات المدير
+async def get_admin_user(current_user = Depends(get_current_user_dependency)):
+    """اعتماد للتحقق من صلاحيات المدير"""
+    if not current_user.is_admin:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="ليس لديك صلاحية للوصول إلى هذا المورد"
+        )
+    return current_user
+
 
 @router.post("/register", response_model=UserResponse, status_code=status.HTTP_201_CREATED)
 async def register(user_data: UserCreate):
-    """تسجيل مستخدم جديد"""
+    """تسجيل مستخدم جديد
+
+    التسجيل متاح دون مصادقة، فالحساب المُنشأ مستخدم عادي دائماً مهما كانت قيمة is_admin المرسلة.
+    """
     try:
-        user = await simple_auth_service.create_user(user_data)
+        user = await simple_auth_service.create_user(user_data.model_copy(update={"is_admin": False}))
         return UserResponse(**user.to_dict())
+    except PasswordHashBusyError as e:
+        raise _password_hash_busy(e)
     except ValueError as e:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -34,10 +96,13 @@ async def register(user_data: UserCreate):
 @router.post("/login", response_model=TokenPair)
 async def login(user_credentials: UserLogin):
     """تسجيل الدخول"""
-    user = await simple_auth_service.authenticate_user(
-        user_credentials.username, 
-        user_credentials.password
-    )
+    try:
+        user = await simple_auth_service.authenticate_user(
+            user_credentials.username,
+            user_credentials.password
+        )
+    except PasswordHashBusyError as e:
+        raise _password_hash_busy(e)
     
     if not user:
         raise HTTPException(
@@ -69,26 +134,9 @@ async def login(user_credentials: UserLogin):
 
 
 @router.get("/me", response_model=UserResponse)
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+async def get_current_user(current_user: User = Depends(get_current_user_dependency)):
     """الحصول على بيانات المستخدم الحالي"""
-    token_data = simple_auth_service.verify_token(credentials.credentials)
-    
-    if not token_data:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="رمز مميز غير صحيح أو منتهي الصلاحية",
-            headers={"WWW-Authenticate": "Bearer"},
-        )
-    
-    user = await simple_auth_service.get_user_by_username(token_data.username)
-    if not user:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="المستخدم غير موجود",
-            headers={"WWW-Authenticate": "Bearer"},
-        )
-    
-    return UserResponse(**user.to_dict())
+    return UserResponse(**current_user.to_dict())
 
 
 @router.post("/refresh", response_model=TokenPair)
@@ -132,37 +180,3 @@ async def logout(body: Optional[RefreshRequest] = None):
     if body and body.refresh_token:
         simple_auth_service.revoke_refresh_token(body.refresh_token)
     return {"message": "تم تسجيل الخروج بنجاح"}
-
-
-# دالة للحصول على المستخدم الحالي (للاستخدام في endpoints أخرى)
-async def get_current_user_dependency(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    """اعتماد للحصول على المستخدم الحالي"""
-    token_data = simple_auth_service.verify_token(credentials.credentials)
-    
-    if not token_data:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="رمز مميز غير صحيح أو منتهي الصلاحية",
-            headers={"WWW-Authenticate": "Bearer"},
-        )
-    
-    user = await simple_auth_service.get_user_by_username(token_data.username)
-    if not user:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="المستخدم غير موجود",
-            headers={"WWW-Authenticate": "Bearer"},
-        )
-    
-    return user
-
-
-# دالة للتحقق من صلاحيات المدير
-async def get_admin_user(current_user = Depends(get_current_user_dependency)):
-    """اعتماد للتحقق من صلاحيات المدير"""
-    if not current_user.is_admin:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="ليس لديك صلاحية للوصول إلى هذا المورد"
-        )
-    return current_user
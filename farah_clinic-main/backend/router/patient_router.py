@@ -1,4 +1,6 @@
-from fastapi import APIRouter, HTTPException, Query, Depends
+from datetime import date, timedelta
+from fastapi import APIRouter, HTTPException, Query, Depends, Request, Response
+from fastapi.responses import StreamingResponse
 from typing import List, Optional
 from bson import ObjectId
 
@@ -7,11 +9,19 @@ from models.user import User
 from schemas.patient import (
     PatientCreate, PatientUpdate, PatientResponse,
     PatientList, PaymentCreate, PaymentResponse,
-    OverdueNotification, PatientFilter, PaymentUpdate
+    OverdueNotification, PatientFilter, PaymentUpdate,
+    PaymentBulkCreate, PaymentBulkResponse
 )
-from services.patient_service import patient_service
+from services.patient_service import (
+    patient_service, OVERDUE_MIN_DAYS, SORT_FIELDS, PATIENT_EXPORT_HEADERS, PAYMENT_EXPORT_HEADERS
+)
+from services.statistics_service import statistics_service
+from services.report_service import report_service, MONTHLY_FIELDS
+from services.typeahead_service import typeahead_service
+from services.statement_service import statement_service
 from utils.date_utils import DateUtils
 from utils.notification_utils import NotificationUtils
+from utils.spreadsheet_utils import SpreadsheetUtils
 from router.auth_router import get_current_user_dependency, get_admin_user
  
 
@@ -38,7 +48,7 @@ async def create_patient(patient: PatientCreate, current_user: User = Depends(ge
             remaining_amount=created_patient.remaining_amount,
             monthly_installment=created_patient.calculate_monthly_installment(),
             next_payment_date=created_patient.get_next_payment_date(),
-            payments_count=len(created_patient.payments)
+            payments_count=created_patient.payments_count
         )
 
         return response
@@ -49,37 +59,63 @@ async def create_patient(patient: PatientCreate, current_user: User = Depends(ge
 
 @router.get("/", response_model=List[PatientList])
 async def get_patients(
+    response: Response,
     name: Optional[str] = Query(None, description="فلترة بالاسم"),
     completed: Optional[bool] = Query(None, description="فلترة بالحالة (مكتمل/غير مكتمل)"),
     overdue_only: Optional[bool] = Query(False, description="عرض المتأخرات فقط"),
+    sort: str = Query("name", description=f"حقل الترتيب: {', '.join(SORT_FIELDS)}"),
+    order: str = Query("asc", pattern="^(asc|desc)$", description="اتجاه الترتيب"),
+    limit: Optional[int] = Query(None, ge=1, le=500, description="حجم الصفحة (بدونه تُرجع كل النتائج)"),
+    cursor: Optional[str] = Query(None, description="مؤشر الصفحة التالية من ترويسة X-Next-Cursor"),
     current_user: User = Depends(get_current_user_dependency)
 ):
-    """الحصول على جميع المرضى مع فلترة"""
+    """الحصول على جميع المرضى مع فلترة وترقيم بالمؤشر"""
     try:
-        patients = await patient_service.get_all_patients(
+        patients, next_cursor = await patient_service.get_patients_page(
             name_filter=name,
             completed_filter=completed,
-            overdue_only=overdue_only
+            overdue_only=overdue_only,
+            sort=sort,
+            descending=order == "desc",
+            limit=limit,
+            cursor=cursor
         )
+        if next_cursor:
+            response.headers["X-Next-Cursor"] = next_cursor
         return patients
 
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"خطأ في استرجاع المرضى: {str(e)}")
 
 
 @router.get("/search", response_model=List[PatientResponse])
 async def search_patients(
+    response: Response,
     query: str = Query(..., description="البحث بالاسم أو رقم الهاتف"),
+    sort: Optional[str] = Query(None, description=f"حقل الترتيب: {', '.join(SORT_FIELDS)} (بدونه: الأكثر تطابقاً أولاً)"),
+    order: str = Query("asc", pattern="^(asc|desc)$", description="اتجاه الترتيب"),
+    limit: Optional[int] = Query(None, ge=1, le=500, description="حجم الصفحة (بدونه تُرجع كل النتائج)"),
+    cursor: Optional[str] = Query(None, description="مؤشر الصفحة التالية من ترويسة X-Next-Cursor"),
     current_user: User = Depends(get_current_user_dependency)
 ):
     """البحث عن مريض بالاسم أو رقم الهاتف"""
     try:
-        patients = await patient_service.get_patient_by_name_or_phone(query)
+        patients, next_cursor = await patient_service.search_patients_page(
+            query,
+            sort=sort,
+            descending=order == "desc",
+            limit=limit,
+            cursor=cursor
+        )
+        if next_cursor:
+            response.headers["X-Next-Cursor"] = next_cursor
 
         # تحويل إلى PatientResponse
-        responses = []
+        page = []
         for patient in patients:
-            response = PatientResponse(
+            patient_response = PatientResponse(
                 id=patient.id,
                 name=patient.name,
                 phone=patient.phone,
@@ -92,16 +128,94 @@ async def search_patients(
                 remaining_amount=patient.remaining_amount,
                 monthly_installment=patient.calculate_monthly_installment(),
                 next_payment_date=patient.get_next_payment_date(),
-                payments_count=len(patient.payments)
+                payments_count=patient.payments_count
             )
-            responses.append(response)
+            page.append(patient_response)
 
-        return responses
+        return page
 
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"خطأ في البحث عن المرضى: {str(e)}")
 
 
+@router.get("/search/suggest")
+async def suggest_patients(
+    q: str = Query(..., min_length=1, description="بداية الاسم أو رقم الهاتف"),
+    limit: int = Query(10, ge=1, le=50, description="أقصى عدد للاقتراحات"),
+    current_user: User = Depends(get_current_user_dependency)
+):
+    """اقتراحات سريعة أثناء الكتابة من فهرس في الذاكرة (بدون استعلام قاعدة البيانات)"""
+    try:
+        return typeahead_service.suggest(q, limit)
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"خطأ في اقتراحات البحث: {str(e)}")
+
+
+def _export_response(name: str, file_format: str, headers, rows) -> StreamingResponse:
+    """استجابة تصدير متدفقة كملف مرفق"""
+    filename = f"{name}-{DateUtils.get_baghdad_now():%Y%m%d}.{file_format}"
+    return StreamingResponse(
+        SpreadsheetUtils.export_chunks(file_format, headers, rows),
+        media_type=SpreadsheetUtils.MEDIA_TYPES[file_format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+
+def _export_date_range(from_date: Optional[date], to_date: Optional[date]):
+    """حدود نطاق التصدير (أيام بتوقيت بغداد شاملة) محوّلة إلى UTC"""
+    if from_date and to_date and from_date > to_date:
+        raise ValueError("يجب أن يكون تاريخ البداية قبل تاريخ النهاية")
+    return (
+        DateUtils.get_day_start_utc(from_date) if from_date else None,
+        DateUtils.get_day_start_utc(to_date + timedelta(days=1)) if to_date else None,
+    )
+
+
+@router.get("/export")
+async def export_patients(
+    file_format: str = Query("csv", alias="format", pattern="^(csv|xlsx)$", description="صيغة الملف"),
+    from_date: Optional[date] = Query(None, description="تاريخ التسجيل من (YYYY-MM-DD، بتوقيت بغداد)"),
+    to_date: Optional[date] = Query(None, description="تاريخ التسجيل إلى (شاملاً)"),
+    completed: Optional[bool] = Query(None, description="فلترة بالحالة (مكتمل/غير مكتمل)"),
+    batch_size: int = Query(1000, ge=100, le=10000, description="حجم دفعة القراءة من قاعدة البيانات"),
+    current_user: User = Depends(get_current_user_dependency)
+):
+    """تصدير سجل المرضى كملف CSV أو XLSX متدفق (ذاكرة ثابتة مهما كان عدد المرضى)"""
+    try:
+        start, end = _export_date_range(from_date, to_date)
+        rows = patient_service.iter_patients_export(start, end, completed, batch_size)
+        return _export_response("patients", file_format, PATIENT_EXPORT_HEADERS, rows)
+
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"خطأ في تصدير المرضى: {str(e)}")
+
+
+@router.get("/payments/export")
+async def export_payments(
+    file_format: str = Query("csv", alias="format", pattern="^(csv|xlsx)$", description="صيغة الملف"),
+    from_date: Optional[date] = Query(None, description="تاريخ الدفعة من (YYYY-MM-DD، بتوقيت بغداد)"),
+    to_date: Optional[date] = Query(None, description="تاريخ الدفعة إلى (شاملاً)"),
+    completed: Optional[bool] = Query(None, description="فلترة بحالة المريض (مكتمل/غير مكتمل)"),
+    batch_size: int = Query(1000, ge=100, le=10000, description="حجم دفعة القراءة من قاعدة البيانات"),
+    current_user: User = Depends(get_current_user_dependency)
+):
+    """تصدير سجل الدفعات مع أسماء المرضى كملف CSV أو XLSX متدفق"""
+    try:
+        start, end = _export_date_range(from_date, to_date)
+        rows = patient_service.iter_payments_export(start, end, completed, batch_size)
+        return _export_response("payments", file_format, PAYMENT_EXPORT_HEADERS, rows)
+
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"خطأ في تصدير الدفعات: {str(e)}")
+
+
 @router.get("/{patient_id}", response_model=PatientResponse)
 async def get_patient(patient_id: str, current_user: User = Depends(get_current_user_dependency)):
     """الحصول على تفاصيل مريض معين"""
@@ -125,7 +239,7 @@ async def get_patient(patient_id: str, current_user: User = Depends(get_current_
             remaining_amount=patient.remaining_amount,
             monthly_installment=patient.calculate_monthly_installment(),
             next_payment_date=patient.get_next_payment_date(),
-            payments_count=len(patient.payments)
+            payments_count=patient.payments_count
         )
 
         return response
@@ -159,7 +273,7 @@ async def update_patient(patient_id: str, patient_update: PatientUpdate, current
             remaining_amount=updated_patient.remaining_amount,
             monthly_installment=updated_patient.calculate_monthly_installment(),
             next_payment_date=updated_patient.get_next_payment_date(),
-            payments_count=len(updated_patient.payments)
+            payments_count=updated_patient.payments_count
         )
 
         return response
@@ -187,6 +301,20 @@ async def delete_patient(patient_id: str, current_user: User = Depends(get_admin
         raise HTTPException(status_code=500, detail=f"خطأ في حذف المريض: {str(e)}")
 
 
+@router.post("/payments/bulk", response_model=PaymentBulkResponse)
+async def create_payments_bulk(bulk: PaymentBulkCreate, current_user: User = Depends(get_current_user_dependency)):
+    """إدخال مجموعة دفعات في طلب واحد (نتيجة لكل دفعة بنفس الترتيب)"""
+    try:
+        results = await patient_service.create_payments_bulk(bulk.payments)
+        created = sum(1 for result in results if result["success"])
+        return PaymentBulkResponse(created=created, failed=len(results) - created, results=results)
+
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"خطأ في إدخال الدفعات: {str(e)}")
+
+
 @router.post("/{patient_id}/payments", response_model=PaymentResponse)
 async def create_payment(patient_id: str, payment: PaymentCreate, current_user: User = Depends(get_current_user_dependency)):
     """إنشاء دفعة جديدة لمريض"""
@@ -194,14 +322,13 @@ async def create_payment(patient_id: str, payment: PaymentCreate, current_user:
         # التأكد من أن معرف المريض صحيح
         payment.patient_id = patient_id
 
-        created_payment = await patient_service.create_payment(payment)
+        # اسم المريض يُرجع من نفس تحديث الملخص (بدون قراءة إضافية)
+        result = await patient_service.record_payment(payment)
 
-        if not created_payment:
+        if not result:
             raise HTTPException(status_code=404, detail="المريض غير موجود")
 
-        # جلب اسم المريض
-        patient = await patient_service.get_patient_by_id(patient_id)
-        patient_name = patient.name if patient else None
+        created_payment, patient_name = result
 
         # تحويل إلى PaymentResponse
         response = PaymentResponse(
@@ -221,6 +348,38 @@ async def create_payment(patient_id: str, payment: PaymentCreate, current_user:
         raise HTTPException(status_code=500, detail=f"خطأ في إنشاء الدفعة: {str(e)}")
 
 
+@router.get("/{patient_id}/statement.pdf")
+async def get_patient_statement(
+    patient_id: str,
+    request: Request,
+    current_user: User = Depends(get_current_user_dependency)
+):
+    """كشف حساب المريض PDF (البيانات، سجل الدفعات، المتبقي، جدول الأقساط)
+
+    الكشف يُحفظ حسب إصدار المريض، ويُرجع 304 إذا كان لدى العميل نفس النسخة (If-None-Match).
+    """
+    try:
+        result = await statement_service.get_statement(patient_id)
+        if not result:
+            raise HTTPException(status_code=404, detail="المريض غير موجود")
+
+        pdf, version_key = result
+        etag = f'"{version_key}"'
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers={"ETag": etag})
+
+        return Response(
+            content=pdf,
+            media_type="application/pdf",
+            headers={"ETag": etag, "Content-Disposition": f'inline; filename="statement-{patient_id}.pdf"'}
+        )
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"خطأ في إنشاء كشف الحساب: {str(e)}")
+
+
 @router.get("/{patient_id}/payments", response_model=List[PaymentResponse])
 async def get_patient_payments(patient_id: str, current_user: User = Depends(get_current_user_dependency)):
     """جلب جميع مدفوعات مريض معين"""
@@ -308,10 +467,19 @@ async def delete_payment(patient_id: str, payment_id: str, current_user: User =
 
 
 @router.get("/notifications/overdue", response_model=List[OverdueNotification])
-async def get_overdue_notifications(current_user: User = Depends(get_current_user_dependency)):
-    """الحصول على إشعارات المتأخرات"""
+async def get_overdue_notifications(
+    min_days: int = Query(OVERDUE_MIN_DAYS, ge=0, description="أقل عدد أيام تأخير"),
+    skip: int = Query(0, ge=0, description="عدد النتائج المتجاوزة"),
+    limit: Optional[int] = Query(None, ge=1, le=1000, description="أقصى عدد للنتائج"),
+    current_user: User = Depends(get_current_user_dependency)
+):
+    """الحصول على إشعارات المتأخرات (الأكثر تأخراً أولاً)"""
     try:
-        notifications = await patient_service.get_overdue_notifications()
+        notifications = await patient_service.get_overdue_notifications(
+            min_days=min_days,
+            skip=skip,
+            limit=limit
+        )
         return notifications
 
     except Exception as e:
@@ -350,24 +518,25 @@ async def get_upcoming_payments(days_ahead: int = Query(7, description="عدد 
 
 @router.get("/statistics/summary")
 async def get_patients_statistics(current_user: User = Depends(get_current_user_dependency)):
-    """الحصول على إحصائيات المرضى"""
+    """الحصول على إحصائيات المرضى
+
+    العدّادات تُقرأ من وثيقة إحصائيات واحدة تُحدَّث مع كل كتابة، وملخص المتأخرات بتجميع واحد.
+    """
     try:
-        # الحصول على جميع المرضى
-        all_patients = await patient_service.get_all_patients()
+        counters = await statistics_service.get_counters()
 
         # إحصائيات عامة
-        total_patients = len(all_patients)
-        completed_patients = len([p for p in all_patients if p.is_completed])
+        total_patients = counters["total_patients"]
+        completed_patients = counters["completed_patients"]
         active_patients = total_patients - completed_patients
 
         # إجمالي المبالغ
-        total_amount = sum(p.total_amount for p in all_patients)
-        total_paid = sum(p.total_amount - p.remaining_amount for p in all_patients)
-        total_remaining = sum(p.remaining_amount for p in all_patients)
+        total_amount = counters["total_amount"]
+        total_paid = counters["total_paid"]
+        total_remaining = counters["total_remaining"]
 
         # إشعارات المتأخرات
-        overdue_notifications = await patient_service.get_overdue_notifications()
-        overdue_summary = NotificationUtils.get_overdue_summary(overdue_notifications)
+        overdue_summary = await patient_service.get_overdue_summary()
 
         return {
             "total_patients": total_patients,
@@ -382,3 +551,29 @@ async def get_patients_statistics(current_user: User = Depends(get_current_user_
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"خطأ في استرجاع الإحصائيات: {str(e)}")
+
+
+@router.get("/statistics/monthly")
+async def get_monthly_statistics(
+    from_month: Optional[str] = Query(None, alias="from", description="شهر البداية YYYY-MM (افتراضياً قبل 11 شهراً)"),
+    to_month: Optional[str] = Query(None, alias="to", description="شهر النهاية YYYY-MM (افتراضياً الشهر الحالي)"),
+    current_user: User = Depends(get_current_user_dependency)
+):
+    """تقرير الإيرادات والتحصيل الشهري بتوقيت بغداد"""
+    try:
+        to_month = to_month or DateUtils.get_month_key(DateUtils.get_baghdad_now())
+        from_month = from_month or DateUtils.shift_month_key(to_month, -11)
+
+        months = await report_service.get_monthly_report(from_month, to_month)
+        return {
+            "from": from_month,
+            "to": to_month,
+            "timezone": DateUtils.BAGHDAD_TZ.zone,
+            "months": months,
+            "totals": {field: round(sum(month[field] for month in months), 2) for field in MONTHLY_FIELDS}
+        }
+
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"خطأ في استرجاع التقرير الشهري: {str(e)}")
@@ -73,6 +73,27 @@ class PaymentCreate(BaseModel):
     notes: Optional[str] = Field(None, max_length=500, description="ملاحظات")
 
 
+class PaymentBulkCreate(BaseModel):
+    """سكيما إدخال مجموعة دفعات دفعة واحدة"""
+    payments: List[PaymentCreate] = Field(..., min_length=1, description="الدفعات")
+
+
+class PaymentBulkItemResult(BaseModel):
+    """نتيجة عنصر واحد في الإدخال الجماعي"""
+    index: int
+    success: bool
+    payment_id: Optional[str] = None
+    patient_name: Optional[str] = None
+    error: Optional[str] = None
+
+
+class PaymentBulkResponse(BaseModel):
+    """سكيما نتيجة الإدخال الجماعي للدفعات"""
+    created: int
+    failed: int
+    results: List[PaymentBulkItemResult]
+
+
 class PaymentResponse(BaseModel):
     """سكيما عرض الدفعة"""
     id: Union[str, ObjectId] = Field(alias="_id")
@@ -1,38 +1,110 @@
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Any, Dict, Optional, Tuple
 from jose import JWTError, jwt
-from passlib.context import CryptContext
 from config import config
 from motor.motor_asyncio import AsyncIOMotorCollection
-from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
 
 from models.user import User, UserCreate, UserLogin, Token, TokenData
 from services.database import db_service
+from services.password_service import password_service
 
 # إعدادات JWT من متغيرات البيئة
 SECRET_KEY = config.JWT_SECRET_KEY
 ALGORITHM = config.JWT_ALGORITHM
 ACCESS_TOKEN_EXPIRE_MINUTES = config.JWT_ACCESS_TOKEN_EXPIRE_MINUTES
 
-# إعداد تشفير كلمات المرور
-pwd_context = CryptContext(
-    schemes=["bcrypt"],
-    deprecated="auto",
-    bcrypt__rounds=config.BCRYPT_ROUNDS,
-)
+# ذاكرة المستخدمين المؤقتة: أقصى عدد مستخدمين ومدة صلاحية كل مستخدم (بالثواني)
+# المدة تحدد أقصى تأخر في رؤية تعديل أجرته عملية خادم أخرى (مثل تعطيل مستخدم)
+USER_CACHE_SIZE = 256
+USER_CACHE_TTL_SECONDS = 60
 
 
 class AuthService:
     """خدمة المصادقة"""
 
+    # استعلامات نموذجية لتقرير الفهارس
+    QUERY_SHAPES = [
+        {"name": "get_user_by_username", "collection": "users", "filter": {"username": "admin"}},
+    ]
+
     def __init__(self):
         self.users_collection: AsyncIOMotorCollection = None
+        # المستخدمون المقروؤون مؤخراً (LRU مع مدة صلاحية): اسم المستخدم -> (وقت الانتهاء، المستخدم)
+        # مع فهرس من المعرف إلى الاسم، فالبحث بأي منهما من الذاكرة دون استعلام
+        self._user_cache: "OrderedDict[str, Tuple[float, User]]" = OrderedDict()
+        self._user_ids: Dict[str, str] = {}
+        # يزداد مع كل إبطال، حتى لا تُخزَّن نتيجة استعلام بدأ قبل التعديل
+        self._cache_generation = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
 
     async def initialize_collection(self):
         """تهيئة مجموعة المستخدمين"""
         if self.users_collection is None:
             self.users_collection = db_service.get_collection("users")
 
+    def invalidate_user(self, username: Optional[str] = None):
+        """إبطال مستخدم من الذاكرة المؤقتة (أو جميع المستخدمين إذا لم يُحدد الاسم)"""
+        self._cache_generation += 1
+        if username is None:
+            self._user_cache.clear()
+            self._user_ids.clear()
+        else:
+            self._forget(username)
+
+    def cache_stats(self) -> Dict[str, Any]:
+        """إحصائيات الذاكرة المؤقتة للمستخدمين"""
+        lookups = self.cache_hits + self.cache_misses
+        return {
+            "size": len(self._user_cache),
+            "max_size": USER_CACHE_SIZE,
+            "ttl_seconds": USER_CACHE_TTL_SECONDS,
+            "hits": self.cache_hits,
+            "misses": self.cache_misses,
+            "hit_rate": round(self.cache_hits / lookups, 3) if lookups else 0.0,
+        }
+
+    def _cached_user(self, username: str) -> Optional[User]:
+        """المستخدم من الذاكرة المؤقتة إن وُجد ولم تنتهِ صلاحيته"""
+        cached = self._user_cache.get(username)
+        if cached is None:
+            return None
+        expires_at, user = cached
+        if expires_at <= time.monotonic():
+            self._forget(username)
+            return None
+        self._user_cache.move_to_end(username)
+        self.cache_hits += 1
+        return user
+
+    async def _load_user(self, query: Dict[str, Any]) -> Optional[User]:
+        """قراءة مستخدم من قاعدة البيانات وحفظه في الذاكرة المؤقتة"""
+        await self.initialize_collection()
+
+        self.cache_misses += 1
+        generation = self._cache_generation
+        user_data = await self.users_collection.find_one(query)
+        if not user_data:
+            return None
+
+        user = User(**user_data)
+        if generation == self._cache_generation:
+            self._forget(user.username)
+            self._user_cache[user.username] = (time.monotonic() + USER_CACHE_TTL_SECONDS, user)
+            self._user_ids[str(user.id)] = user.username
+            if len(self._user_cache) > USER_CACHE_SIZE:
+                self._forget(next(iter(self._user_cache)))
+        return user
+
+    def _forget(self, username: str):
+        """حذف مستخدم من الذاكرة المؤقتة ومن فهرس المعرفات"""
+        cached = self._user_cache.pop(username, None)
+        if cached is not None:
+            self._user_ids.pop(str(cached[1].id), None)
+
     def create_access_token(self, data: dict, expires_delta: Optional[timedelta] = None):
         """إنشاء رمز مميز للوصول"""
         to_encode = data.copy()
@@ -73,13 +145,17 @@ class AuthService:
             username=user_data.username,
             email=user_data.email,
             full_name=user_data.full_name,
-            hashed_password=User.hash_password(user_data.password),
+            hashed_password=await password_service.hash(user_data.password),
             is_admin=user_data.is_admin
         )
 
-        # إدراج في قاعدة البيانات
-        result = await self.users_collection.insert_one(user.dict(by_alias=True))
-        
+        # إدراج في قاعدة البيانات (الفهرس الفريد على username يمنع تكرار الاسم بين الطلبات المتزامنة)
+        try:
+            result = await self.users_collection.insert_one(user.dict(by_alias=True))
+        except DuplicateKeyError:
+            raise ValueError("اسم المستخدم موجود بالفعل")
+        self.invalidate_user(user.username)
+
         # استرجاع المستخدم المُدرج
         created_user = await self.users_collection.find_one({"_id": result.inserted_id})
         return User(**created_user)
@@ -93,34 +169,33 @@ class AuthService:
             return None
 
         user = User(**user_data)
-        if not user.verify_password(password):
+        verified, new_hash = await password_service.verify_and_update(password, user.hashed_password)
+        if not verified:
             return None
 
+        # التشفير المخزّن أضعف من السياسة الحالية: يُستبدل بالجديد
+        if new_hash:
+            await self.users_collection.update_one({"_id": user_data["_id"]}, {"$set": {"hashed_password": new_hash}})
+            self.invalidate_user(username)
+            user.hashed_password = new_hash
+
         if not user.is_active:
             return None
 
         return user
 
     async def get_user_by_username(self, username: str) -> Optional[User]:
-        """الحصول على مستخدم بالاسم"""
-        await self.initialize_collection()
+        """الحصول على مستخدم بالاسم
 
-        user_data = await self.users_collection.find_one({"username": username})
-        if user_data:
-            return User(**user_data)
-        return None
+        النتيجة تُقرأ من الذاكرة المؤقتة إن وُجدت، ولا يجب تعديل الكائن المُرجع.
+        """
+        return self._cached_user(username) or await self._load_user({"username": username})
 
     async def get_user_by_id(self, user_id: str) -> Optional[User]:
-        """الحصول على مستخدم بالمعرف"""
-        await self.initialize_collection()
-
-        try:
-            user_data = await self.users_collection.find_one({"_id": ObjectId(user_id)})
-            if user_data:
-                return User(**user_data)
-        except Exception:
-            pass
-        return None
+        """الحصول على مستخدم بالمعرف (المعرف يُخزّن نصاً في _id كما ينشئه نموذج User)"""
+        username = self._user_ids.get(str(user_id))
+        user = self._cached_user(username) if username is not None else None
+        return user or await self._load_user({"_id": str(user_id)})
 
     async def update_last_login(self, username: str):
         """تحديث آخر تسجيل دخول"""
@@ -130,6 +205,7 @@ class AuthService:
             {"username": username},
             {"$set": {"last_login": datetime.now()}}
         )
+        self.invalidate_user(username)
 
     async def create_default_admin(self):
         """إنشاء مدير افتراضي إذا لم يكن موجوداً"""
@@ -158,13 +234,37 @@ class AuthService:
             print(f"⚠️ خطأ في إنشاء المدير الافتراضي: {e}")
             print("💡 يمكنك إنشاء المدير يدوياً عبر API")
 
+    async def create_default_user(self):
+        """إنشاء مستخدم عادي افتراضي إذا لم يكن موجوداً"""
+        try:
+            await self.initialize_collection()
+
+            user_exists = await self.users_collection.find_one({"username": "user"})
+            if user_exists:
+                print("✅ المستخدم العادي موجود بالفعل")
+                return
+
+            default_user = UserCreate(
+                username="user",
+                email="user@farahdental.com",
+                full_name="مستخدم عادي",
+                password="user123",  # يجب تغييرها في الإنتاج
+                is_admin=False
+            )
+
+            await self.create_user(default_user)
+            print("✅ تم إنشاء المستخدم العادي الافتراضي: user / user123")
+
+        except Exception as e:
+            print(f"⚠️ خطأ في إنشاء المستخدم العادي الافتراضي: {e}")
+
     def get_password_hash(self, password: str) -> str:
         """تشفير كلمة المرور"""
-        return pwd_context.hash(password)
+        return password_service.hash_sync(password)
 
     def verify_password(self, plain_password: str, hashed_password: str) -> bool:
         """التحقق من كلمة المرور"""
-        return pwd_context.verify(plain_password, hashed_password)
+        return password_service.verify_sync(plain_password, hashed_password)
 
 
 # إنشاء نسخة واحدة من خدمة المصادقة
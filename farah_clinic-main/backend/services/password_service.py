@@ -0,0 +1,214 @@
+"""
+خدمة تشفير كلمات المرور المشتركة
+
+مكان واحد لسياسة التشفير (الخوارزمية وكلفتها) ولمجمع الخيوط الذي يجري فيه التشفير.
+الكلفة تُعاير عند بدء التشغيل لتقارب زمن تحقق مستهدف على الخادم الحالي، أو تُثبت من الإعدادات.
+
+للمعايرة من سطر الأوامر: python -m services.password_service [--target-ms 250] [--scheme bcrypt]
+"""
+
+import argparse
+import asyncio
+import math
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, Tuple, TypeVar
+
+from passlib.context import CryptContext
+from passlib.hash import argon2, bcrypt
+
+from config import config
+
+
+T = TypeVar("T")
+
+# الخوارزميات المدعومة
+SUPPORTED_SCHEMES = ("bcrypt", "argon2")
+
+# حدود الكلفة: الحد الأدنى أماناً مهما كان الخادم بطيئاً، والأعلى حتى لا يطول الدخول بلا حد
+MIN_BCRYPT_ROUNDS = 10
+MAX_BCRYPT_ROUNDS = 16
+MIN_ARGON2_ROUNDS = 2
+MAX_ARGON2_ROUNDS = 20
+
+# ذاكرة argon2 لكل عملية تشفير (KiB)
+ARGON2_MEMORY_COST_KIB = 64 * 1024
+
+# كلفة bcrypt قبل المعايرة (وعند تعذرها)
+DEFAULT_BCRYPT_ROUNDS = 12
+
+# عدد القياسات في المعايرة (يؤخذ الوسيط)
+CALIBRATION_SAMPLES = 3
+
+
+class PasswordHashBusyError(Exception):
+    """مجمع تشفير كلمات المرور ممتلئ (يُرجع للعميل 429 بدل الانتظار)"""
+
+
+class PasswordService:
+    """تشفير كلمات المرور والتحقق منها بسياسة واحدة معايرة على الخادم"""
+
+    def __init__(self):
+        self.scheme = self._resolve_scheme(config.PASSWORD_HASH_SCHEME)
+        rounds = (config.BCRYPT_ROUNDS or DEFAULT_BCRYPT_ROUNDS) if self.scheme == "bcrypt" else MIN_ARGON2_ROUNDS
+        self.policy: Dict[str, Any] = {"scheme": self.scheme, "rounds": rounds, "verify_ms": None, "calibrated": False}
+        self.context = self._build_context(self.scheme, rounds)
+
+        # التشفير يستغرق مئات الملّي ثانية ويحرر GIL، لذلك يجري في خيوط منفصلة عن حلقة الأحداث.
+        # عدد العمليات المقبولة (قيد التنفيذ + في الانتظار) محدود، وما زاد يُرفض فوراً.
+        self._executor = ThreadPoolExecutor(
+            max_workers=config.PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash"
+        )
+        self._slots = threading.BoundedSemaphore(config.PASSWORD_HASH_WORKERS + config.PASSWORD_HASH_QUEUE)
+        self.rejected = 0
+        self.rehashed = 0
+
+    async def hash(self, password: str) -> str:
+        """تشفير كلمة المرور دون إيقاف حلقة الأحداث"""
+        return await self._run(self.hash_sync, password)
+
+    async def verify(self, password: str, hashed_password: str) -> bool:
+        """التحقق من كلمة المرور دون إيقاف حلقة الأحداث"""
+        return await self._run(self.verify_sync, password, hashed_password)
+
+    async def verify_and_update(self, password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+        """التحقق من كلمة المرور، مع تشفير جديد إذا كان المخزّن أضعف من السياسة الحالية
+
+        يُرجع (صحيحة؟، التشفير الجديد أو None)؛ على المستدعي حفظ التشفير الجديد إن وُجد.
+        """
+        verified, new_hash = await self._run(self.context.verify_and_update, password, hashed_password)
+        if new_hash is not None:
+            self.rehashed += 1
+        return verified, new_hash
+
+    def hash_sync(self, password: str) -> str:
+        """تشفير متزامن (خارج حلقة الأحداث فقط: التهيئة والسكربتات)"""
+        return self.context.hash(password)
+
+    def verify_sync(self, password: str, hashed_password: str) -> bool:
+        """تحقق متزامن (خارج حلقة الأحداث فقط)"""
+        return self.context.verify(password, hashed_password)
+
+    async def _run(self, func: Callable[..., T], *args) -> T:
+        """تنفيذ عملية تشفير في مجمع الخيوط، أو PasswordHashBusyError إذا كان ممتلئاً
+
+        المكان يُحرر عند انتهاء العملية في الخيط نفسه، حتى لو أُلغي الطلب قبلها.
+        """
+        if not self._slots.acquire(blocking=False):
+            self.rejected += 1
+            raise PasswordHashBusyError("الخادم مشغول بطلبات تسجيل الدخول، حاول بعد قليل")
+        try:
+            future = self._executor.submit(func, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return await asyncio.wrap_future(future)
+
+    async def calibrate_async(self) -> Dict[str, Any]:
+        """معايرة الكلفة عند بدء التشغيل (في خيط حتى لا تتوقف حلقة الأحداث)"""
+        return await asyncio.to_thread(self.calibrate)
+
+    def calibrate(self, target_ms: Optional[float] = None) -> Dict[str, Any]:
+        """قياس الخادم واعتماد أعلى كلفة لا يتجاوز زمن تحققها target_ms
+
+        إذا كانت BCRYPT_ROUNDS محددة في الإعدادات تُعتمد كما هي لـ bcrypt، ويُقدّر زمنها فقط.
+        """
+        if self.scheme == "bcrypt" and config.BCRYPT_ROUNDS:
+            rounds = config.BCRYPT_ROUNDS
+            verify_ms = self.measure_verify_ms("bcrypt", MIN_BCRYPT_ROUNDS) * 2 ** (rounds - MIN_BCRYPT_ROUNDS)
+        else:
+            rounds, verify_ms = self.choose_rounds(self.scheme, target_ms or config.PASSWORD_HASH_TARGET_MS)
+
+        self.context = self._build_context(self.scheme, rounds)
+        self.policy = {"scheme": self.scheme, "rounds": rounds, "verify_ms": round(verify_ms, 1), "calibrated": True}
+        return self.policy
+
+    @staticmethod
+    def choose_rounds(scheme: str, target_ms: float) -> Tuple[int, float]:
+        """(الكلفة، زمن التحقق المقدّر) لأعلى كلفة ضمن target_ms
+
+        يُقاس زمن أدنى كلفة مرة واحدة ثم يُقدّر الباقي: كل جولة bcrypt تضاعف الزمن، وزمن argon2
+        يتناسب خطياً مع عدد الجولات.
+        """
+        if scheme == "bcrypt":
+            base_ms = PasswordService.measure_verify_ms("bcrypt", MIN_BCRYPT_ROUNDS)
+            extra = math.floor(math.log2(target_ms / base_ms)) if target_ms > base_ms else 0
+            rounds = min(MAX_BCRYPT_ROUNDS, MIN_BCRYPT_ROUNDS + extra)
+            return rounds, base_ms * 2 ** (rounds - MIN_BCRYPT_ROUNDS)
+
+        base_ms = PasswordService.measure_verify_ms("argon2", MIN_ARGON2_ROUNDS)
+        per_round_ms = base_ms / MIN_ARGON2_ROUNDS
+        rounds = max(MIN_ARGON2_ROUNDS, min(MAX_ARGON2_ROUNDS, int(target_ms // per_round_ms)))
+        return rounds, per_round_ms * rounds
+
+    @staticmethod
+    def measure_verify_ms(scheme: str, rounds: int) -> float:
+        """وسيط زمن التحقق (بالملّي ثانية) لخوارزمية وكلفة محددتين"""
+        handler = PasswordService._handler(scheme, rounds)
+        hashed = handler.hash("calibration-password")
+        samples = []
+        for _ in range(CALIBRATION_SAMPLES):
+            started = time.perf_counter()
+            handler.verify("calibration-password", hashed)
+            samples.append((time.perf_counter() - started) * 1000)
+        return statistics.median(samples)
+
+    @staticmethod
+    def _handler(scheme: str, rounds: int):
+        """معالج passlib بالكلفة المطلوبة"""
+        if scheme == "argon2":
+            return argon2.using(rounds=rounds, memory_cost=ARGON2_MEMORY_COST_KIB)
+        return bcrypt.using(rounds=rounds)
+
+    @staticmethod
+    def _build_context(scheme: str, rounds: int) -> CryptContext:
+        """سياق التشفير: الخوارزمية المختارة افتراضية، والأخرى مقبولة للتحقق فقط
+
+        min_rounds يجعل التشفيرات الأضعف من السياسة (أو بالخوارزمية الأخرى) تُعاد عند الدخول،
+        بينما تبقى التشفيرات الأقوى كما هي.
+        """
+        schemes = [scheme] + [other for other in SUPPORTED_SCHEMES
+                              if other != scheme and PasswordService._available(other)]
+        settings = {f"{scheme}__default_rounds": rounds, f"{scheme}__min_rounds": rounds}
+        if scheme == "argon2":
+            settings["argon2__memory_cost"] = ARGON2_MEMORY_COST_KIB
+        return CryptContext(schemes=schemes, default=scheme, deprecated="auto", **settings)
+
+    @staticmethod
+    def _available(scheme: str) -> bool:
+        """هل مكتبة الخوارزمية مثبتة (argon2 يتطلب argon2-cffi)"""
+        return argon2.has_backend() if scheme == "argon2" else True
+
+    @staticmethod
+    def _resolve_scheme(scheme: str) -> str:
+        """الخوارزمية من الإعدادات، مع الرجوع إلى bcrypt إذا كانت غير مدعومة أو غير مثبتة"""
+        scheme = (scheme or "bcrypt").lower()
+        if scheme not in SUPPORTED_SCHEMES:
+            print(f"⚠️ خوارزمية تشفير غير مدعومة '{scheme}'، سيُستخدم bcrypt")
+            return "bcrypt"
+        if not PasswordService._available(scheme):
+            print("⚠️ argon2 يتطلب تثبيت argon2-cffi، سيُستخدم bcrypt")
+            return "bcrypt"
+        return scheme
+
+
+# إنشاء نسخة واحدة من خدمة كلمات المرور
+password_service = PasswordService()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="معايرة كلفة تشفير كلمات المرور على هذا الخادم")
+    parser.add_argument("--target-ms", type=float, default=config.PASSWORD_HASH_TARGET_MS,
+                        help="زمن التحقق المستهدف بالملّي ثانية")
+    parser.add_argument("--scheme", choices=SUPPORTED_SCHEMES, default=password_service.scheme)
+    args = parser.parse_args()
+
+    if not PasswordService._available(args.scheme):
+        parser.error("argon2 يتطلب تثبيت argon2-cffi")
+    rounds, verify_ms = PasswordService.choose_rounds(args.scheme, args.target_ms)
+    print(f"{args.scheme}: {rounds} جولة، زمن التحقق المقدّر {verify_ms:.0f} ms (المستهدف {args.target_ms:.0f} ms)")
+    if args.scheme == "bcrypt":
+        print(f"لتثبيت هذه الكلفة بدل المعايرة عند كل تشغيل: BCRYPT_ROUNDS={rounds}")
@@ -1,7 +1,16 @@
+import asyncio
+import math
+import time
+from collections import OrderedDict
+from contextlib import AsyncExitStack, asynccontextmanager
 from datetime import datetime, timedelta
-from typing import List, Optional, Dict, Any
+from itertools import islice
+from typing import AsyncIterator, Iterator, List, Optional, Dict, Any, Tuple
 from bson import ObjectId
 from motor.motor_asyncio import AsyncIOMotorCollection
+from pydantic import ValidationError
+from pymongo import UpdateOne, ReturnDocument
+from pymongo.errors import BulkWriteError
 
 from models.patient import Patient, Payment
 from schemas.patient import (
@@ -9,15 +18,91 @@ from schemas.patient import (
     PatientList, PaymentCreate, OverdueNotification, PaymentUpdate
 )
 from services.database import db_service
+from services.sync_service import sync_service
+from services.statistics_service import statistics_service
+from services.report_service import report_service
+from services.typeahead_service import typeahead_service
+from utils.date_utils import DateUtils
+from utils.pagination_utils import PaginationUtils
+from utils.search_utils import SearchUtils
+
+
+# أقل عدد أيام تأخير لاعتبار المريض متأخراً (يطابق Patient.is_overdue(days_threshold=1))
+OVERDUE_MIN_DAYS = 2
+
+# حقول الترتيب المسموحة للترقيم بالمؤشر (لكل منها فهرس مركب مع _id)
+SORT_FIELDS = ("name", "registration_date", "remaining_amount", "next_due_date")
+
+# حقول المريض التي تدخل في عدّادات الإحصائيات والتقارير الشهرية
+STATS_PROJECTION = {"is_completed": 1, "total_amount": 1, "total_paid": 1, "remaining_amount": 1, "registration_date": 1}
+
+# أقصى عدد مرشحين يُعاد ترتيبهم حسب درجة التطابق في البحث بالاسم
+NAME_SEARCH_CANDIDATES = 200
+
+# ذاكرة المرضى المؤقتة: أقصى عدد مرضى ومدة صلاحية كل مريض (بالثواني)
+PATIENT_CACHE_SIZE = 512
+PATIENT_CACHE_TTL_SECONDS = 60
+
+# تاريخ الاستحقاق التالي محسوباً داخل قاعدة البيانات (يطابق Patient.compute_next_due_date)
+NEXT_DUE_DATE_EXPR = {
+    "$dateAdd": {
+        "startDate": "$registration_date",
+        "unit": "month",
+        "amount": {"$add": ["$payments_count", 1]},
+    }
+}
+
+# أقصى عدد دفعات في طلب إدخال جماعي واحد
+MAX_BULK_PAYMENTS = 1000
+
+# عدد الصفوف في كل دفعة كتابة عند استيراد المرضى من ملف
+IMPORT_CHUNK_SIZE = 1000
+
+# أعمدة ملفات التصدير (عناوين المرضى تطابق أعمدة الاستيراد فيمكن إعادة استيراد الملف)
+PATIENT_EXPORT_HEADERS = (
+    "المعرف", "الاسم", "رقم الهاتف", "المبلغ الكلي", "عدد الأشهر", "تاريخ التسجيل",
+    "المدفوع", "المتبقي", "عدد الدفعات", "تاريخ آخر دفعة", "الاستحقاق التالي", "مكتمل", "ملاحظات",
+)
+PAYMENT_EXPORT_HEADERS = (
+    "المعرف", "معرف المريض", "اسم المريض", "رقم الهاتف", "المبلغ", "تاريخ الدفعة", "ملاحظات",
+)
 
 
 class PatientService:
     """خدمة إدارة المرضى"""
 
+    # استعلامات نموذجية تُستخدم في تقرير الفهارس لمعرفة أي استعلام يلجأ إلى COLLSCAN
+    QUERY_SHAPES: List[Dict[str, Any]] = [
+        {"name": "get_all_patients(completed)", "collection": "patients", "filter": {"is_completed": False}},
+        {"name": "get_all_patients(name)", "collection": "patients",
+         "filter": SearchUtils.name_prefix_query("أحمد")},
+        {"name": "search_patients_page(name)", "collection": "patients",
+         "filter": {"name_trigrams": {"$in": SearchUtils.name_trigrams(["احمد"])}}},
+        {"name": "get_patient_by_name_or_phone(phone)", "collection": "patients",
+         "filter": SearchUtils.phone_prefix_query("0770")},
+        {"name": "get_patients_page(registration_date)", "collection": "patients",
+         "filter": {"is_completed": False}, "sort": [("registration_date", -1), ("_id", -1)]},
+        {"name": "get_overdue_notifications", "collection": "patients",
+         "filter": {"is_completed": False, "next_due_date": {"$lte": datetime(2000, 1, 1)}},
+         "sort": [("next_due_date", 1)]},
+        {"name": "payments_by_patient", "collection": "payments",
+         "filter": {"patient_id": ObjectId()}, "sort": [("payment_date", -1)]},
+    ]
+
     def __init__(self):
         self.patients_collection: AsyncIOMotorCollection = None
         self.payments_collection: AsyncIOMotorCollection = None
 
+        # ذاكرة مؤقتة (LRU مع مدة صلاحية) للمرضى المجمّعين مع مدفوعاتهم: المعرف -> (وقت الانتهاء، المريض)
+        self._patient_cache: "OrderedDict[str, Tuple[float, Patient]]" = OrderedDict()
+        # يزداد مع كل إبطال، حتى لا تُخزّن قراءة بدأت قبل كتابة متزامنة
+        self._cache_generation = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+        # أقفال الكتابة لكل مريض: المعرف -> [القفل، عدد المنتظرين]
+        self._patient_locks: Dict[str, list] = {}
+
     async def initialize_collections(self):
         """تهيئة المجموعات"""
         if self.patients_collection is None:
@@ -25,70 +110,232 @@ class PatientService:
         if self.payments_collection is None:
             self.payments_collection = db_service.get_collection("payments")
 
+    def invalidate_patient(self, patient_id: Any = None):
+        """إبطال مريض من الذاكرة المؤقتة (أو جميع المرضى إذا لم يُحدد المعرف)"""
+        self._cache_generation += 1
+        if patient_id is None:
+            self._patient_cache.clear()
+        else:
+            self._patient_cache.pop(str(patient_id), None)
+
+    @asynccontextmanager
+    async def patient_lock(self, patient_id: Any) -> AsyncIterator[None]:
+        """قفل كتابة خاص بمريض واحد
+
+        الكتابات على نفس المريض (دفعات، تعديل، حذف) تُنفذ بالتتابع، وكتابات المرضى المختلفين
+        تبقى متوازية. يُحذف القفل عند عدم وجود منتظرين حتى لا ينمو القاموس مع عدد المرضى.
+        القفل داخل العملية فقط، ويفترض تشغيل الخادم كعملية واحدة (كما في main.py).
+        """
+        key = str(patient_id)
+        entry = self._patient_locks.get(key)
+        if entry is None:
+            entry = self._patient_locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._patient_locks[key]
+
+    def cache_stats(self) -> Dict[str, Any]:
+        """إحصائيات الذاكرة المؤقتة للمرضى"""
+        lookups = self.cache_hits + self.cache_misses
+        return {
+            "size": len(self._patient_cache),
+            "max_size": PATIENT_CACHE_SIZE,
+            "ttl_seconds": PATIENT_CACHE_TTL_SECONDS,
+            "hits": self.cache_hits,
+            "misses": self.cache_misses,
+            "hit_rate": round(self.cache_hits / lookups, 3) if lookups else 0.0,
+        }
+
     async def create_patient(self, patient_data: PatientCreate) -> Patient:
         """إنشاء مريض جديد"""
         await self.initialize_collections()
 
-        patient = Patient(
+        async with sync_service.stamping() as stamp:
+            patient = self._build_patient(patient_data, stamp)
+
+            # إدراج في قاعدة البيانات (المدفوعات تُخزّن في مجموعتها الخاصة وليس داخل وثيقة المريض)
+            # الوثيقة المُدرجة معروفة مسبقاً فلا حاجة لإعادة قراءتها
+            created_patient = patient.dict(by_alias=True, exclude={"payments"})
+            await self.patients_collection.insert_one(created_patient)
+
+        statistics_service.schedule(statistics_service.apply_patient_change(None, created_patient))
+        typeahead_service.upsert(created_patient)
+        await report_service.invalidate([created_patient["registration_date"]])
+        return patient
+
+    async def import_patients(
+        self,
+        rows: Iterator[Tuple[int, Dict[str, Any]]],
+        chunk_size: int = IMPORT_CHUNK_SIZE
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """استيراد مرضى من صفوف ملف (رقم الصف، الحقول) على دفعات
+
+        كل دفعة من chunk_size صف تُتحقق مقابل PatientCreate ثم تُكتب بـ insert_many غير مرتب،
+        فلا يوقف صف خاطئ بقية الدفعة. يُرجع أحداثاً متتابعة بدل تجميعها في الذاكرة:
+          {"type": "error", "data": {"row": N, "detail": "..."}} لكل صف مرفوض
+          {"type": "progress", "data": {"rows", "inserted", "failed"}} بعد كل دفعة
+          {"type": "end", "data": {"rows", "inserted", "failed", "seconds"}} في النهاية
+        قراءة الصفوف (تحليل CSV/XLSX) تجري في خيط منفصل حتى لا توقف حلقة الأحداث.
+        """
+        await self.initialize_collections()
+
+        started = time.monotonic()
+        counts = {"rows": 0, "inserted": 0, "failed": 0}
+
+        while True:
+            chunk = await asyncio.to_thread(lambda: list(islice(rows, chunk_size)))
+            if not chunk:
+                break
+            counts["rows"] += len(chunk)
+
+            # مرضى الدفعة الواحدة يشتركون في إصدار تغيير واحد؛ الأخطاء تُرسل بعد انتهاء الكتابة
+            # حتى لا يبقى الإصدار محجوزاً بانتظار قارئ البث
+            errors: List[Dict[str, Any]] = []
+            documents: List[Dict[str, Any]] = []
+            row_numbers: List[int] = []
+            failed_indexes = set()
+            async with sync_service.stamping() as stamp:
+                for row_number, row in chunk:
+                    try:
+                        patient = self._build_patient(PatientCreate(**row), stamp)
+                    except (ValidationError, ValueError) as e:
+                        counts["failed"] += 1
+                        errors.append({"row": row_number, "detail": self._validation_message(e)})
+                        continue
+                    documents.append(patient.dict(by_alias=True, exclude={"payments"}))
+                    row_numbers.append(row_number)
+
+                if documents:
+                    try:
+                        await self.patients_collection.insert_many(documents, ordered=False)
+                    except BulkWriteError as e:
+                        for write_error in e.details.get("writeErrors", []):
+                            failed_indexes.add(write_error["index"])
+                            errors.append({
+                                "row": row_numbers[write_error["index"]], "detail": write_error.get("errmsg", "")
+                            })
+
+            for error in errors:
+                yield {"type": "error", "data": error}
+
+            inserted = [doc for index, doc in enumerate(documents) if index not in failed_indexes]
+            counts["inserted"] += len(inserted)
+            counts["failed"] += len(failed_indexes)
+
+            if inserted:
+                for doc in inserted:
+                    typeahead_service.upsert(doc)
+                statistics_service.schedule(statistics_service.apply_delta(
+                    patients=len(inserted),
+                    total_amount=sum(doc["total_amount"] for doc in inserted),
+                    remaining=sum(doc["remaining_amount"] for doc in inserted)
+                ))
+                await report_service.invalidate({doc["registration_date"] for doc in inserted})
+
+            yield {"type": "progress", "data": dict(counts)}
+
+        yield {"type": "end", "data": {**counts, "seconds": round(time.monotonic() - started, 2)}}
+
+    def _build_patient(self, patient_data: PatientCreate, stamp: Dict[str, Any]) -> Patient:
+        """بناء وثيقة مريض جديد مع الحقول المشتقة (البحث، المتبقي، الاستحقاق التالي) وحقول التغيير stamp"""
+        registration_date = patient_data.registration_date or DateUtils.get_utc_now()
+        return Patient(
             name=patient_data.name,
             phone=patient_data.phone,
+            phone_normalized=SearchUtils.normalize_phone(patient_data.phone),
+            **SearchUtils.name_search_fields(patient_data.name),
             total_amount=patient_data.total_amount,
             installments_months=patient_data.installments_months,
             notes=patient_data.notes,
-            registration_date=patient_data.registration_date or datetime.now(),
-            remaining_amount=patient_data.total_amount  # في البداية المبلغ المتبقي = المبلغ الكلي
+            registration_date=registration_date,
+            remaining_amount=patient_data.total_amount,  # في البداية المبلغ المتبقي = المبلغ الكلي
+            next_due_date=Patient.compute_next_due_date(registration_date, 0),
+            **stamp
         )
 
-        # إدراج في قاعدة البيانات
-        result = await self.patients_collection.insert_one(patient.dict(by_alias=True))
-
-        # استرجاع المريض المُدرج
-        created_patient = await self.patients_collection.find_one({"_id": result.inserted_id})
-        return Patient(**created_patient)
+    @staticmethod
+    def _validation_message(error: Exception) -> str:
+        """رسالة مختصرة لخطأ التحقق من صف (الحقل: السبب)"""
+        if isinstance(error, ValidationError):
+            return "; ".join(
+                f"{'.'.join(str(part) for part in item['loc'])}: {item['msg']}" for item in error.errors()
+            )
+        return str(error)
 
     async def get_patient_by_id(self, patient_id: str) -> Optional[Patient]:
-        """الحصول على مريض بالمعرف"""
+        """الحصول على مريض بالمعرف
+
+        النتيجة تُقرأ من الذاكرة المؤقتة إن وُجدت، ولا يجب تعديل الكائن المُرجع.
+        """
         await self.initialize_collections()
 
-        try:
-            patient_data = await self.patients_collection.find_one({"_id": ObjectId(patient_id)})
-            if patient_data:
-                # الحصول على المدفوعات الخاصة بالمريض
-                payments_data = await self.payments_collection.find({"patient_id": ObjectId(patient_id)}).to_list(length=None)
-                patient_data["payments"] = [Payment(**payment) for payment in payments_data]
-
-                patient = Patient(**patient_data)
-                patient.calculate_remaining_amount()
+        key = str(patient_id)
+        cached = self._patient_cache.get(key)
+        if cached is not None:
+            expires_at, patient = cached
+            if expires_at > time.monotonic():
+                self._patient_cache.move_to_end(key)
+                self.cache_hits += 1
                 return patient
+            del self._patient_cache[key]
+        self.cache_misses += 1
+
+        try:
+            # استعلام واحد يجلب المريض مع مدفوعاته
+            generation = self._cache_generation
+            patients = await self._find_patients_with_payments({"_id": ObjectId(patient_id)})
+            if patients:
+                if generation == self._cache_generation:
+                    self._patient_cache[key] = (time.monotonic() + PATIENT_CACHE_TTL_SECONDS, patients[0])
+                    if len(self._patient_cache) > PATIENT_CACHE_SIZE:
+                        self._patient_cache.popitem(last=False)
+                return patients[0]
         except Exception as e:
             print(f"خطأ في الحصول على المريض: {e}")
         return None
 
     async def get_patient_by_name_or_phone(self, search_term: str) -> List[Patient]:
         """البحث عن مريض بالاسم أو رقم الهاتف"""
-        await self.initialize_collections()
+        patients, _ = await self.search_patients_page(search_term)
+        return patients
 
-        # البحث بالاسم أو رقم الهاتف
-        query = {
-            "$or": [
-                {"name": {"$regex": search_term, "$options": "i"}},
-                {"phone": {"$regex": search_term, "$options": "i"}}
-            ]
-        }
+    async def search_patients_page(
+        self,
+        search_term: str,
+        sort: Optional[str] = None,
+        descending: bool = False,
+        limit: Optional[int] = None,
+        cursor: Optional[str] = None
+    ) -> Tuple[List[Patient], Optional[str]]:
+        """البحث عن مريض بالاسم أو رقم الهاتف مع الترقيم بالمؤشر
 
-        patients_data = await self.patients_collection.find(query).to_list(length=None)
-        patients = []
+        بدون sort يُرتب البحث بالاسم حسب درجة التطابق (بدون مؤشر للصفحة التالية).
+        يُرجع (المرضى، مؤشر الصفحة التالية أو None).
+        """
+        await self.initialize_collections()
 
-        for patient_data in patients_data:
-            # الحصول على المدفوعات
-            payments_data = await self.payments_collection.find({"patient_id": patient_data["_id"]}).to_list(length=None)
-            patient_data["payments"] = [Payment(**payment) for payment in payments_data]
+        # الأرقام تُبحث كبادئة مثبّتة على الهاتف الموحّد (مفهرس)
+        if SearchUtils.is_phone_query(search_term):
+            query = SearchUtils.phone_prefix_query(search_term)
+            if not query:
+                return [], None
+            return await self._find_patients_page(query, sort or "name", descending, limit, cursor)
 
-            patient = Patient(**patient_data)
-            patient.calculate_remaining_amount()
-            patients.append(patient)
+        if sort is None:
+            if cursor:
+                raise ValueError("الترقيم بالمؤشر يتطلب تحديد حقل الترتيب")
+            return await self._rank_name_matches(search_term, limit), None
 
-        return patients
+        # الأسماء بعد التوحيد: كل كلمة في البحث بداية لكلمة في الاسم
+        query = SearchUtils.name_prefix_query(search_term)
+        if not query:
+            return [], None
+        return await self._find_patients_page(query, sort, descending, limit, cursor)
 
     async def get_all_patients(
         self,
@@ -97,36 +344,43 @@ class PatientService:
         overdue_only: Optional[bool] = None
     ) -> List[PatientList]:
         """الحصول على جميع المرضى مع فلترة"""
+        patients, _ = await self.get_patients_page(name_filter, completed_filter, overdue_only)
+        return patients
+
+    async def get_patients_page(
+        self,
+        name_filter: Optional[str] = None,
+        completed_filter: Optional[bool] = None,
+        overdue_only: Optional[bool] = None,
+        sort: str = "name",
+        descending: bool = False,
+        limit: Optional[int] = None,
+        cursor: Optional[str] = None
+    ) -> Tuple[List[PatientList], Optional[str]]:
+        """الحصول على المرضى مع فلترة وترقيم بالمؤشر
+
+        يُرجع (صفحة المرضى، مؤشر الصفحة التالية أو None). بدون limit تُرجع كل النتائج.
+        """
         await self.initialize_collections()
 
         query = {}
 
         # فلترة بالاسم
         if name_filter:
-            query["name"] = {"$regex": name_filter, "$options": "i"}
+            query.update(SearchUtils.name_prefix_query(name_filter))
 
         # فلترة بالحالة (مكتمل/غير مكتمل)
         if completed_filter is not None:
             query["is_completed"] = completed_filter
 
-        patients_data = await self.patients_collection.find(query).to_list(length=None)
-        patients = []
+        # فلترة المتأخرات إذا طُلب ذلك (المريض المكتمل لا يكون متأخراً)
+        if overdue_only:
+            if completed_filter:
+                return [], None
+            query.update(self._overdue_query(OVERDUE_MIN_DAYS))
 
-        for patient_data in patients_data:
-            # الحصول على المدفوعات
-            payments_data = await self.payments_collection.find({"patient_id": patient_data["_id"]}).to_list(length=None)
-            patient_data["payments"] = [Payment(**payment) for payment in payments_data]
-
-            patient = Patient(**patient_data)
-            patient.calculate_remaining_amount()
-
-            # فلترة المتأخرات إذا طُلب ذلك
-            if overdue_only and not patient.is_overdue():
-                continue
-
-            patients.append(self._convert_to_patient_list(patient))
-
-        return patients
+        patients, next_cursor = await self._find_patients_page(query, sort, descending, limit, cursor)
+        return [self._convert_to_patient_list(patient) for patient in patients], next_cursor
 
     async def update_patient(self, patient_id: str, update_data: PatientUpdate) -> Optional[Patient]:
         """تحديث بيانات المريض"""
@@ -135,15 +389,46 @@ class PatientService:
         try:
             # تحضير البيانات للتحديث
             update_dict = {k: v for k, v in update_data.dict(exclude_unset=True).items() if v is not None}
+            if "phone" in update_dict:
+                update_dict["phone_normalized"] = SearchUtils.normalize_phone(update_dict["phone"])
+            if "name" in update_dict:
+                update_dict.update(SearchUtils.name_search_fields(update_dict["name"]))
 
             if update_dict:
-                result = await self.patients_collection.update_one(
-                    {"_id": ObjectId(patient_id)},
-                    {"$set": update_dict}
-                )
+                async with self.patient_lock(patient_id), sync_service.stamping() as stamp:
+                    update_dict.update(stamp)
+
+                    # الحقول المشتقة تُحسب في نفس العملية: المتبقي من المبلغ الكلي الجديد ما لم يحدده
+                    # المدير صراحة، والاكتمال من المتبقي ما لم يُحدد صراحة. تُرجع الوثيقة السابقة
+                    # (للعدّادات والتقارير) وتُشتق اللاحقة منها بنفس الحساب، فيكفي طلب واحد
+                    derived = self._derived_update_fields(update_dict)
+                    before = await self.patients_collection.find_one_and_update(
+                        {"_id": ObjectId(patient_id)},
+                        [
+                            {"$set": {k: {"$literal": v} for k, v in update_dict.items()}},
+                            {"$set": {"next_due_date": NEXT_DUE_DATE_EXPR, **derived}},
+                        ],
+                        projection={"payments": 0},
+                        return_document=ReturnDocument.BEFORE
+                    )
 
-                if result.modified_count > 0:
-                    return await self.get_patient_by_id(patient_id)
+                    if before is not None:
+                        after = {**before, **update_dict}
+                        if "remaining_amount" in derived:
+                            after["remaining_amount"] = after.get("total_amount", 0) - after.get("total_paid", 0)
+                        if "is_completed" in derived:
+                            after["is_completed"] = after.get("remaining_amount", 0) <= 0
+                        after["next_due_date"] = Patient.compute_next_due_date(
+                            after["registration_date"], after.get("payments_count", 0)
+                        )
+                        updated_patient = Patient(**after)
+
+                        self.invalidate_patient(patient_id)
+                        statistics_service.schedule(statistics_service.apply_patient_change(before, after))
+                        typeahead_service.upsert(after)
+                        if "registration_date" in update_dict or "total_amount" in update_dict:
+                            await report_service.invalidate([before.get("registration_date"), after["registration_date"]])
+                        return updated_patient
         except Exception as e:
             print(f"خطأ في تحديث المريض: {e}")
         return None
@@ -153,59 +438,208 @@ class PatientService:
         await self.initialize_collections()
 
         try:
-            # حذف المدفوعات أولاً
-            await self.payments_collection.delete_many({"patient_id": ObjectId(patient_id)})
+            async def delete(session):
+                deleted = await self.patients_collection.find_one_and_delete(
+                    {"_id": ObjectId(patient_id)}, projection=STATS_PROJECTION, session=session
+                )
+                if deleted is None:
+                    return None
+
+                # حذف المدفوعات مع المريض، وتسجيل جميع المحذوفات في إدراج واحد
+                payments = await self.payments_collection.find(
+                    {"patient_id": ObjectId(patient_id)}, {"payment_date": 1}, session=session
+                ).to_list(length=None)
+                if payments:
+                    await self.payments_collection.delete_many({"patient_id": ObjectId(patient_id)}, session=session)
+                await sync_service.record_deletions({
+                    "payments": [payment["_id"] for payment in payments],
+                    "patients": [deleted["_id"]],
+                }, stamp, session=session)
+                return deleted, payments
 
-            # حذف المريض
-            result = await self.patients_collection.delete_one({"_id": ObjectId(patient_id)})
-            return result.deleted_count > 0
+            async with self.patient_lock(patient_id):
+                async with sync_service.stamping() as stamp:
+                    result = await db_service.run_in_transaction(delete)
+                self.invalidate_patient(patient_id)
+                typeahead_service.remove(patient_id)
+                if result is None:
+                    return False
+
+                deleted, payments = result
+                statistics_service.schedule(statistics_service.apply_patient_change(deleted, None))
+                await report_service.invalidate(
+                    [deleted.get("registration_date")] + [payment.get("payment_date") for payment in payments]
+                )
+                return True
         except Exception as e:
             print(f"خطأ في حذف المريض: {e}")
         return False
 
     async def create_payment(self, payment_data: PaymentCreate) -> Optional[Payment]:
         """إنشاء دفعة جديدة"""
+        result = await self.record_payment(payment_data)
+        return result[0] if result else None
+
+    async def record_payment(self, payment_data: PaymentCreate) -> Optional[Tuple[Payment, str]]:
+        """إنشاء دفعة جديدة وإرجاعها مع اسم المريض
+
+        عمليتان فقط: إدراج الدفعة، ثم تحديث ملخص المريض (المدفوع، المتبقي، العدد، آخر دفعة،
+        الاستحقاق التالي، الاكتمال) في تحديث pipeline واحد يُرجع الوثيقة السابقة.
+        إذا لم يوجد المريض تُحذف الدفعة. تُنفذ العمليات داخل معاملة عند توفرها وتحت قفل المريض.
+        """
         await self.initialize_collections()
 
         try:
             patient_id = ObjectId(payment_data.patient_id)
 
-            # التحقق من وجود المريض
-            patient = await self.get_patient_by_id(payment_data.patient_id)
-            if not patient:
-                return None
-
             # إنشاء الدفعة
             payment = Payment(
                 patient_id=patient_id,
                 amount=payment_data.amount,
-                payment_date=payment_data.payment_date or datetime.now(),
+                payment_date=payment_data.payment_date or DateUtils.get_utc_now(),
                 notes=payment_data.notes
             )
 
-            # إدراج الدفعة
-            result = await self.payments_collection.insert_one(payment.dict(by_alias=True))
+            async def write(session):
+                payment.version, payment.updated_at = stamp["version"], stamp["updated_at"]
+                await self.payments_collection.insert_one(payment.dict(by_alias=True), session=session)
 
-            # تحديث إجمالي المدفوعات للمريض
-            await self.patients_collection.update_one(
-                {"_id": patient_id},
-                {"$inc": {"total_paid": payment_data.amount}}
-            )
-
-            # التحقق من اكتمال التقسيط
-            updated_patient = await self.get_patient_by_id(payment_data.patient_id)
-            if updated_patient and updated_patient.remaining_amount <= 0:
-                await self.patients_collection.update_one(
+                before = await self.patients_collection.find_one_and_update(
                     {"_id": patient_id},
-                    {"$set": {"is_completed": True}}
+                    self._payments_added_pipeline(payment.amount, 1, payment.payment_date, stamp),
+                    projection={"name": 1, "is_completed": 1, "remaining_amount": 1},
+                    return_document=ReturnDocument.BEFORE,
+                    session=session
                 )
+                if before is None:
+                    # المريض غير موجود
+                    await self.payments_collection.delete_one({"_id": payment.id}, session=session)
+                return before
+
+            async with self.patient_lock(patient_id):
+                # الإصدار يُحجز تحت قفل المريض ويبقى قيد الكتابة حتى تثبيت المعاملة
+                async with sync_service.stamping() as stamp:
+                    before = await db_service.run_in_transaction(write)
+                if before is None:
+                    return None
 
-            return payment
+                self.invalidate_patient(patient_id)
+                typeahead_service.adjust_remaining(patient_id, -payment.amount)
+                newly_completed = not before.get("is_completed") and before.get("remaining_amount", 0) - payment.amount <= 0
+                statistics_service.schedule(statistics_service.apply_delta(
+                    completed=int(newly_completed),
+                    total_paid=payment.amount,
+                    remaining=-payment.amount
+                ))
+                await report_service.invalidate([payment.payment_date])
+
+                return payment, before.get("name")
 
         except Exception as e:
             print(f"خطأ في إنشاء الدفعة: {e}")
         return None
 
+    async def create_payments_bulk(self, payments_data: List[PaymentCreate]) -> List[Dict[str, Any]]:
+        """إدخال مجموعة دفعات دفعة واحدة (تسوية نهاية اليوم)
+
+        قراءة واحدة للمرضى المعنيين، ثم insert_many للدفعات وbulk_write واحد لتحديث ملخص كل
+        مريض (مجموع دفعاته في تحديث pipeline واحد). يُرجع نتيجة لكل عنصر بنفس الترتيب:
+        {index, success, payment_id, patient_name} أو {index, success: False, error}.
+        """
+        await self.initialize_collections()
+
+        if len(payments_data) > MAX_BULK_PAYMENTS:
+            raise ValueError(f"أقصى عدد دفعات في الطلب الواحد {MAX_BULK_PAYMENTS}")
+
+        results: List[Dict[str, Any]] = [{"index": index, "success": False} for index in range(len(payments_data))]
+        patient_ids: Dict[int, ObjectId] = {}
+        for index, payment_data in enumerate(payments_data):
+            if ObjectId.is_valid(payment_data.patient_id):
+                patient_ids[index] = ObjectId(payment_data.patient_id)
+            else:
+                results[index]["error"] = "معرف المريض غير صالح"
+
+        if not patient_ids:
+            return results
+
+        # أقفال المرضى تُؤخذ بترتيب ثابت حتى لا تتعارض طلبات جماعية متزامنة
+        async with AsyncExitStack() as stack:
+            for patient_id in sorted(set(patient_ids.values())):
+                await stack.enter_async_context(self.patient_lock(patient_id))
+
+            patients = {}
+            async for patient_data in self.patients_collection.find(
+                {"_id": {"$in": list(set(patient_ids.values()))}},
+                {"name": 1, "is_completed": 1, "remaining_amount": 1}
+            ):
+                patients[patient_data["_id"]] = patient_data
+
+            payments: List[Tuple[int, Payment]] = []
+            for index, patient_id in patient_ids.items():
+                if patient_id not in patients:
+                    results[index]["error"] = "المريض غير موجود"
+                    continue
+                payment_data = payments_data[index]
+                payments.append((index, Payment(
+                    patient_id=patient_id,
+                    amount=payment_data.amount,
+                    payment_date=payment_data.payment_date or DateUtils.get_utc_now(),
+                    notes=payment_data.notes
+                )))
+
+            if not payments:
+                return results
+
+            # تجميع دفعات كل مريض: المجموع، العدد، أحدث تاريخ
+            totals: Dict[ObjectId, Dict[str, Any]] = {}
+            for _, payment in payments:
+                total = totals.setdefault(payment.patient_id, {"amount": 0.0, "count": 0, "last": payment.payment_date})
+                total["amount"] += payment.amount
+                total["count"] += 1
+                total["last"] = max(total["last"], payment.payment_date)
+
+            async def write(session):
+                for _, payment in payments:
+                    payment.version, payment.updated_at = stamp["version"], stamp["updated_at"]
+                await self.payments_collection.insert_many(
+                    [payment.dict(by_alias=True) for _, payment in payments], ordered=False, session=session
+                )
+                await self.patients_collection.bulk_write([
+                    UpdateOne(
+                        {"_id": patient_id},
+                        self._payments_added_pipeline(total["amount"], total["count"], total["last"], stamp)
+                    )
+                    for patient_id, total in totals.items()
+                ], ordered=False, session=session)
+
+            # جميع دفعات الطلب وملخصات مرضاها تشترك في إصدار واحد
+            async with sync_service.stamping() as stamp:
+                await db_service.run_in_transaction(write)
+
+            newly_completed = 0
+            for patient_id, total in totals.items():
+                before = patients[patient_id]
+                if not before.get("is_completed") and before.get("remaining_amount", 0) - total["amount"] <= 0:
+                    newly_completed += 1
+                self.invalidate_patient(patient_id)
+                typeahead_service.adjust_remaining(patient_id, -total["amount"])
+
+        amount = sum(payment.amount for _, payment in payments)
+        statistics_service.schedule(statistics_service.apply_delta(
+            completed=newly_completed,
+            total_paid=amount,
+            remaining=-amount
+        ))
+        await report_service.invalidate([payment.payment_date for _, payment in payments])
+
+        for index, payment in payments:
+            results[index].update({
+                "success": True,
+                "payment_id": str(payment.id),
+                "patient_name": patients[payment.patient_id].get("name"),
+            })
+        return results
+
     async def update_payment(self, payment_id: str, update_data: PaymentUpdate) -> Optional[Payment]:
         """تحديث دفعة"""
         await self.initialize_collections()
@@ -216,74 +650,512 @@ class PatientService:
                 payment = await self.payments_collection.find_one({"_id": ObjectId(payment_id)})
                 return Payment(**payment) if payment else None
 
-            result = await self.payments_collection.update_one(
-                {"_id": ObjectId(payment_id)},
-                {"$set": update_dict}
-            )
+            async with sync_service.stamping() as stamp:
+                update_dict.update(stamp)
+                before = await self.payments_collection.find_one_and_update(
+                    {"_id": ObjectId(payment_id)},
+                    {"$set": update_dict}
+                )
+
+            if before is not None:
+                # $set بسيط: الوثيقة اللاحقة هي السابقة مع الحقول المحدّثة
+                updated = {**before, **update_dict}
 
-            if result.modified_count > 0:
-                updated = await self.payments_collection.find_one({"_id": ObjectId(payment_id)})
-                return Payment(**updated) if updated else None
+                # تغيير تاريخ الدفعة قد يغيّر تاريخ آخر دفعة للمريض والتقرير الشهري للشهرين
+                if "payment_date" in update_dict:
+                    async with self.patient_lock(updated["patient_id"]), sync_service.stamping() as refresh_stamp:
+                        await self._refresh_last_payment_date(updated["patient_id"], refresh_stamp)
+                    await report_service.invalidate([before.get("payment_date"), updated["payment_date"]])
+                self.invalidate_patient(updated["patient_id"])
+                return Payment(**updated)
         except Exception as e:
             print(f"خطأ في تحديث الدفعة: {e}")
         return None
 
     async def delete_payment(self, payment_id: str) -> bool:
-        """حذف دفعة"""
+        """حذف دفعة
+
+        القفل يُؤخذ قبل المعاملة كما في record_payment، لأن تاريخ آخر دفعة قراءة ثم كتابة.
+        """
         await self.initialize_collections()
         try:
-            # عند حذف الدفعة، يُفضّل خصمها من total_paid للمريض المرتبط
-            payment_doc = await self.payments_collection.find_one({"_id": ObjectId(payment_id)})
-            if not payment_doc:
+            existing = await self.payments_collection.find_one({"_id": ObjectId(payment_id)}, {"patient_id": 1})
+            if not existing:
                 return False
+            patient_id = existing["patient_id"]
 
-            result = await self.payments_collection.delete_one({"_id": ObjectId(payment_id)})
-            if result.deleted_count > 0:
-                # خصم المبلغ من إجمالي المدفوعات
-                await self.patients_collection.update_one(
+            async def delete(session):
+                payment_doc = await self.payments_collection.find_one_and_delete(
+                    {"_id": ObjectId(payment_id), "patient_id": patient_id}, session=session
+                )
+                if not payment_doc:
+                    return None
+
+                # خصم المبلغ من إجمالي المدفوعات وتحديث ملخص الدفعات، وإلغاء الاكتمال إذا عاد
+                # للمريض مبلغ متبقٍ
+                amount = float(payment_doc.get("amount", 0))
+                before = await self.patients_collection.find_one_and_update(
                     {"_id": payment_doc["patient_id"]},
-                    {"$inc": {"total_paid": -float(payment_doc.get("amount", 0))}}
+                    [
+                        {"$set": {
+                            "total_paid": {"$subtract": ["$total_paid", amount]},
+                            "remaining_amount": {"$add": ["$remaining_amount", amount]},
+                            "payments_count": {"$max": [{"$subtract": ["$payments_count", 1]}, 0]},
+                            **{k: {"$literal": v} for k, v in stamp.items()},
+                        }},
+                        {"$set": {
+                            "next_due_date": NEXT_DUE_DATE_EXPR,
+                            "is_completed": {"$and": [
+                                {"$eq": ["$is_completed", True]},
+                                {"$lte": ["$remaining_amount", 0]},
+                            ]},
+                        }},
+                    ],
+                    projection={"last_payment_date": 1, "is_completed": 1, "remaining_amount": 1},
+                    return_document=ReturnDocument.BEFORE,
+                    session=session
                 )
-                return True
+
+                # تاريخ آخر دفعة يُعاد حسابه فقط إذا كانت المحذوفة هي الأحدث
+                if before and before.get("last_payment_date") == payment_doc.get("payment_date"):
+                    await self._refresh_last_payment_date(payment_doc["patient_id"], stamp, session=session)
+                await sync_service.record_tombstones("payments", [payment_doc["_id"]], stamp, session=session)
+                return payment_doc, before
+
+            async with self.patient_lock(patient_id):
+                async with sync_service.stamping() as stamp:
+                    result = await db_service.run_in_transaction(delete)
+            if result is None:
+                return False
+
+            payment_doc, before = result
+            amount = float(payment_doc.get("amount", 0))
+            no_longer_completed = bool(before and before.get("is_completed")) and before.get("remaining_amount", 0) + amount > 0
+
+            self.invalidate_patient(payment_doc["patient_id"])
+            typeahead_service.adjust_remaining(payment_doc["patient_id"], amount)
+            statistics_service.schedule(statistics_service.apply_delta(
+                completed=-int(no_longer_completed),
+                total_paid=-amount,
+                remaining=amount
+            ))
+            await report_service.invalidate([payment_doc.get("payment_date")])
+            return True
         except Exception as e:
             print(f"خطأ في حذف الدفعة: {e}")
         return False
 
-    async def get_overdue_notifications(self) -> List[OverdueNotification]:
-        """الحصول على إشعارات المتأخرات"""
+    async def get_overdue_notifications(
+        self,
+        min_days: int = OVERDUE_MIN_DAYS,
+        skip: int = 0,
+        limit: Optional[int] = None
+    ) -> List[OverdueNotification]:
+        """الحصول على إشعارات المتأخرات
+
+        استعلام نطاق على next_due_date المفهرس، مرتب من الأكثر تأخراً إلى الأقل.
+        """
         await self.initialize_collections()
 
-        # الحصول على جميع المرضى غير المكتملين
-        patients_data = await self.patients_collection.find({"is_completed": False}).to_list(length=None)
-        notifications = []
+        now = DateUtils.get_utc_now()
+        cursor = self.patients_collection.find(
+            self._overdue_query(min_days, now), {"payments": 0}
+        ).sort("next_due_date", 1).skip(skip)
+        if limit:
+            cursor = cursor.limit(limit)
 
-        for patient_data in patients_data:
-            # الحصول على المدفوعات
-            payments_data = await self.payments_collection.find({"patient_id": patient_data["_id"]}).to_list(length=None)
-            patient_data["payments"] = [Payment(**payment) for payment in payments_data]
+        notifications = []
 
+        async for patient_data in cursor:
             patient = Patient(**patient_data)
-            patient.calculate_remaining_amount()
-
-            if patient.is_overdue():
-                next_payment_date = patient.get_next_payment_date()
-                days_overdue = (datetime.now() - next_payment_date).days
-
-                notification = OverdueNotification(
-                    patient_id=patient.id,
-                    patient_name=patient.name,
-                    phone=patient.phone,
-                    registration_date=patient.registration_date,
-                    days_overdue=days_overdue,
-                    total_amount=patient.total_amount,
-                    remaining_amount=patient.remaining_amount,
-                    monthly_installment=patient.calculate_monthly_installment(),
-                    next_payment_date=next_payment_date
-                )
-                notifications.append(notification)
+            notification = OverdueNotification(
+                patient_id=patient.id,
+                patient_name=patient.name,
+                phone=patient.phone,
+                registration_date=patient.registration_date,
+                days_overdue=(now - patient.next_due_date).days,
+                total_amount=patient.total_amount,
+                remaining_amount=patient.remaining_amount,
+                monthly_installment=patient.calculate_monthly_installment(),
+                next_payment_date=patient.next_due_date
+            )
+            notifications.append(notification)
 
         return notifications
 
+    async def get_overdue_summary(self, min_days: int = OVERDUE_MIN_DAYS) -> Dict[str, Any]:
+        """ملخص المتأخرات بتجميع واحد على فهرس next_due_date (يطابق NotificationUtils.get_overdue_summary)"""
+        await self.initialize_collections()
+
+        now = DateUtils.get_utc_now()
+        days_overdue = {"$floor": {"$divide": [{"$subtract": [now, "$next_due_date"]}, 24 * 60 * 60 * 1000]}}
+        pipeline = [
+            {"$match": self._overdue_query(min_days, now)},
+            {"$group": {
+                "_id": None,
+                "total_overdue_patients": {"$sum": 1},
+                "total_overdue_amount": {"$sum": "$remaining_amount"},
+                "total_days": {"$sum": days_overdue},
+                "critical_cases": {"$sum": {"$cond": [{"$gt": [days_overdue, 30]}, 1, 0]}},
+            }},
+        ]
+
+        summary = {
+            "total_overdue_patients": 0,
+            "total_overdue_amount": 0.0,
+            "average_days_overdue": 0,
+            "critical_cases": 0  # متأخرات أكثر من 30 يوم
+        }
+        async for row in self.patients_collection.aggregate(pipeline):
+            summary.update({
+                "total_overdue_patients": row["total_overdue_patients"],
+                "total_overdue_amount": round(row["total_overdue_amount"], 2),
+                "average_days_overdue": round(row["total_days"] / row["total_overdue_patients"], 1),
+                "critical_cases": row["critical_cases"],
+            })
+        return summary
+
+    async def backfill_payment_summaries(self, only_missing: bool = True) -> int:
+        """حساب ملخص المدفوعات المخزّن (العدد، آخر تاريخ، المدفوع، المتبقي، الاستحقاق التالي) من مجموعة الدفعات.
+
+        يُستدعى عند بدء التشغيل لترحيل الوثائق القديمة التي لا تحتوي على هذه الحقول،
+        ويمكن استدعاؤه مع only_missing=False لإعادة حساب جميع المرضى.
+        """
+        await self.initialize_collections()
+
+        query = {
+            "$or": [
+                {"payments_count": {"$exists": False}},
+                {"next_due_date": {"$exists": False}},
+            ]
+        } if only_missing else {}
+        patients_data = await self.patients_collection.find(
+            query, {"_id": 1, "total_amount": 1, "registration_date": 1}
+        ).to_list(length=None)
+        if not patients_data:
+            return 0
+
+        # تجميع الدفعات لكل مريض باستعلام واحد
+        summaries = {}
+        pipeline = [
+            {"$match": {"patient_id": {"$in": [p["_id"] for p in patients_data]}}},
+            {"$group": {
+                "_id": "$patient_id",
+                "payments_count": {"$sum": 1},
+                "total_paid": {"$sum": "$amount"},
+                "last_payment_date": {"$max": "$payment_date"},
+            }},
+        ]
+        async for summary in self.payments_collection.aggregate(pipeline):
+            summaries[summary["_id"]] = summary
+
+        async with sync_service.stamping() as stamp:
+            operations = []
+            for patient_data in patients_data:
+                summary = summaries.get(patient_data["_id"], {})
+                total_paid = float(summary.get("total_paid", 0.0))
+                payments_count = summary.get("payments_count", 0)
+                operations.append(UpdateOne(
+                    {"_id": patient_data["_id"]},
+                    {"$set": {
+                        "payments_count": payments_count,
+                        "last_payment_date": summary.get("last_payment_date"),
+                        "total_paid": total_paid,
+                        "remaining_amount": float(patient_data.get("total_amount", 0)) - total_paid,
+                        "next_due_date": Patient.compute_next_due_date(patient_data["registration_date"], payments_count),
+                        **stamp,
+                    }}
+                ))
+
+            await self.patients_collection.bulk_write(operations, ordered=False)
+        self.invalidate_patient()
+        return len(operations)
+
+    async def backfill_search_fields(self) -> int:
+        """حساب حقول البحث (الهاتف الموحّد، مفاتيح الاسم) للمرضى القدامى الذين لا يحتوون عليها"""
+        await self.initialize_collections()
+
+        query = {
+            "$or": [
+                {"phone_normalized": {"$exists": False}},
+                {"name_trigrams": {"$exists": False}},
+            ]
+        }
+        patients_data = await self.patients_collection.find(query, {"phone": 1, "name": 1}).to_list(length=None)
+        if not patients_data:
+            return 0
+
+        async with sync_service.stamping() as stamp:
+            operations = [
+                UpdateOne(
+                    {"_id": patient_data["_id"]},
+                    {"$set": {
+                        "phone_normalized": SearchUtils.normalize_phone(patient_data.get("phone")),
+                        **SearchUtils.name_search_fields(patient_data.get("name", "")),
+                        **stamp,
+                    }}
+                )
+                for patient_data in patients_data
+            ]
+
+            await self.patients_collection.bulk_write(operations, ordered=False)
+        self.invalidate_patient()
+        return len(operations)
+
+    @staticmethod
+    def _overdue_query(min_days: int, now: Optional[datetime] = None) -> Dict[str, Any]:
+        """شرط المتأخرات: غير مكتمل وتاريخ استحقاقه قبل (الآن - min_days يوم)"""
+        cutoff = (now or DateUtils.get_utc_now()) - timedelta(days=min_days)
+        return {"is_completed": False, "next_due_date": {"$lte": cutoff}}
+
+    @staticmethod
+    def _derived_update_fields(update_dict: Dict[str, Any]) -> Dict[str, Any]:
+        """تعابير المتبقي والاكتمال لتحديث المريض (للمرحلة الثانية من pipeline التحديث)
+
+        المتبقي يُعاد حسابه عند تغيير المبلغ الكلي إلا إذا حدده المدير صراحة، والاكتمال
+        يُشتق من المتبقي الجديد عند تغيّره إلا إذا حُدد صراحة.
+        """
+        derived: Dict[str, Any] = {}
+        remaining: Any = "$remaining_amount"
+        if "total_amount" in update_dict and "remaining_amount" not in update_dict:
+            remaining = derived["remaining_amount"] = {"$subtract": ["$total_amount", "$total_paid"]}
+        remaining_changed = "remaining_amount" in derived or "remaining_amount" in update_dict
+        if remaining_changed and "is_completed" not in update_dict:
+            derived["is_completed"] = {"$lte": [remaining, 0]}
+        return derived
+
+    @staticmethod
+    def _payments_added_pipeline(
+        amount: float, count: int, last_payment_date: datetime, stamp: Dict[str, Any]
+    ) -> List[Dict[str, Any]]:
+        """تحديث pipeline لملخص المريض بعد إضافة دفعات (المجموع، العدد، أحدث تاريخ) مع حقول التغيير stamp
+
+        المتبقي والاستحقاق التالي والاكتمال تُحسب في نفس العملية من القيم الجديدة.
+        """
+        return [
+            {"$set": {
+                "total_paid": {"$add": ["$total_paid", amount]},
+                "remaining_amount": {"$subtract": ["$remaining_amount", amount]},
+                "payments_count": {"$add": ["$payments_count", count]},
+                "last_payment_date": {"$max": ["$last_payment_date", {"$literal": last_payment_date}]},
+                **{k: {"$literal": v} for k, v in stamp.items()},
+            }},
+            {"$set": {
+                "next_due_date": NEXT_DUE_DATE_EXPR,
+                "is_completed": {"$or": [
+                    {"$eq": ["$is_completed", True]},
+                    {"$lte": ["$remaining_amount", 0]},
+                ]},
+            }},
+        ]
+
+    async def _refresh_last_payment_date(self, patient_id: ObjectId, stamp: Dict[str, Any], session=None):
+        """إعادة حساب تاريخ آخر دفعة للمريض من مجموعة الدفعات مع حقول التغيير stamp"""
+        latest = await self.payments_collection.find_one(
+            {"patient_id": patient_id},
+            {"payment_date": 1},
+            sort=[("payment_date", -1)],
+            session=session
+        )
+        await self.patients_collection.update_one(
+            {"_id": patient_id},
+            {"$set": {"last_payment_date": latest["payment_date"] if latest else None, **stamp}},
+            session=session
+        )
+
+    async def _rank_name_matches(self, search_term: str, limit: Optional[int] = None) -> List[Patient]:
+        """بحث تقريبي بالاسم مرتب حسب درجة التطابق
+
+        المرشحون يُجلبون عبر الفهارس (مقطع ثلاثي مشترك أو بداية كلمة)، ويُستبعد من يشترك
+        في أقل من نصف مقاطع البحث، ثم يُعاد ترتيب أفضلهم حسب SearchUtils.rank_name_match.
+        """
+        grams = SearchUtils.name_trigrams(SearchUtils.name_tokens(search_term))
+        prefix_query = SearchUtils.name_prefix_query(search_term)
+        if not grams or not prefix_query:
+            return []
+
+        pipeline = [
+            {"$match": {"$or": [{"name_trigrams": {"$in": grams}}, prefix_query]}},
+            {"$project": {"payments": 0}},
+            {"$addFields": {"_overlap": {"$size": {"$setIntersection": [{"$ifNull": ["$name_trigrams", []]}, grams]}}}},
+            {"$match": {"$or": [{"_overlap": {"$gte": math.ceil(len(grams) / 2)}}, prefix_query]}},
+            {"$sort": {"_overlap": -1, "name": 1}},
+            {"$limit": max(NAME_SEARCH_CANDIDATES, limit or 0)},
+        ]
+        candidates = [
+            Patient(**patient_data)
+            async for patient_data in self.patients_collection.aggregate(pipeline)
+        ]
+
+        candidates.sort(key=lambda patient: (
+            -SearchUtils.rank_name_match(search_term, patient.name_search or "", patient.name_trigrams),
+            patient.name
+        ))
+        return candidates[:limit] if limit else candidates
+
+    async def _find_patients_page(
+        self,
+        query: Dict[str, Any],
+        sort: str,
+        descending: bool,
+        limit: Optional[int],
+        cursor: Optional[str]
+    ) -> Tuple[List[Patient], Optional[str]]:
+        """صفحة من المرضى مرتبة حسب (sort، _id) تبدأ بعد المؤشر، دون skip
+
+        تُقرأ مجموعة المرضى وحدها بالاعتماد على ملخص المدفوعات المخزّن.
+        """
+        if sort not in SORT_FIELDS:
+            raise ValueError(f"حقل الترتيب غير مدعوم: {sort}")
+
+        keyset = PaginationUtils.keyset_query(sort, descending, cursor)
+        if keyset:
+            query = {"$and": [query, keyset]} if query else keyset
+
+        direction = -1 if descending else 1
+        find_cursor = self.patients_collection.find(query, {"payments": 0}).sort(
+            [(sort, direction), ("_id", direction)]
+        )
+        if limit:
+            # عنصر إضافي لمعرفة وجود صفحة تالية دون استعلام عدّ
+            find_cursor = find_cursor.limit(limit + 1)
+
+        patients = [Patient(**patient_data) async for patient_data in find_cursor]
+
+        next_cursor = None
+        if limit and len(patients) > limit:
+            patients = patients[:limit]
+            last = patients[-1]
+            next_cursor = PaginationUtils.encode_cursor(sort, getattr(last, sort), last.id)
+
+        return patients, next_cursor
+
+    async def iter_patients_with_payments(
+        self,
+        query: Optional[Dict[str, Any]] = None,
+        batch_size: int = 200
+    ) -> AsyncIterator[Patient]:
+        """المرور على المرضى مع مدفوعاتهم عبر مؤشر aggregation واحد ($match ثم $lookup).
+
+        يُرجع كل مريض فور وصوله من قاعدة البيانات دون تحميل النتائج كاملة في الذاكرة،
+        وعدد الاستعلامات ثابت مهما كان عدد المرضى بدلاً من استعلام لكل مريض.
+        """
+        await self.initialize_collections()
+
+        pipeline = [
+            {"$match": query or {}},
+            {"$lookup": {
+                "from": self.payments_collection.name,
+                "localField": "_id",
+                "foreignField": "patient_id",
+                "as": "payments",
+            }},
+        ]
+
+        async for patient_data in self.patients_collection.aggregate(pipeline, batchSize=batch_size):
+            patient_data["payments"] = [Payment(**payment) for payment in patient_data.get("payments", [])]
+
+            # المتبقي المخزّن هو المرجع (قد يحدده المدير صراحة)، فلا يُعاد حسابه هنا
+            yield Patient(**patient_data)
+
+    async def iter_patients_export(
+        self,
+        from_date: Optional[datetime] = None,
+        to_date: Optional[datetime] = None,
+        completed: Optional[bool] = None,
+        batch_size: int = 1000
+    ) -> AsyncIterator[Tuple[Any, ...]]:
+        """صفوف تصدير المرضى (بترتيب PATIENT_EXPORT_HEADERS) من مؤشر واحد بحجم دفعة batch_size
+
+        from_date/to_date حدود registration_date بتوقيت UTC (from شاملاً و to غير شامل).
+        التواريخ تُصدَّر كتاريخ فقط بتوقيت بغداد.
+        """
+        await self.initialize_collections()
+
+        query: Dict[str, Any] = self._date_range_query("registration_date", from_date, to_date)
+        if completed is not None:
+            query["is_completed"] = completed
+
+        projection = {"payments": 0, "name_search": 0, "name_tokens": 0, "name_trigrams": 0}
+        cursor = self.patients_collection.find(query, projection, batch_size=batch_size).sort(
+            [("registration_date", 1), ("_id", 1)]
+        )
+        async for patient in cursor:
+            yield (
+                str(patient["_id"]),
+                patient.get("name"),
+                patient.get("phone"),
+                patient.get("total_amount"),
+                patient.get("installments_months"),
+                DateUtils.get_baghdad_date(patient.get("registration_date")),
+                patient.get("total_paid", 0),
+                patient.get("remaining_amount"),
+                patient.get("payments_count", 0),
+                DateUtils.get_baghdad_date(patient.get("last_payment_date")),
+                DateUtils.get_baghdad_date(patient.get("next_due_date")),
+                bool(patient.get("is_completed")),
+                patient.get("notes"),
+            )
+
+    async def iter_payments_export(
+        self,
+        from_date: Optional[datetime] = None,
+        to_date: Optional[datetime] = None,
+        completed: Optional[bool] = None,
+        batch_size: int = 1000
+    ) -> AsyncIterator[Tuple[Any, ...]]:
+        """صفوف تصدير الدفعات (بترتيب PAYMENT_EXPORT_HEADERS) مع اسم المريض وهاتفه
+
+        from_date/to_date حدود payment_date بتوقيت UTC، وcompleted يفلتر حسب حالة المريض.
+        مؤشر aggregation واحد: الدفعات بترتيب التاريخ ثم $lookup للمريض بالمعرف.
+        """
+        await self.initialize_collections()
+
+        pipeline: List[Dict[str, Any]] = [
+            {"$match": self._date_range_query("payment_date", from_date, to_date)},
+            {"$sort": {"payment_date": 1, "_id": 1}},
+            {"$lookup": {
+                "from": self.patients_collection.name,
+                "localField": "patient_id",
+                "foreignField": "_id",
+                "as": "patient",
+            }},
+            {"$unwind": {"path": "$patient", "preserveNullAndEmptyArrays": True}},
+            # إرسال حقول التصدير فقط بدل وثيقة المريض كاملة
+            {"$project": {
+                "patient_id": 1, "amount": 1, "payment_date": 1, "notes": 1,
+                "patient.name": 1, "patient.phone": 1, "patient.is_completed": 1,
+            }},
+        ]
+        if completed is not None:
+            pipeline.append({"$match": {"patient.is_completed": completed}})
+
+        async for payment in self.payments_collection.aggregate(pipeline, batchSize=batch_size):
+            patient = payment.get("patient") or {}
+            yield (
+                str(payment["_id"]),
+                str(payment.get("patient_id")),
+                patient.get("name"),
+                patient.get("phone"),
+                payment.get("amount"),
+                DateUtils.get_baghdad_date(payment.get("payment_date")),
+                payment.get("notes"),
+            )
+
+    @staticmethod
+    def _date_range_query(field: str, from_date: Optional[datetime], to_date: Optional[datetime]) -> Dict[str, Any]:
+        """شرط نطاق تاريخ (from شاملاً و to غير شامل)، أو شرط فارغ بدون حدود"""
+        date_range = {}
+        if from_date is not None:
+            date_range["$gte"] = from_date
+        if to_date is not None:
+            date_range["$lt"] = to_date
+        return {field: date_range} if date_range else {}
+
+    async def _find_patients_with_payments(self, query: Dict[str, Any]) -> List[Patient]:
+        """جلب المرضى المطابقين مع مدفوعاتهم كقائمة"""
+        return [patient async for patient in self.iter_patients_with_payments(query)]
+
     def _convert_to_patient_list(self, patient: Patient) -> PatientList:
         """تحويل مريض إلى تنسيق القائمة"""
         return PatientList(
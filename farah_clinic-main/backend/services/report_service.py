@@ -0,0 +1,158 @@
+from datetime import datetime
+from typing import List, Dict, Any, Iterable, Optional
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from services.database import db_service
+from utils.date_utils import DateUtils
+
+
+# أقصى عدد أشهر في تقرير واحد
+MAX_REPORT_MONTHS = 120
+
+# حقول التقرير الشهري
+MONTHLY_FIELDS = ("amount_collected", "payments_count", "new_patients", "new_contracted_amount")
+
+# رمز خطأ تكرار المفتاح في MongoDB
+DUPLICATE_KEY_ERROR = 11000
+
+
+class ReportService:
+    """خدمة التقارير الشهرية (الإيرادات والتحصيل) مع تخزين دائم للأشهر المغلقة"""
+
+    def __init__(self):
+        self.patients_collection: AsyncIOMotorCollection = None
+        self.payments_collection: AsyncIOMotorCollection = None
+        self.reports_collection: AsyncIOMotorCollection = None
+
+    async def initialize_collections(self):
+        """تهيئة المجموعات"""
+        if self.patients_collection is None:
+            self.patients_collection = db_service.get_collection("patients")
+        if self.payments_collection is None:
+            self.payments_collection = db_service.get_collection("payments")
+        if self.reports_collection is None:
+            self.reports_collection = db_service.get_collection("monthly_reports")
+
+    async def get_monthly_report(self, from_month: str, to_month: str) -> List[Dict[str, Any]]:
+        """التقرير الشهري من from_month إلى to_month (شاملاً، بصيغة YYYY-MM وبتوقيت بغداد)
+
+        الأشهر المغلقة تُقرأ من التخزين الدائم، ولا يُحسب إلا الأشهر غير المخزّنة والشهر الحالي.
+        """
+        await self.initialize_collections()
+
+        months = self._month_range(from_month, to_month)
+        current_month = DateUtils.get_month_key(DateUtils.get_baghdad_now())
+
+        # الوثيقة بلا computed_at علامة إبطال؛ generation يُقرأ قبل الحساب ليُكتب التقرير بشرطه
+        cached = {}
+        generations = {}
+        async for doc in self.reports_collection.find({"_id": {"$in": months}}):
+            generations[doc["_id"]] = doc.get("generation", 0)
+            if "computed_at" in doc:
+                cached[doc["_id"]] = doc
+
+        missing = [month for month in months if month not in cached or month >= current_month]
+        if missing:
+            computed = await self._compute_months(missing[0], missing[-1])
+
+            # تخزين الأشهر المغلقة فقط، فالشهر الحالي وما بعده قد يتغير
+            closed = [month for month in missing if month < current_month]
+            if closed:
+                await self._store_months(closed, computed, generations)
+            for month in missing:
+                cached[month] = computed.get(month, {})
+
+        return [
+            {"month": month, **{field: cached[month].get(field, 0) for field in MONTHLY_FIELDS}}
+            for month in months
+        ]
+
+    async def invalidate(self, dates: Iterable[Optional[datetime]]):
+        """إبطال التقارير المخزّنة للأشهر التي تقع فيها هذه التواريخ (دفعة أو تسجيل بتاريخ سابق)"""
+        # الشهر الحالي لا يُخزّن أصلاً، فالكتابات العادية (بتاريخ اليوم) لا تكلف أي عملية إضافية
+        current_month = DateUtils.get_month_key(DateUtils.get_baghdad_now())
+        month_keys = list({DateUtils.get_month_key(d) for d in dates if d is not None and
+                           DateUtils.get_month_key(d) < current_month})
+        if month_keys:
+            await self.initialize_collections()
+            # زيادة generation بدل الحذف، فلا يكتب حساب متزامن بدأ قبل الإبطال نتيجته القديمة
+            await self.reports_collection.bulk_write([
+                UpdateOne({"_id": month},
+                          {"$inc": {"generation": 1}, "$unset": {field: "" for field in (*MONTHLY_FIELDS, "computed_at")}},
+                          upsert=True)
+                for month in month_keys
+            ], ordered=False)
+
+    async def _store_months(self, months: List[str], computed: Dict[str, Dict[str, Any]], generations: Dict[str, int]):
+        """تخزين الأشهر المغلقة بشرط ألا يتغير generation منذ قراءته (لم يُبطَل الشهر أثناء الحساب)"""
+        try:
+            await self.reports_collection.bulk_write([
+                UpdateOne({"_id": month, "generation": generations.get(month, 0)},
+                          {"$set": {**computed.get(month, {}), "computed_at": datetime.utcnow()}},
+                          upsert=True)
+                for month in months
+            ], ordered=False)
+        except BulkWriteError as e:
+            # تعارض المفتاح يعني أن الشهر أُبطل بعد القراءة، فيُترك للطلب التالي
+            if any(error.get("code") != DUPLICATE_KEY_ERROR for error in e.details.get("writeErrors", [])):
+                raise
+
+    async def _compute_months(self, from_month: str, to_month: str) -> Dict[str, Dict[str, Any]]:
+        """حساب أشهر متتالية بتجميعين: الدفعات حسب payment_date والمرضى الجدد حسب registration_date"""
+        date_range = {
+            "$gte": DateUtils.get_month_start_utc(from_month),
+            "$lt": DateUtils.get_month_start_utc(DateUtils.shift_month_key(to_month, 1)),
+        }
+
+        def month_of(field: str) -> Dict[str, Any]:
+            return {"$dateToString": {"format": "%Y-%m", "date": field, "timezone": DateUtils.BAGHDAD_TZ.zone}}
+
+        computed: Dict[str, Dict[str, Any]] = {}
+
+        payments_pipeline = [
+            {"$match": {"payment_date": date_range}},
+            {"$group": {
+                "_id": month_of("$payment_date"),
+                "amount_collected": {"$sum": "$amount"},
+                "payments_count": {"$sum": 1},
+            }},
+        ]
+        async for row in self.payments_collection.aggregate(payments_pipeline):
+            computed.setdefault(row["_id"], {}).update({
+                "amount_collected": round(row["amount_collected"], 2),
+                "payments_count": row["payments_count"],
+            })
+
+        patients_pipeline = [
+            {"$match": {"registration_date": date_range}},
+            {"$group": {
+                "_id": month_of("$registration_date"),
+                "new_patients": {"$sum": 1},
+                "new_contracted_amount": {"$sum": "$total_amount"},
+            }},
+        ]
+        async for row in self.patients_collection.aggregate(patients_pipeline):
+            computed.setdefault(row["_id"], {}).update({
+                "new_patients": row["new_patients"],
+                "new_contracted_amount": round(row["new_contracted_amount"], 2),
+            })
+
+        return computed
+
+    @staticmethod
+    def _month_range(from_month: str, to_month: str) -> List[str]:
+        """قائمة مفاتيح الأشهر من from_month إلى to_month شاملاً"""
+        from_year, from_num = DateUtils.parse_month_key(from_month)
+        to_year, to_num = DateUtils.parse_month_key(to_month)
+        count = (to_year - from_year) * 12 + (to_num - from_num) + 1
+        if count <= 0:
+            raise ValueError("يجب أن يكون شهر البداية قبل شهر النهاية")
+        if count > MAX_REPORT_MONTHS:
+            raise ValueError(f"أقصى مدة للتقرير {MAX_REPORT_MONTHS} شهراً")
+        return [DateUtils.shift_month_key(from_month, i) for i in range(count)]
+
+
+# إنشاء نسخة واحدة من خدمة التقارير
+report_service = ReportService()
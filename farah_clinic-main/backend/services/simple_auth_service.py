@@ -1,16 +1,19 @@
 """
 خدمة مصادقة مبسطة للتطوير
-تعمل بدون قاعدة بيانات مؤقتاً لحل مشكلة MongoDB
+الرموز (الوصول وrefresh) في الذاكرة، والمستخدمون في MongoDB عبر auth_service مع ذاكرة مؤقتة
 """
 
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from typing import Optional, Tuple, Dict, Any
 import uuid
 from jose import JWTError, jwt
-from passlib.context import CryptContext
 from config import config
 
 from models.user import User, UserCreate, UserLogin, Token, TokenData
+from services.auth_service import auth_service
+from services.password_service import password_service
 
 # إعدادات JWT من متغيرات البيئة
 SECRET_KEY = config.JWT_SECRET_KEY
@@ -18,50 +21,23 @@ ALGORITHM = config.JWT_ALGORITHM
 ACCESS_TOKEN_EXPIRE_MINUTES = config.JWT_ACCESS_TOKEN_EXPIRE_MINUTES
 REFRESH_TOKEN_EXPIRE_MINUTES = config.JWT_REFRESH_TOKEN_EXPIRE_MINUTES
 
-# إعداد تشفير كلمات المرور
-pwd_context = CryptContext(
-    schemes=["bcrypt"],
-    deprecated="auto",
-    bcrypt__rounds=config.BCRYPT_ROUNDS,
-)
-
-# مستخدم افتراضي في الذاكرة (للتطوير فقط)
-DEFAULT_ADMIN = {
-    "id": "admin_id_123",
-    "username": "admin",
-    "email": "admin@farahdental.com",
-    "full_name": "مدير النظام",
-    "hashed_password": pwd_context.hash("admin123"),
-    "is_active": True,
-    "is_admin": True,
-    "created_at": datetime.now(),
-    "last_login": None
-}
-
-# مستخدم عادي افتراضي (للتطوير فقط)
-DEFAULT_USER = {
-    "id": "user_id_123",
-    "username": "user",
-    "email": "user@farahdental.com",
-    "full_name": "مستخدم عادي",
-    "hashed_password": pwd_context.hash("user123"),
-    "is_active": True,
-    "is_admin": False,
-    "created_at": datetime.now(),
-    "last_login": None
-}
-
-# قائمة المستخدمين في الذاكرة (للتطوير فقط)
-MEMORY_USERS = [DEFAULT_ADMIN, DEFAULT_USER]
-
 # تخزين refresh tokens في الذاكرة (للتطوير فقط)
 # المفتاح هو jti والقيمة تحتوي على بيانات المالك وحالة الإبطال
 REFRESH_TOKENS: Dict[str, Dict[str, Any]] = {}
 
+# أقصى عدد رموز وصول محقق منها محفوظة في الذاكرة
+TOKEN_CACHE_SIZE = 1024
 
 class SimpleAuthService:
     """خدمة مصادقة مبسطة للتطوير"""
 
+    def __init__(self):
+        # رموز الوصول المحقق منها (LRU): الرمز كاملاً -> (وقت انتهائه exp، بياناته)
+        # المفتاح هو الرمز كاملاً وليس التوقيع وحده، حتى لا يُقبل رمز عُدّلت بياناته مع إبقاء توقيع صحيح
+        self._token_cache: "OrderedDict[str, Tuple[float, TokenData]]" = OrderedDict()
+        self.token_cache_hits = 0
+        self.token_cache_misses = 0
+
     def create_access_token(self, data: dict, expires_delta: Optional[timedelta] = None):
         """إنشاء رمز مميز للوصول"""
         to_encode = data.copy()
@@ -141,7 +117,21 @@ class SimpleAuthService:
             return False
 
     def verify_token(self, token: str) -> Optional[TokenData]:
-        """التحقق من صحة الرمز المميز"""
+        """التحقق من صحة الرمز المميز
+
+        الرموز الصحيحة تُحفظ حتى وقت انتهائها (exp)، فالعميل الذي يكرر نفس الرمز لا يدفع كلفة
+        التحقق من التوقيع وفك JSON إلا مرة واحدة.
+        """
+        cached = self._token_cache.get(token)
+        if cached is not None:
+            expires_at, token_data = cached
+            if expires_at > time.time():
+                self._token_cache.move_to_end(token)
+                self.token_cache_hits += 1
+                return token_data
+            del self._token_cache[token]
+        self.token_cache_misses += 1
+
         try:
             payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
             username: str = payload.get("sub")
@@ -149,81 +139,62 @@ class SimpleAuthService:
             
             if username is None or user_id is None:
                 return None
-                
-            return TokenData(username=username, user_id=user_id)
+
+            token_data = TokenData(username=username, user_id=user_id)
+            if payload.get("exp") is not None:
+                self._token_cache[token] = (float(payload["exp"]), token_data)
+                if len(self._token_cache) > TOKEN_CACHE_SIZE:
+                    self._token_cache.popitem(last=False)
+            return token_data
         except JWTError:
             return None
 
-    async def create_user(self, user_data: UserCreate) -> User:
-        """إنشاء مستخدم جديد"""
-        # التحقق من عدم وجود اسم مستخدم مكرر
-        for existing_user in MEMORY_USERS:
-            if existing_user["username"] == user_data.username:
-                raise ValueError("اسم المستخدم موجود بالفعل")
-
-        # إنشاء المستخدم
-        new_user = {
-            "id": f"user_{len(MEMORY_USERS) + 1}",
-            "username": user_data.username,
-            "email": user_data.email,
-            "full_name": user_data.full_name,
-            "hashed_password": pwd_context.hash(user_data.password),
-            "is_active": True,
-            "is_admin": user_data.is_admin,
-            "created_at": datetime.now(),
-            "last_login": None
+    def token_cache_stats(self) -> Dict[str, Any]:
+        """إحصائيات ذاكرة الرموز المحقق منها"""
+        lookups = self.token_cache_hits + self.token_cache_misses
+        return {
+            "size": len(self._token_cache),
+            "max_size": TOKEN_CACHE_SIZE,
+            "hits": self.token_cache_hits,
+            "misses": self.token_cache_misses,
+            "hit_rate": round(self.token_cache_hits / lookups, 3) if lookups else 0.0,
         }
 
-        MEMORY_USERS.append(new_user)
-        return User(**new_user)
+    async def create_user(self, user_data: UserCreate) -> User:
+        """إنشاء مستخدم جديد"""
+        return await auth_service.create_user(user_data)
 
     async def authenticate_user(self, username: str, password: str) -> Optional[User]:
         """مصادقة المستخدم"""
-        for user_data in MEMORY_USERS:
-            if user_data["username"] == username:
-                if pwd_context.verify(password, user_data["hashed_password"]):
-                    if user_data["is_active"]:
-                        return User(**user_data)
-        return None
+        return await auth_service.authenticate_user(username, password)
 
     async def get_user_by_username(self, username: str) -> Optional[User]:
-        """الحصول على مستخدم بالاسم"""
-        for user_data in MEMORY_USERS:
-            if user_data["username"] == username:
-                return User(**user_data)
-        return None
+        """الحصول على مستخدم بالاسم (من الذاكرة المؤقتة إن وُجد)"""
+        return await auth_service.get_user_by_username(username)
 
     async def get_user_by_id(self, user_id: str) -> Optional[User]:
-        """الحصول على مستخدم بالمعرف"""
-        for user_data in MEMORY_USERS:
-            if user_data["id"] == user_id:
-                return User(**user_data)
-        return None
+        """الحصول على مستخدم بالمعرف (من الذاكرة المؤقتة إن وُجد)"""
+        return await auth_service.get_user_by_id(user_id)
 
     async def update_last_login(self, username: str):
         """تحديث آخر تسجيل دخول"""
-        for user_data in MEMORY_USERS:
-            if user_data["username"] == username:
-                user_data["last_login"] = datetime.now()
-                break
+        await auth_service.update_last_login(username)
 
     async def create_default_admin(self):
         """إنشاء مدير افتراضي إذا لم يكن موجوداً"""
-        # المدير الافتراضي موجود بالفعل في MEMORY_USERS
-        print("✅ المدير الافتراضي جاهز: admin / admin123")
+        await auth_service.create_default_admin()
 
     async def create_default_user(self):
         """إنشاء مستخدم افتراضي عادي إذا لم يكن موجوداً"""
-        # المستخدم الافتراضي موجود بالفعل في MEMORY_USERS
-        print("✅ المستخدم العادي جاهز: user / user123")
+        await auth_service.create_default_user()
 
     def get_password_hash(self, password: str) -> str:
         """تشفير كلمة المرور"""
-        return pwd_context.hash(password)
+        return password_service.hash_sync(password)
 
     def verify_password(self, plain_password: str, hashed_password: str) -> bool:
         """التحقق من كلمة المرور"""
-        return pwd_context.verify(plain_password, hashed_password)
+        return password_service.verify_sync(plain_password, hashed_password)
 
 
 # إنشاء نسخة واحدة من خدمة المصادقة المبسطة
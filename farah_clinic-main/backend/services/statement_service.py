@@ -0,0 +1,353 @@
+import asyncio
+import multiprocessing
+import os
+import re
+import tempfile
+import time
+import uuid
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Set, Tuple
+from motor.motor_asyncio import AsyncIOMotorCollection
+
+from config import config
+from models.patient import Patient
+from services.database import db_service
+from services.patient_service import patient_service
+from utils.date_utils import DateUtils
+from utils.pdf_utils import PdfUtils
+
+
+# أقصى عدد كشوفات PDF محفوظة في الذاكرة المؤقتة
+STATEMENT_CACHE_SIZE = 128
+
+# اسم العيادة في رأس الكشف
+CLINIC_NAME = "عيادة فرح لطب الأسنان"
+
+# عدد الكشوفات في كل مهمة تُرسل إلى عملية رسم أثناء الدفعة الشهرية
+BATCH_RENDER_CHUNK = 20
+
+# عدد مهام الدفعة الشهرية المحفوظة (مع ملفاتها) قبل حذف الأقدم
+BATCH_JOBS_KEPT = 3
+
+
+class StatementService:
+    """خدمة كشوفات الحساب PDF
+
+    الرسم يجري في مجمع عمليات (ProcessPoolExecutor) فلا يتوقف الخادم أثناءه، والنتيجة تُحفظ
+    مفتاحها إصدار المريض (أحدث إصدار للمريض أو دفعاته) مع تاريخ اليوم، فتكرار التحميل لا يكلف شيئاً
+    حتى يتغير المريض أو يمر يوم (حالة الأقساط المتأخرة تعتمد على التاريخ).
+    """
+
+    def __init__(self):
+        self._executor: Optional[ProcessPoolExecutor] = None
+        # المعرف -> (مفتاح الإصدار، PDF)
+        self._cache: "OrderedDict[str, Tuple[str, bytes]]" = OrderedDict()
+        # الكشوفات قيد الرسم، حتى لا يُرسم نفس الكشف مرتين لطلبات متزامنة
+        self._pending: Dict[Tuple[str, str], asyncio.Future] = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.patients_collection: AsyncIOMotorCollection = None
+        # مهام الدفعة الشهرية: المعرف -> الحالة (الأقدم أولاً)
+        self._jobs: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+
+    async def initialize_collections(self):
+        """تهيئة المجموعات"""
+        if self.patients_collection is None:
+            self.patients_collection = db_service.get_collection("patients")
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        """مجمع العمليات (يُنشأ عند أول استخدام بعدد أنوية المعالج أو STATEMENT_WORKERS)"""
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.worker_count(),
+                # spawn بدل fork: العمليات لا ترث حلقة الأحداث واتصالات قاعدة البيانات
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._executor
+
+    @staticmethod
+    def worker_count() -> int:
+        """عدد عمليات الرسم"""
+        return config.STATEMENT_WORKERS or os.cpu_count() or 1
+
+    def shutdown(self):
+        """إيقاف مجمع العمليات ومهام الدفعة الشهرية وحذف ملفاتها عند إيقاف التطبيق"""
+        for job in self._jobs.values():
+            self._discard_job(job)
+        self._jobs.clear()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def get_statement(self, patient_id: str) -> Optional[Tuple[bytes, str]]:
+        """كشف حساب المريض (PDF، مفتاح الإصدار للاستخدام كـ ETag) أو None إذا لم يوجد المريض"""
+        patient = await patient_service.get_patient_by_id(patient_id)
+        if patient is None:
+            return None
+
+        key = self.version_key(patient)
+        cached = self._cache.get(str(patient.id))
+        if cached is not None and cached[0] == key:
+            self._cache.move_to_end(str(patient.id))
+            self.cache_hits += 1
+            return cached[1], key
+        self.cache_misses += 1
+
+        pending_key = (str(patient.id), key)
+        future = self._pending.get(pending_key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(
+                self.executor, PdfUtils.render_statement, self.statement_data(patient), config.STATEMENT_FONT_PATH
+            )
+            self._pending[pending_key] = future
+            future.add_done_callback(lambda _: self._pending.pop(pending_key, None))
+
+        pdf = await future
+        self._cache[str(patient.id)] = (key, pdf)
+        self._cache.move_to_end(str(patient.id))
+        if len(self._cache) > STATEMENT_CACHE_SIZE:
+            self._cache.popitem(last=False)
+        return pdf, key
+
+    def start_batch(self) -> Dict[str, Any]:
+        """بدء دفعة كشوفات نهاية الشهر لجميع المرضى غير المكتملين في الخلفية
+
+        إذا كانت هناك دفعة قيد التنفيذ تُرجع حالتها بدل بدء دفعة ثانية.
+        """
+        for job in self._jobs.values():
+            if job["status"] == "running":
+                return self.job_status(job["id"])
+
+        job_id = uuid.uuid4().hex
+        now = datetime.now()
+        job = {
+            "id": job_id,
+            "status": "running",
+            "total": None,
+            "rendered": 0,
+            "failed": 0,
+            "errors": [],
+            "size": 0,
+            "started_at": now,
+            "finished_at": None,
+            "elapsed_seconds": None,
+            "filename": f"statements-{DateUtils.get_baghdad_now():%Y-%m}.zip",
+            "path": None,
+            "task": None,
+        }
+        self._jobs[job_id] = job
+        job["task"] = asyncio.ensure_future(self._run_batch(job, now))
+
+        while len(self._jobs) > BATCH_JOBS_KEPT:
+            oldest = next(iter(self._jobs.values()))
+            if oldest["status"] == "running":
+                break
+            self._discard_job(self._jobs.pop(oldest["id"]))
+        return self.job_status(job_id)
+
+    def job_status(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """حالة مهمة الدفعة (دون المسار الداخلي للملف) أو None إذا لم توجد"""
+        job = self._jobs.get(job_id)
+        if job is None:
+            return None
+        return {key: value for key, value in job.items() if key not in ("path", "task")}
+
+    def job_file(self, job_id: str) -> Optional[Tuple[str, str]]:
+        """(مسار ملف ZIP، اسم التحميل) لمهمة مكتملة، أو None إذا لم تكتمل"""
+        job = self._jobs.get(job_id)
+        if job is None or job["status"] != "completed":
+            return None
+        return job["path"], job["filename"]
+
+    async def _run_batch(self, job: Dict[str, Any], now: datetime):
+        """تنفيذ الدفعة: المرضى مع مدفوعاتهم من مؤشر aggregation واحد، والرسم موزع على
+        مجمع العمليات، وكل كشف يُكتب إلى ملف ZIP على القرص فور انتهائه
+
+        عدد المهام المرسلة في نفس الوقت محدود بضعف عدد العمليات، فلا تُحمّل بيانات جميع المرضى
+        ولا جميع الكشوفات في الذاكرة.
+        """
+        started = time.perf_counter()
+        query = {"is_completed": False}
+        loop = asyncio.get_running_loop()
+        max_in_flight = 2 * self.worker_count()
+        in_flight: Set[asyncio.Future] = set()
+
+        handle, job["path"] = tempfile.mkstemp(prefix="statements-", suffix=".zip")
+        os.close(handle)
+        try:
+            await self.initialize_collections()
+            job["total"] = await self.patients_collection.count_documents(query)
+
+            with zipfile.ZipFile(job["path"], "w", compression=zipfile.ZIP_DEFLATED) as archive:
+                async def drain(return_when: str):
+                    nonlocal in_flight
+                    done, in_flight = await asyncio.wait(in_flight, return_when=return_when)
+                    for future in done:
+                        await asyncio.to_thread(self._write_entries, archive, future.result(), job)
+
+                chunk: List[Tuple[str, Dict[str, Any]]] = []
+                async for patient in patient_service.iter_patients_with_payments(query):
+                    chunk.append((self._archive_name(patient), self.statement_data(patient, now)))
+                    if len(chunk) < BATCH_RENDER_CHUNK:
+                        continue
+                    in_flight.add(loop.run_in_executor(
+                        self.executor, PdfUtils.render_statements, chunk, config.STATEMENT_FONT_PATH
+                    ))
+                    chunk = []
+                    if len(in_flight) >= max_in_flight:
+                        await drain(asyncio.FIRST_COMPLETED)
+
+                if chunk:
+                    in_flight.add(loop.run_in_executor(
+                        self.executor, PdfUtils.render_statements, chunk, config.STATEMENT_FONT_PATH
+                    ))
+                if in_flight:
+                    await drain(asyncio.ALL_COMPLETED)
+
+            job["size"] = os.path.getsize(job["path"])
+            job["status"] = "completed"
+        except asyncio.CancelledError:
+            job["status"] = "cancelled"
+            raise
+        except Exception as e:
+            print(f"خطأ في دفعة كشوفات نهاية الشهر: {e}")
+            job["status"] = "failed"
+            job["errors"].append(str(e))
+        finally:
+            for future in in_flight:
+                future.cancel()
+            if job["status"] != "completed":
+                self._remove_file(job)
+            job["finished_at"] = datetime.now()
+            job["elapsed_seconds"] = round(time.perf_counter() - started, 2)
+
+    @staticmethod
+    def _write_entries(
+        archive: zipfile.ZipFile,
+        results: List[Tuple[str, Optional[bytes], Optional[str]]],
+        job: Dict[str, Any]
+    ):
+        """كتابة الكشوفات المرسومة إلى ملف ZIP وتحديث عدّادات المهمة"""
+        for name, pdf, error in results:
+            if pdf is None:
+                job["failed"] += 1
+                # أول الأخطاء تكفي للتشخيص دون تضخيم الحالة
+                if len(job["errors"]) < 20:
+                    job["errors"].append(f"{name}: {error}")
+                continue
+            archive.writestr(name, pdf)
+            job["rendered"] += 1
+
+    @staticmethod
+    def _archive_name(patient: Patient) -> str:
+        """اسم ملف الكشف داخل ZIP: الاسم (دون رموز غير صالحة في أسماء الملفات) ثم المعرف"""
+        name = re.sub(r'[\\/:*?"<>|\s]+', "_", patient.name).strip("_")
+        return f"{name}_{patient.id}.pdf"
+
+    def _discard_job(self, job: Dict[str, Any]):
+        """إلغاء مهمة (إن كانت تعمل) وحذف ملفها"""
+        if job["task"] is not None and not job["task"].done():
+            job["task"].cancel()
+        self._remove_file(job)
+
+    @staticmethod
+    def _remove_file(job: Dict[str, Any]):
+        """حذف ملف ZIP الخاص بالمهمة إن وُجد"""
+        if job["path"] and os.path.exists(job["path"]):
+            try:
+                os.remove(job["path"])
+            except OSError as e:
+                print(f"تعذر حذف ملف الكشوفات {job['path']}: {e}")
+        job["path"] = None
+
+    def cache_stats(self) -> Dict[str, Any]:
+        """إحصائيات ذاكرة الكشوفات المؤقتة"""
+        lookups = self.cache_hits + self.cache_misses
+        return {
+            "size": len(self._cache),
+            "max_size": STATEMENT_CACHE_SIZE,
+            "bytes": sum(len(pdf) for _, pdf in self._cache.values()),
+            "hits": self.cache_hits,
+            "misses": self.cache_misses,
+            "hit_rate": round(self.cache_hits / lookups, 3) if lookups else 0.0,
+        }
+
+    @staticmethod
+    def version_key(patient: Patient) -> str:
+        """مفتاح الكشف: أحدث إصدار للمريض أو لأي من دفعاته، مع تاريخ اليوم بتوقيت بغداد"""
+        version = max([patient.version] + [payment.version for payment in patient.payments])
+        return f"{patient.id}-{version}-{DateUtils.get_baghdad_now():%Y%m%d}"
+
+    @staticmethod
+    def statement_data(patient: Patient, now: Optional[datetime] = None) -> Dict[str, Any]:
+        """بيانات الكشف كقيم بسيطة (نصوص وأرقام) لتُنقل إلى عملية الرسم"""
+        now = now or DateUtils.get_utc_now()
+        monthly_installment = patient.calculate_monthly_installment()
+        payments = sorted(patient.payments, key=lambda payment: payment.payment_date)
+        paid_installments = patient.installments_months if patient.is_completed else len(payments)
+
+        schedule = []
+        for number in range(1, patient.installments_months + 1):
+            due_date = Patient.add_months(patient.registration_date, number)
+            if number <= paid_installments:
+                status = "مدفوع"
+            elif due_date < now:
+                status = "متأخر"
+            else:
+                status = "مستحق"
+            schedule.append({
+                "number": number,
+                "date": StatementService._format_date(due_date),
+                "amount": StatementService._format_amount(monthly_installment),
+                "status": status,
+            })
+
+        return {
+            "clinic": CLINIC_NAME,
+            "generated_at": StatementService._format_date(now),
+            "patient": {
+                "id": str(patient.id),
+                "name": patient.name,
+                "phone": patient.phone,
+                "registration_date": StatementService._format_date(patient.registration_date),
+                "total_amount": StatementService._format_amount(patient.total_amount),
+                "installments_months": patient.installments_months,
+                "monthly_installment": StatementService._format_amount(monthly_installment),
+                "total_paid": StatementService._format_amount(patient.total_paid),
+                "remaining_amount": StatementService._format_amount(patient.remaining_amount),
+                "next_payment_date": "-" if patient.is_completed
+                else StatementService._format_date(patient.get_next_payment_date()),
+                "status": "مكتمل" if patient.is_completed else "قيد التقسيط",
+                "notes": patient.notes,
+            },
+            "payments": [
+                {
+                    "number": number,
+                    "date": StatementService._format_date(payment.payment_date),
+                    "amount": StatementService._format_amount(payment.amount),
+                    "notes": payment.notes or "",
+                }
+                for number, payment in enumerate(payments, start=1)
+            ],
+            "schedule": schedule,
+        }
+
+    @staticmethod
+    def _format_date(dt: datetime) -> str:
+        """التاريخ بتوقيت بغداد بصيغة الاستمارة (yyyy/MM/dd)"""
+        return DateUtils.convert_to_baghdad_time(dt).strftime("%Y/%m/%d")
+
+    @staticmethod
+    def _format_amount(amount: float) -> str:
+        """المبلغ بفواصل الآلاف بالدينار العراقي"""
+        amount = round(amount or 0, 2)
+        return f"{amount:,.0f} دينار" if float(amount).is_integer() else f"{amount:,.2f} دينار"
+
+
+# إنشاء نسخة واحدة من خدمة الكشوفات
+statement_service = StatementService()
@@ -0,0 +1,189 @@
+import asyncio
+from datetime import datetime
+from typing import Awaitable, Dict, Any, Optional, Set
+from motor.motor_asyncio import AsyncIOMotorCollection
+
+from services.database import db_service
+
+
+# معرف وثيقة العدّادات العامة للعيادة
+CLINIC_STATS_ID = "clinic"
+
+# الفاصل بين عمليات المطابقة الدورية (بالثواني)
+STATS_RECONCILE_INTERVAL_SECONDS = 6 * 60 * 60
+
+# عدد محاولات المطابقة قبل تأجيلها إذا استمرت الكتابات أثناء الحساب
+RECONCILE_ATTEMPTS = 3
+
+# الحقول المخزّنة في وثيقة العدّادات
+STATS_FIELDS = ("total_patients", "completed_patients", "total_amount", "total_paid", "total_remaining")
+
+
+class StatisticsService:
+    """خدمة عدّادات الإحصائيات العامة (تُحدَّث تدريجياً بـ $inc مع كل كتابة)"""
+
+    def __init__(self):
+        self.statistics_collection: AsyncIOMotorCollection = None
+        self.patients_collection: AsyncIOMotorCollection = None
+        # تحديثات العدّادات الجارية في الخلفية (مراجع تمنع جمعها قبل انتهائها وتسمح بتسجيل أخطائها)
+        self._pending: Set[asyncio.Future] = set()
+        # عدد التحديثات المجدولة منذ البدء (لمعرفة هل حدثت كتابة أثناء المطابقة)
+        self._scheduled = 0
+        self._reconcile_lock = asyncio.Lock()
+
+    async def initialize_collections(self):
+        """تهيئة المجموعات"""
+        if self.statistics_collection is None:
+            self.statistics_collection = db_service.get_collection("statistics")
+        if self.patients_collection is None:
+            self.patients_collection = db_service.get_collection("patients")
+
+    async def apply_delta(
+        self,
+        patients: int = 0,
+        completed: int = 0,
+        total_amount: float = 0.0,
+        total_paid: float = 0.0,
+        remaining: float = 0.0
+    ):
+        """تطبيق فرق على العدّادات في عملية ذرية واحدة"""
+        await self.initialize_collections()
+
+        increments = {
+            "total_patients": patients,
+            "completed_patients": completed,
+            "total_amount": float(total_amount),
+            "total_paid": float(total_paid),
+            "total_remaining": float(remaining),
+        }
+        increments = {k: v for k, v in increments.items() if v}
+        if not increments:
+            return
+
+        try:
+            await self.statistics_collection.update_one(
+                {"_id": CLINIC_STATS_ID},
+                {"$inc": increments, "$set": {"updated_at": datetime.now()}},
+                upsert=True
+            )
+        except Exception as e:
+            # الانحراف الناتج يُصلَح في المطابقة الدورية التالية
+            print(f"خطأ في تحديث عدّادات الإحصائيات: {e}")
+
+    def schedule(self, update: Awaitable):
+        """تنفيذ تحديث للعدّادات في الخلفية حتى لا يضيف عملية إلى زمن الطلب
+
+        الأخطاء تُسجَّل عند انتهاء المهمة، وأي انحراف يُصلَح في المطابقة الدورية.
+        """
+        self._scheduled += 1
+        task = asyncio.ensure_future(update)
+        self._pending.add(task)
+        task.add_done_callback(self._finished)
+
+    def _finished(self, task: asyncio.Future):
+        """إزالة تحديث منتهٍ من قائمة الجارية وتسجيل فشله إن فشل"""
+        self._pending.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            print(f"خطأ في تحديث عدّادات الإحصائيات: {task.exception()}")
+
+    async def flush(self):
+        """انتظار انتهاء تحديثات العدّادات الجارية (عند الإيقاف وفي الاختبارات)"""
+        if self._pending:
+            await asyncio.gather(*self._pending, return_exceptions=True)
+
+    async def apply_patient_change(self, before: Optional[Dict[str, Any]], after: Optional[Dict[str, Any]]):
+        """تطبيق الفرق بين حالتي مريض (None تعني غير موجود: إنشاء أو حذف)"""
+        before = before or {}
+        after = after or {}
+
+        def value(doc: Dict[str, Any], key: str) -> float:
+            return float(doc.get(key) or 0)
+
+        await self.apply_delta(
+            patients=int(bool(after)) - int(bool(before)),
+            completed=int(bool(after.get("is_completed"))) - int(bool(before.get("is_completed"))),
+            total_amount=value(after, "total_amount") - value(before, "total_amount"),
+            total_paid=value(after, "total_paid") - value(before, "total_paid"),
+            remaining=value(after, "remaining_amount") - value(before, "remaining_amount"),
+        )
+
+    async def get_counters(self) -> Dict[str, Any]:
+        """قراءة العدّادات (قراءة وثيقة واحدة)، مع حسابها أول مرة إذا لم تكن موجودة"""
+        await self.initialize_collections()
+
+        counters = await self.statistics_collection.find_one({"_id": CLINIC_STATS_ID})
+        if counters is None:
+            counters = await self.reconcile()
+        return {field: counters.get(field, 0) for field in STATS_FIELDS}
+
+    async def compute_counters(self) -> Dict[str, Any]:
+        """حساب العدّادات من مجموعة المرضى مباشرة بتجميع واحد"""
+        await self.initialize_collections()
+
+        pipeline = [
+            {"$group": {
+                "_id": None,
+                "total_patients": {"$sum": 1},
+                "completed_patients": {"$sum": {"$cond": [{"$eq": ["$is_completed", True]}, 1, 0]}},
+                "total_amount": {"$sum": "$total_amount"},
+                "total_paid": {"$sum": "$total_paid"},
+                "total_remaining": {"$sum": "$remaining_amount"},
+            }},
+        ]
+        computed = {field: 0 for field in STATS_FIELDS}
+        async for row in self.patients_collection.aggregate(pipeline):
+            computed.update({field: row.get(field, 0) for field in STATS_FIELDS})
+        return computed
+
+    async def reconcile(self) -> Dict[str, Any]:
+        """مطابقة العدّادات مع البيانات الفعلية وإصلاح أي انحراف
+
+        تُنتظر التحديثات الجارية أولاً، ثم يُقارن المخزّن بالمحسوب ويُطبق الفرق بـ $inc واحد
+        (لا استبدال)، فلا يضيع تحديث يصل بعد القراءة. إذا جُدول تحديث في هذه العملية أو تغيّرت
+        الوثيقة المخزّنة أثناء الحساب فالنتيجة غير مؤكدة، فتُعاد المحاولة ثم تُؤجَّل للمطابقة التالية.
+        يُرجع العدّادات المحسوبة مع مقدار الانحراف الذي تم إصلاحه (drift).
+        """
+        await self.initialize_collections()
+
+        async with self._reconcile_lock:
+            for _ in range(RECONCILE_ATTEMPTS):
+                await self.flush()
+                scheduled = self._scheduled
+                stored = await self._stored_counters()
+                computed = await self.compute_counters()
+                if self._scheduled != scheduled or await self._stored_counters() != stored:
+                    continue
+
+                drift = {field: round(computed[field] - stored[field], 2) for field in STATS_FIELDS}
+                drift = {field: diff for field, diff in drift.items() if diff}
+                increments = {field: computed[field] - stored[field] for field in drift}
+
+                now = datetime.now()
+                update: Dict[str, Any] = {"$set": {"updated_at": now, "reconciled_at": now}}
+                if increments:
+                    update["$inc"] = increments
+                await self.statistics_collection.update_one({"_id": CLINIC_STATS_ID}, update, upsert=True)
+                return {**computed, "drift": drift}
+
+        print("ℹ️ تأجيل مطابقة الإحصائيات: كتابات مستمرة أثناء الحساب")
+        return {**computed, "drift": {}}
+
+    async def _stored_counters(self) -> Dict[str, Any]:
+        """قيم العدّادات المخزّنة (0 للحقول غير الموجودة)"""
+        stored = await self.statistics_collection.find_one({"_id": CLINIC_STATS_ID}) or {}
+        return {field: stored.get(field, 0) for field in STATS_FIELDS}
+
+    async def run_periodic_reconciliation(self, interval_seconds: int = STATS_RECONCILE_INTERVAL_SECONDS):
+        """مهمة خلفية تطابق العدّادات كل interval_seconds"""
+        while True:
+            await asyncio.sleep(interval_seconds)
+            try:
+                result = await self.reconcile()
+                if result["drift"]:
+                    print(f"⚠️ تم إصلاح انحراف في الإحصائيات: {result['drift']}")
+            except Exception as e:
+                print(f"خطأ في مطابقة الإحصائيات: {e}")
+
+
+# إنشاء نسخة واحدة من خدمة الإحصائيات
+statistics_service = StatisticsService()
@@ -0,0 +1,224 @@
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import timedelta
+from typing import AsyncIterator, List, Optional, Dict, Any, Set, Tuple
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo import ReturnDocument
+
+from models.patient import Patient, Payment
+from services.database import db_service
+from utils.date_utils import DateUtils
+
+
+# معرف وثيقة عدّاد الإصدارات في مجموعة counters
+VERSION_COUNTER_ID = "sync_version"
+
+# مدة الاحتفاظ بسجلات الحذف (بالأيام)؛ العميل الذي لم يزامن منذ أقدم منها يحصل على مزامنة كاملة
+TOMBSTONE_RETENTION_DAYS = 90
+
+# الفاصل بين عمليات تنظيف سجلات الحذف الدورية (بالثواني)
+TOMBSTONE_PRUNE_INTERVAL_SECONDS = 24 * 60 * 60
+
+
+class SyncService:
+    """خدمة المزامنة التفاضلية (إصدارات التغيير وسجلات الحذف)"""
+
+    def __init__(self):
+        self.patients_collection: AsyncIOMotorCollection = None
+        self.payments_collection: AsyncIOMotorCollection = None
+        self.tombstones_collection: AsyncIOMotorCollection = None
+        self.counters_collection: AsyncIOMotorCollection = None
+
+        # عدّاد الإصدارات في الذاكرة (عملية خادم واحدة، كأقفال المرضى وفهرس الاقتراحات)
+        # والإصدارات المحجوزة التي لم تنتهِ كتابتها بعد
+        self._version: Optional[int] = None
+        self._in_flight: Set[int] = set()
+
+    async def initialize_collections(self):
+        """تهيئة المجموعات"""
+        if self.patients_collection is None:
+            self.patients_collection = db_service.get_collection("patients")
+        if self.payments_collection is None:
+            self.payments_collection = db_service.get_collection("payments")
+        if self.tombstones_collection is None:
+            self.tombstones_collection = db_service.get_collection("tombstones")
+        if self.counters_collection is None:
+            self.counters_collection = db_service.get_collection("counters")
+
+    @asynccontextmanager
+    async def stamping(self) -> AsyncIterator[Dict[str, Any]]:
+        """حجز حقول التغيير (إصدار تصاعدي ووقت التعديل) للكتابة التي تجري داخل الكتلة
+
+        الإصدار يبقى قيد الكتابة حتى تنتهي الكتلة (بما فيها تثبيت المعاملة)، ولا يتجاوزه
+        مؤشر المزامنة قبل ذلك. الحجز من الذاكرة فلا يكلف أي عملية على قاعدة البيانات.
+        """
+        if self._version is None:
+            await self.initialize_counter()
+
+        self._version += 1
+        version = self._version
+        self._in_flight.add(version)
+        try:
+            yield {"version": version, "updated_at": DateUtils.get_utc_now()}
+        finally:
+            self._in_flight.discard(version)
+
+    async def current_version(self) -> int:
+        """مؤشر المزامنة: أعلى إصدار انتهت كل الكتابات حتى رقمه"""
+        cursor, _ = await self._publish_cursor()
+        return cursor
+
+    async def _publish_cursor(self) -> Tuple[int, Dict[str, Any]]:
+        """تثبيت المؤشر الحالي في counters قبل إرجاعه للعميل، وإرجاعه مع وثيقة العدّاد
+
+        بعد إعادة التشغيل يبدأ العدّاد من أعلى قيمة مثبتة، فلا تقل الإصدارات الجديدة عن أي مؤشر
+        لدى العملاء حتى لو لم تُكتب آخر الإصدارات المحجوزة.
+        """
+        if self._version is None:
+            await self.initialize_counter()
+
+        cursor = min(self._in_flight) - 1 if self._in_flight else self._version
+        counter = await self.counters_collection.find_one_and_update(
+            {"_id": VERSION_COUNTER_ID},
+            {"$max": {"value": cursor}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        return cursor, counter
+
+    async def record_tombstones(self, collection_name: str, doc_ids: List[ObjectId], stamp: Dict[str, Any],
+                                session=None):
+        """تسجيل عمليات الحذف ليعرفها العملاء عند المزامنة"""
+        await self.record_deletions({collection_name: doc_ids}, stamp, session=session)
+
+    async def record_deletions(self, deleted: Dict[str, List[ObjectId]], stamp: Dict[str, Any], session=None):
+        """تسجيل حذف وثائق من عدة مجموعات في عملية إدراج واحدة بحقول تغيير الكتابة stamp"""
+        await self.initialize_collections()
+
+        if not any(deleted.values()):
+            return
+
+        tombstones = [
+            {
+                "collection": collection_name,
+                "doc_id": doc_id,
+                "version": stamp["version"],
+                "deleted_at": stamp["updated_at"],
+            }
+            for collection_name, doc_ids in deleted.items()
+            for doc_id in doc_ids
+        ]
+        await self.tombstones_collection.insert_many(tombstones, ordered=False, session=session)
+
+    async def get_changes(self, since: int) -> Dict[str, Any]:
+        """جلب ما تغيّر بعد المؤشر since
+
+        يُرجع المؤشر الجديد، المرضى والدفعات المعدّلة (مع اسم المريض لكل دفعة)،
+        ومعرفات المحذوفات. since=0 يعني مزامنة كاملة، وكذلك المؤشر الأقدم من سجلات الحذف
+        المحتفظ بها (لا يمكن معرفة ما حُذف قبلها).
+        """
+        await self.initialize_collections()
+
+        # المؤشر يُثبَّت قبل الاستعلام حتى لا تضيع تغييرات تحدث أثناءه
+        cursor, counter = await self._publish_cursor()
+        if since < counter.get("pruned_through", 0):
+            since = 0
+        version_query = {"version": {"$gt": since}} if since > 0 else {}
+
+        patients_data = await self.patients_collection.find(version_query, {"payments": 0}).to_list(length=None)
+        patients = [Patient(**patient_data) for patient_data in patients_data]
+
+        payments_data = await self.payments_collection.find(version_query).to_list(length=None)
+        payments = [Payment(**payment_data) for payment_data in payments_data]
+
+        # أسماء المرضى للدفعات التي لم يتغير مريضها في هذه الدفعة
+        patient_names = {patient.id: patient.name for patient in patients}
+        missing_ids = list({payment.patient_id for payment in payments} - set(patient_names))
+        if missing_ids:
+            async for patient_data in self.patients_collection.find({"_id": {"$in": missing_ids}}, {"name": 1}):
+                patient_names[patient_data["_id"]] = patient_data["name"]
+
+        deleted = {"patients": [], "payments": []}
+        if since > 0:
+            async for tombstone in self.tombstones_collection.find(version_query):
+                deleted.setdefault(tombstone["collection"], []).append(str(tombstone["doc_id"]))
+
+        return {
+            "cursor": cursor,
+            "full": since <= 0,
+            "patients": patients,
+            "payments": [(payment, patient_names.get(payment.patient_id)) for payment in payments],
+            "deleted": deleted,
+        }
+
+    async def initialize_counter(self) -> int:
+        """تهيئة عدّاد الإصدارات في الذاكرة من أعلى إصدار مخزّن أو مثبت (عند البدء، قبل أي كتابة)
+
+        حتى لا تقل الإصدارات الجديدة عن مؤشرات العملاء الحالية؛ الإصدارات قبل العدّاد
+        كانت وقتاً بالميكروثانية.
+        """
+        await self.initialize_collections()
+
+        highest = 0
+        for collection in (self.patients_collection, self.payments_collection, self.tombstones_collection):
+            latest = await collection.find_one({}, {"version": 1}, sort=[("version", -1)])
+            if latest:
+                highest = max(highest, int(latest.get("version", 0)))
+        counter = await self.counters_collection.find_one_and_update(
+            {"_id": VERSION_COUNTER_ID},
+            {"$max": {"value": highest}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        self._version = max(self._version or 0, counter["value"], counter.get("pruned_through", 0))
+        return self._version
+
+    async def backfill_versions(self) -> int:
+        """إضافة حقول الإصدار للوثائق القديمة التي أُنشئت قبل دعم المزامنة"""
+        await self.initialize_collections()
+
+        migrated = 0
+        for collection in (self.patients_collection, self.payments_collection):
+            if await collection.find_one({"version": {"$exists": False}}, {"_id": 1}) is None:
+                continue
+            async with self.stamping() as stamp:
+                result = await collection.update_many({"version": {"$exists": False}}, {"$set": stamp})
+            migrated += result.modified_count
+        return migrated
+
+    async def prune_tombstones(self, retention_days: int = TOMBSTONE_RETENTION_DAYS) -> int:
+        """حذف سجلات الحذف الأقدم من retention_days يوماً
+
+        أعلى إصدار محذوف يُسجل في العدّاد قبل الحذف، فالعميل الذي يطلب مزامنة من مؤشر
+        أقدم منه يحصل على مزامنة كاملة بدل تفويت عمليات حذف.
+        """
+        await self.initialize_collections()
+
+        cutoff = DateUtils.get_utc_now() - timedelta(days=retention_days)
+        newest = await self.tombstones_collection.find_one(
+            {"deleted_at": {"$lt": cutoff}}, {"version": 1}, sort=[("version", -1)]
+        )
+        if newest is None:
+            return 0
+
+        await self.counters_collection.update_one(
+            {"_id": VERSION_COUNTER_ID}, {"$max": {"pruned_through": newest["version"]}}, upsert=True
+        )
+        result = await self.tombstones_collection.delete_many({"version": {"$lte": newest["version"]}})
+        return result.deleted_count
+
+    async def run_periodic_pruning(self, interval_seconds: int = TOMBSTONE_PRUNE_INTERVAL_SECONDS):
+        """مهمة خلفية تنظف سجلات الحذف القديمة كل interval_seconds"""
+        while True:
+            try:
+                pruned = await self.prune_tombstones()
+                if pruned:
+                    print(f"🧹 تم حذف {pruned} سجل حذف أقدم من {TOMBSTONE_RETENTION_DAYS} يوماً")
+            except Exception as e:
+                print(f"خطأ في تنظيف سجلات الحذف: {e}")
+            await asyncio.sleep(interval_seconds)
+
+
+# إنشاء نسخة واحدة من خدمة المزامنة
+sync_service = SyncService()
@@ -0,0 +1,168 @@
+import heapq
+import math
+from collections import defaultdict
+from typing import List, Dict, Any, Set
+from motor.motor_asyncio import AsyncIOMotorCollection
+
+from services.database import db_service
+from utils.search_utils import SearchUtils
+
+
+# أقصى طول بادئة تُفهرس لكل كلمة (الكلمات الأطول تُطابق ببادئاتها حتى هذا الطول ثم بالمقاطع)
+MAX_PREFIX_LENGTH = 12
+
+
+class TypeaheadService:
+    """فهرس اقتراحات في الذاكرة لأسماء المرضى وأرقامهم (للبحث أثناء الكتابة)
+
+    يُبنى عند بدء التشغيل من مؤشر يجلب الحقول اللازمة فقط، ويُحدَّث مع كل كتابة على المرضى.
+    """
+
+    def __init__(self):
+        self.patients_collection: AsyncIOMotorCollection = None
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._name_prefixes: Dict[str, Set[str]] = defaultdict(set)
+        self._name_trigrams: Dict[str, Set[str]] = defaultdict(set)
+        self._phone_prefixes: Dict[str, Set[str]] = defaultdict(set)
+
+    async def initialize_collections(self):
+        """تهيئة المجموعات"""
+        if self.patients_collection is None:
+            self.patients_collection = db_service.get_collection("patients")
+
+    async def build(self) -> int:
+        """بناء الفهرس من جميع المرضى (الاسم والهاتف والمتبقي فقط)"""
+        await self.initialize_collections()
+
+        self._entries.clear()
+        self._name_prefixes.clear()
+        self._name_trigrams.clear()
+        self._phone_prefixes.clear()
+
+        cursor = self.patients_collection.find({}, {"name": 1, "phone": 1, "remaining_amount": 1})
+        async for patient_data in cursor:
+            self.upsert(patient_data)
+        return len(self._entries)
+
+    def upsert(self, patient: Any):
+        """إضافة مريض أو تحديثه في الفهرس (وثيقة من قاعدة البيانات أو كائن Patient)"""
+        data = patient if isinstance(patient, dict) else patient.dict(by_alias=True)
+        patient_id = str(data["_id"])
+        self.remove(patient_id)
+
+        tokens = SearchUtils.name_tokens(data.get("name"))
+        entry = {
+            "id": patient_id,
+            "name": data.get("name", ""),
+            "phone": data.get("phone", ""),
+            "remaining_amount": float(data.get("remaining_amount") or 0),
+            "name_search": " ".join(tokens),
+            "tokens": tokens,
+            "trigrams": SearchUtils.name_trigrams(tokens),
+            "phone_normalized": SearchUtils.normalize_phone(data.get("phone")),
+        }
+        self._entries[patient_id] = entry
+
+        for key in self._name_keys(entry):
+            self._name_prefixes[key].add(patient_id)
+        for gram in entry["trigrams"]:
+            self._name_trigrams[gram].add(patient_id)
+        for key in self._phone_keys(entry):
+            self._phone_prefixes[key].add(patient_id)
+
+    def remove(self, patient_id: Any):
+        """حذف مريض من الفهرس"""
+        entry = self._entries.pop(str(patient_id), None)
+        if entry is None:
+            return
+
+        for index, keys in (
+            (self._name_prefixes, self._name_keys(entry)),
+            (self._name_trigrams, entry["trigrams"]),
+            (self._phone_prefixes, self._phone_keys(entry)),
+        ):
+            for key in keys:
+                ids = index.get(key)
+                if ids is not None:
+                    ids.discard(entry["id"])
+                    if not ids:
+                        del index[key]
+
+    def adjust_remaining(self, patient_id: Any, delta: float):
+        """تعديل المبلغ المتبقي المعروض بعد إضافة دفعة أو حذفها"""
+        entry = self._entries.get(str(patient_id))
+        if entry is not None:
+            entry["remaining_amount"] += delta
+
+    def suggest(self, search_term: str, limit: int = 10) -> List[Dict[str, Any]]:
+        """اقتراحات للبحث أثناء الكتابة (المعرف، الاسم، الهاتف، المتبقي)"""
+        if SearchUtils.is_phone_query(search_term):
+            phone = SearchUtils.normalize_phone(search_term)[:MAX_PREFIX_LENGTH]
+            ids = self._phone_prefixes.get(phone, ()) if phone else ()
+            entries = heapq.nsmallest(limit, (self._entries[i] for i in ids), key=lambda e: e["phone_normalized"])
+            return [self._public(entry) for entry in entries]
+
+        tokens = SearchUtils.name_tokens(search_term)
+        if not tokens:
+            return []
+
+        # المطابقة ببدايات الكلمات: كل كلمة في البحث بداية لكلمة في الاسم (بدءاً بأصغر مجموعة)
+        sets = sorted((self._name_prefixes.get(token[:MAX_PREFIX_LENGTH], set()) for token in tokens), key=len)
+        prefix_matches = sets[0].intersection(*sets[1:]) if len(sets) > 1 else sets[0]
+        candidates = set(prefix_matches)
+
+        # عند قلة النتائج: مطابقة تقريبية بالمقاطع الثلاثية (تتحمل الأخطاء الإملائية)
+        if len(candidates) < limit and any(len(token) >= SearchUtils.NGRAM_SIZE for token in tokens):
+            grams = SearchUtils.name_trigrams(tokens)
+            overlap: Dict[str, int] = defaultdict(int)
+            for gram in grams:
+                for patient_id in self._name_trigrams.get(gram, ()):
+                    overlap[patient_id] += 1
+            threshold = math.ceil(len(grams) / 2)
+            candidates |= {patient_id for patient_id, count in overlap.items() if count >= threshold}
+
+        # الترتيب على كل المرشحين قبل القص: مطابقات البداية أولاً ثم التقريبية، وداخل كل منهما بدرجة التطابق
+        ranked = heapq.nsmallest(limit, (self._entries[i] for i in candidates), key=lambda e: (
+            e["id"] not in prefix_matches,
+            -SearchUtils.rank_name_match(search_term, e["name_search"], e["trigrams"]),
+            e["name"],
+        ))
+        return [self._public(entry) for entry in ranked]
+
+    def stats(self) -> Dict[str, int]:
+        """حجم الفهرس"""
+        return {
+            "patients": len(self._entries),
+            "name_prefixes": len(self._name_prefixes),
+            "name_trigrams": len(self._name_trigrams),
+            "phone_prefixes": len(self._phone_prefixes),
+        }
+
+    @staticmethod
+    def _name_keys(entry: Dict[str, Any]) -> Set[str]:
+        """بادئات كلمات الاسم المفهرسة"""
+        return {
+            token[:length]
+            for token in entry["tokens"]
+            for length in range(1, min(len(token), MAX_PREFIX_LENGTH) + 1)
+        }
+
+    @staticmethod
+    def _phone_keys(entry: Dict[str, Any]) -> Set[str]:
+        """بادئات رقم الهاتف الموحّد المفهرسة"""
+        phone = entry["phone_normalized"]
+        return {phone[:length] for length in range(1, min(len(phone), MAX_PREFIX_LENGTH) + 1)}
+
+    @staticmethod
+    def _public(entry: Dict[str, Any]) -> Dict[str, Any]:
+        """الحقول المُرجعة في الاقتراح"""
+        return {
+            "id": entry["id"],
+            "name": entry["name"],
+            "phone": entry["phone"],
+            "remaining_amount": round(entry["remaining_amount"], 2),
+        }
+
+
+# إنشاء نسخة واحدة من خدمة الاقتراحات
+typeahead_service = TypeaheadService()
@@ -5,12 +5,71 @@
 """
 
 import asyncio
+import csv
+import io
 import json
+import time
+import zipfile
 from datetime import datetime, timedelta
+from pymongo import monitoring
 from services.patient_service import patient_service
 from services.database import db_service
+from services.statistics_service import statistics_service
+from services.statement_service import statement_service
 from schemas.patient import PatientCreate, PaymentCreate
 from utils.date_utils import DateUtils
+from utils.search_utils import SearchUtils
+from utils.spreadsheet_utils import SpreadsheetUtils
+
+
+class QueryCounter(monitoring.CommandListener):
+    """عدّاد أوامر MongoDB المُرسلة (لقياس عدد الاستعلامات لكل عملية)"""
+
+    # أوامر القراءة التي تُحسب كاستعلام مستقل (getMore مجرد متابعة لنفس المؤشر)
+    QUERY_COMMANDS = {"find", "aggregate", "count", "distinct"}
+
+    # أوامر الكتابة (ذهاب وإياب إلى قاعدة البيانات لكل منها)
+    WRITE_COMMANDS = {"insert", "update", "delete", "findAndModify"}
+
+    # أوامر إنهاء المعاملة (ذهاب وإياب إضافي عند تشغيل MongoDB كـ replica set)
+    TRANSACTION_COMMANDS = {"commitTransaction", "abortTransaction"}
+
+    # مجموعات تُحدَّث في الخلفية خارج زمن الطلب
+    BACKGROUND_COLLECTIONS = {"statistics"}
+
+    def __init__(self):
+        self.commands = []
+        self.collections = []
+
+    def reset(self):
+        self.commands = []
+        self.collections = []
+
+    @property
+    def query_count(self) -> int:
+        return len([name for name in self.commands if name in self.QUERY_COMMANDS])
+
+    @property
+    def round_trip_count(self) -> int:
+        """عدد أوامر القراءة والكتابة وتثبيت المعاملات في مسار الطلب (بدون تحديثات الخلفية)"""
+        counted = self.QUERY_COMMANDS | self.WRITE_COMMANDS | self.TRANSACTION_COMMANDS
+        return len([
+            name for name, collection in zip(self.commands, self.collections)
+            if name in counted and collection not in self.BACKGROUND_COLLECTIONS
+        ])
+
+    def started(self, event):
+        self.commands.append(event.command_name)
+        self.collections.append(event.command.get(event.command_name))
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+query_counter = QueryCounter()
 
 
 async def create_sample_patients():
@@ -125,6 +184,276 @@ async def test_system_features():
         print(f"❌ خطأ في اختبار الميزات: {e}")
 
 
+async def test_query_count():
+    """التأكد من أن استعلامات القوائم ثابتة العدد مهما كان عدد المرضى (بدون N+1)"""
+    print("\n🔢 اختبار عدد الاستعلامات...")
+
+    try:
+        checks = {
+            "get_all_patients": lambda: patient_service.get_all_patients(),
+            "get_patient_by_name_or_phone": lambda: patient_service.get_patient_by_name_or_phone("0770"),
+            "get_overdue_notifications": lambda: patient_service.get_overdue_notifications(),
+        }
+
+        for name, call in checks.items():
+            query_counter.reset()
+            result = await call()
+            assert query_counter.query_count == 1, (
+                f"{name}: {query_counter.query_count} استعلام لـ {len(result)} مريض"
+            )
+            print(f"✅ {name}: استعلام واحد لـ {len(result)} مريض")
+
+    except AssertionError as e:
+        print(f"❌ فشل اختبار عدد الاستعلامات: {e}")
+    except Exception as e:
+        print(f"❌ خطأ في اختبار عدد الاستعلامات: {e}")
+
+
+async def test_phone_search_without_digits():
+    """بحث هاتف لا يبقى منه رقم مميز بعد التوحيد ("0"، "+964") يُرجع نتيجة فارغة دون استعلام"""
+    print("\n📞 اختبار البحث برقم هاتف فارغ بعد التوحيد...")
+
+    try:
+        for term in ("0", "00", "+964"):
+            assert SearchUtils.phone_prefix_query(term) == {}, f"'{term}': بادئة فارغة تطابق كل المرضى"
+            query_counter.reset()
+            results = await patient_service.get_patient_by_name_or_phone(term)
+            assert results == [], f"'{term}': {len(results)} مريض"
+            assert query_counter.query_count == 0, f"'{term}': {query_counter.query_count} استعلام"
+            print(f"✅ '{term}': لا نتائج ولا استعلام")
+
+    except AssertionError as e:
+        print(f"❌ فشل اختبار البحث برقم هاتف فارغ: {e}")
+    except Exception as e:
+        print(f"❌ خطأ في اختبار البحث برقم هاتف فارغ: {e}")
+
+
+async def test_write_round_trips():
+    """التأكد من أن إضافة دفعة تكلف عمليتين فقط (إدراج الدفعة، تحديث ملخص المريض) وتثبيت المعاملة إن وُجدت"""
+    print("\n✍️ اختبار عدد عمليات الكتابة...")
+
+    try:
+        patient = await patient_service.create_patient(PatientCreate(
+            name="مريض اختبار الكتابة",
+            phone="07709999999",
+            total_amount=100.0,
+            installments_months=2
+        ))
+
+        query_counter.reset()
+        result = await patient_service.record_payment(PaymentCreate(patient_id=str(patient.id), amount=100.0))
+        assert result is not None, "لم تُنشأ الدفعة"
+        # تثبيت المعاملة على replica set ذهاب وإياب إضافي لا يمكن دمجه
+        allowed = 2 + int(db_service.supports_transactions)
+        assert query_counter.round_trip_count <= allowed, (
+            f"إضافة دفعة: {query_counter.round_trip_count} عملية ({query_counter.commands})"
+        )
+        print(f"✅ إضافة دفعة: {query_counter.round_trip_count} عملية")
+
+        updated = await patient_service.get_patient_by_id(str(patient.id))
+        assert updated.is_completed and updated.remaining_amount == 0, "لم يُحدَّث ملخص المريض في نفس العملية"
+        print("✅ الاكتمال والمتبقي يُحسبان في نفس تحديث الملخص")
+
+        await patient_service.delete_patient(str(patient.id))
+
+    except AssertionError as e:
+        print(f"❌ فشل اختبار عدد عمليات الكتابة: {e}")
+    except Exception as e:
+        print(f"❌ خطأ في اختبار عدد عمليات الكتابة: {e}")
+
+
+async def test_concurrent_payments():
+    """دفعات متزامنة على نفس المريض (ومريض آخر بالتوازي) يجب أن تنتهي بإجماليات صحيحة"""
+    print("\n🔀 اختبار الدفعات المتزامنة...")
+
+    payments_per_patient = 20
+    amount = 50.0
+
+    try:
+        patients = [
+            await patient_service.create_patient(PatientCreate(
+                name=f"مريض اختبار التزامن {i + 1}",
+                phone=f"0770888000{i}",
+                total_amount=payments_per_patient * amount,
+                installments_months=10
+            ))
+            for i in range(2)
+        ]
+
+        created = await asyncio.gather(*[
+            patient_service.create_payment(PaymentCreate(patient_id=str(patient.id), amount=amount))
+            for patient in patients
+            for _ in range(payments_per_patient)
+        ])
+        assert all(created), "فشل إنشاء بعض الدفعات"
+
+        for patient in patients:
+            patient_service.invalidate_patient(patient.id)
+            result = await patient_service.get_patient_by_id(str(patient.id))
+            assert result.total_paid == payments_per_patient * amount, f"المدفوع: {result.total_paid}"
+            assert result.remaining_amount == 0, f"المتبقي: {result.remaining_amount}"
+            assert result.payments_count == payments_per_patient, f"عدد الدفعات: {result.payments_count}"
+            assert result.is_completed, "لم يُعلَّم المريض كمكتمل"
+        print(f"✅ {len(created)} دفعة متزامنة: الإجماليات والاكتمال صحيحة")
+
+        # حذف دفعات بالتوازي يعيد المتبقي ويلغي الاكتمال
+        patient_payments = [payment for payment in created if payment.patient_id == patients[0].id]
+        await asyncio.gather(*[patient_service.delete_payment(str(payment.id)) for payment in patient_payments[:3]])
+        result = await patient_service.get_patient_by_id(str(patients[0].id))
+        assert result.remaining_amount == 3 * amount, f"المتبقي بعد الحذف: {result.remaining_amount}"
+        assert result.payments_count == payments_per_patient - 3, f"عدد الدفعات بعد الحذف: {result.payments_count}"
+        assert not result.is_completed, "لم يُلغَ الاكتمال بعد حذف الدفعات"
+        print("✅ حذف الدفعات المتزامن يعيد المتبقي ويلغي الاكتمال")
+
+        for patient in patients:
+            await patient_service.delete_patient(str(patient.id))
+
+    except AssertionError as e:
+        print(f"❌ فشل اختبار الدفعات المتزامنة: {e}")
+    except Exception as e:
+        print(f"❌ خطأ في اختبار الدفعات المتزامنة: {e}")
+
+
+async def test_bulk_payments():
+    """إدخال مئات الدفعات في طلب واحد: عدد عمليات ثابت وإجماليات صحيحة"""
+    print("\n📥 اختبار الإدخال الجماعي للدفعات...")
+
+    patients_count = 10
+    payments_count = 500
+
+    try:
+        patients = [
+            await patient_service.create_patient(PatientCreate(
+                name=f"مريض اختبار جماعي {i + 1}",
+                phone=f"0770777{i:04d}",
+                total_amount=1000.0,
+                installments_months=10
+            ))
+            for i in range(patients_count)
+        ]
+        items = [
+            PaymentCreate(patient_id=str(patients[i % patients_count].id), amount=1.0)
+            for i in range(payments_count)
+        ]
+        items.append(PaymentCreate(patient_id="غير صالح", amount=1.0))
+
+        query_counter.reset()
+        started = time.perf_counter()
+        results = await patient_service.create_payments_bulk(items)
+        elapsed = time.perf_counter() - started
+
+        created = sum(1 for result in results if result["success"])
+        assert created == payments_count, f"تم إنشاء {created} من {payments_count}"
+        assert not results[-1]["success"] and results[-1]["error"], "لم يُرفض العنصر غير الصالح"
+        # قراءة المرضى، إدراج الدفعات، تحديث الملخصات، وتثبيت المعاملة إن وُجدت
+        allowed = 3 + int(db_service.supports_transactions)
+        assert query_counter.round_trip_count <= allowed, (
+            f"الإدخال الجماعي: {query_counter.round_trip_count} عملية ({query_counter.commands})"
+        )
+
+        for patient in patients:
+            result = await patient_service.get_patient_by_id(str(patient.id))
+            assert result.total_paid == payments_count / patients_count, f"المدفوع: {result.total_paid}"
+        print(f"✅ {created} دفعة في {query_counter.round_trip_count} عمليات "
+              f"({created / elapsed:.0f} دفعة/ثانية)")
+
+        for patient in patients:
+            await patient_service.delete_patient(str(patient.id))
+
+    except AssertionError as e:
+        print(f"❌ فشل اختبار الإدخال الجماعي: {e}")
+    except Exception as e:
+        print(f"❌ خطأ في اختبار الإدخال الجماعي: {e}")
+
+
+async def test_patient_import():
+    """استيراد ملف CSV كبير على دفعات مع الإبلاغ عن الصفوف الخاطئة"""
+    print("\n📄 اختبار استيراد المرضى من ملف...")
+
+    rows_count = 5000
+
+    try:
+        text = io.StringIO()
+        writer = csv.writer(text)
+        writer.writerow(["الاسم", "رقم الهاتف", "المبلغ الكلي", "عدد الأشهر", "تاريخ التسجيل"])
+        for i in range(rows_count):
+            writer.writerow([f"مريض اختبار الاستيراد {i + 1}", f"0771{i:07d}", 1000, 10, "01/05/2024"])
+        writer.writerow(["صف خاطئ", "123", "-1", "10", ""])
+
+        started = time.perf_counter()
+        events = [
+            event async for event in patient_service.import_patients(
+                SpreadsheetUtils.iter_rows("patients.csv", io.BytesIO(text.getvalue().encode("utf-8")))
+            )
+        ]
+        elapsed = time.perf_counter() - started
+
+        end = events[-1]["data"]
+        errors = [event["data"] for event in events if event["type"] == "error"]
+        assert end["inserted"] == rows_count, f"تم استيراد {end['inserted']} من {rows_count}"
+        assert [error["row"] for error in errors] == [rows_count + 2], f"أخطاء الصفوف: {errors}"
+        print(f"✅ {end['inserted']} مريض في {elapsed:.2f} ثانية، مع رفض الصف {errors[0]['row']}")
+
+        # الحذف عبر الخدمة يحدّث الاقتراحات والذاكرة المؤقتة والعدّادات والتقارير
+        async for patient in patient_service.patients_collection.find({"name_tokens": "الاستيراد"}, {"_id": 1}):
+            await patient_service.delete_patient(str(patient["_id"]))
+
+    except AssertionError as e:
+        print(f"❌ فشل اختبار الاستيراد: {e}")
+    except Exception as e:
+        print(f"❌ خطأ في اختبار الاستيراد: {e}")
+
+
+async def test_statement_batch():
+    """دفعة كشوفات نهاية الشهر: كشف لكل مريض غير مكتمل في ملف ZIP واحد"""
+    print("\n🧾 اختبار دفعة كشوفات نهاية الشهر...")
+
+    try:
+        job = statement_service.start_batch()
+        while job["status"] == "running":
+            await asyncio.sleep(0.5)
+            job = statement_service.job_status(job["id"])
+
+        assert job["status"] == "completed", f"حالة المهمة {job['status']}: {job['errors']}"
+        path, _ = statement_service.job_file(job["id"])
+        with zipfile.ZipFile(path) as archive:
+            names = archive.namelist()
+        assert len(names) == job["total"] == job["rendered"], f"{len(names)} كشف من {job['total']}"
+        rate = job["rendered"] / job["elapsed_seconds"] if job["elapsed_seconds"] else 0
+        print(f"✅ {job['rendered']} كشف في {job['elapsed_seconds']} ثانية ({rate:.1f} كشف/ثانية)، "
+              f"حجم الملف {job['size'] / 1024 / 1024:.1f} MB")
+
+    except AssertionError as e:
+        print(f"❌ فشل اختبار دفعة الكشوفات: {e}")
+    except Exception as e:
+        print(f"❌ خطأ في اختبار دفعة الكشوفات: {e}")
+    finally:
+        statement_service.shutdown()
+
+
+async def test_statistics_counters():
+    """التأكد من أن عدّادات الإحصائيات المحدّثة بـ $inc تطابق البيانات الفعلية"""
+    print("\n📈 اختبار عدّادات الإحصائيات...")
+
+    try:
+        # تحديثات العدّادات تجري في الخلفية، فيُنتظر انتهاؤها قبل المقارنة
+        await statistics_service.flush()
+
+        query_counter.reset()
+        counters = await statistics_service.get_counters()
+        assert query_counter.query_count == 1, f"قراءة العدّادات: {query_counter.query_count} استعلام"
+
+        computed = await statistics_service.compute_counters()
+        drift = {k: computed[k] - counters[k] for k in counters if round(computed[k] - counters[k], 2)}
+        assert not drift, f"انحراف في العدّادات: {drift}"
+        print(f"✅ العدّادات مطابقة ({counters['total_patients']} مريض) وتُقرأ باستعلام واحد")
+
+    except AssertionError as e:
+        print(f"❌ فشل اختبار عدّادات الإحصائيات: {e}")
+    except Exception as e:
+        print(f"❌ خطأ في اختبار عدّادات الإحصائيات: {e}")
+
+
 async def display_system_info():
     """عرض معلومات النظام"""
     print("\n📊 معلومات النظام:")
@@ -140,7 +469,9 @@ async def main():
 
     try:
         # الاتصال بقاعدة البيانات
-        await db_service.connect()
+        await db_service.connect(event_listeners=[query_counter])
+        # كما في بدء تشغيل التطبيق: العدّادات تبدأ من حالة مطابقة للبيانات
+        await statistics_service.reconcile()
 
         # عرض معلومات النظام
         await display_system_info()
@@ -155,6 +486,30 @@ async def main():
         # اختبار الميزات
         await test_system_features()
 
+        # اختبار عدد الاستعلامات
+        await test_query_count()
+
+        # اختبار البحث برقم هاتف فارغ بعد التوحيد
+        await test_phone_search_without_digits()
+
+        # اختبار عدد عمليات الكتابة
+        await test_write_round_trips()
+
+        # اختبار الدفعات المتزامنة
+        await test_concurrent_payments()
+
+        # اختبار الإدخال الجماعي للدفعات
+        await test_bulk_payments()
+
+        # اختبار استيراد المرضى من ملف
+        await test_patient_import()
+
+        # اختبار دفعة كشوفات نهاية الشهر
+        await test_statement_batch()
+
+        # اختبار عدّادات الإحصائيات
+        await test_statistics_counters()
+
         print("\n✅ تم الانتهاء من الاختبار بنجاح!")
         print("\n📖 يمكنك الآن:")
         print("   • زيارة http://localhost:8000/docs لعرض وثائق API")
@@ -1,4 +1,5 @@
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
+from typing import Optional
 import pytz
 
 
@@ -13,6 +14,11 @@ class DateUtils:
         """الحصول على التاريخ والوقت الحالي في بغداد"""
         return datetime.now(DateUtils.BAGHDAD_TZ)
 
+    @staticmethod
+    def get_utc_now() -> datetime:
+        """الوقت الحالي بتوقيت UTC بدون توقيت، كما تُخزّن التواريخ (لا يعتمد على توقيت الخادم)"""
+        return datetime.utcnow()
+
     @staticmethod
     def convert_to_baghdad_time(dt: datetime) -> datetime:
         """تحويل تاريخ إلى توقيت بغداد"""
@@ -65,3 +71,43 @@ class DateUtils:
         """الحصول على نهاية الشهر"""
         next_month = dt.replace(day=28) + timedelta(days=4)  # الذهاب إلى الشهر التالي
         return next_month - timedelta(days=next_month.day)  # العودة إلى اليوم الأخير من الشهر الحالي
+
+    @staticmethod
+    def get_month_key(dt: datetime) -> str:
+        """مفتاح الشهر (YYYY-MM) بتوقيت بغداد"""
+        return DateUtils.convert_to_baghdad_time(dt).strftime("%Y-%m")
+
+    @staticmethod
+    def parse_month_key(month_key: str) -> tuple:
+        """تحويل مفتاح الشهر (YYYY-MM) إلى (السنة، الشهر)"""
+        try:
+            year, month = (int(part) for part in month_key.split("-"))
+            datetime(year, month, 1)
+        except (ValueError, AttributeError):
+            raise ValueError(f"صيغة الشهر غير صحيحة (YYYY-MM): {month_key}")
+        return year, month
+
+    @staticmethod
+    def shift_month_key(month_key: str, months: int) -> str:
+        """إزاحة مفتاح الشهر بعدد من الأشهر"""
+        year, month = DateUtils.parse_month_key(month_key)
+        index = year * 12 + (month - 1) + months
+        return f"{index // 12:04d}-{index % 12 + 1:02d}"
+
+    @staticmethod
+    def get_month_start_utc(month_key: str) -> datetime:
+        """بداية الشهر بتوقيت بغداد محوّلة إلى UTC (بدون توقيت، كما تُخزّن التواريخ)"""
+        year, month = DateUtils.parse_month_key(month_key)
+        start = DateUtils.BAGHDAD_TZ.localize(datetime(year, month, 1))
+        return start.astimezone(pytz.UTC).replace(tzinfo=None)
+
+    @staticmethod
+    def get_day_start_utc(day: date) -> datetime:
+        """بداية اليوم بتوقيت بغداد محوّلة إلى UTC (بدون توقيت، كما تُخزّن التواريخ)"""
+        start = DateUtils.BAGHDAD_TZ.localize(datetime(day.year, day.month, day.day))
+        return start.astimezone(pytz.UTC).replace(tzinfo=None)
+
+    @staticmethod
+    def get_baghdad_date(dt: Optional[datetime]) -> Optional[date]:
+        """التاريخ (بدون الوقت) بتوقيت بغداد لتاريخ مخزّن"""
+        return DateUtils.convert_to_baghdad_time(dt).date() if dt else None
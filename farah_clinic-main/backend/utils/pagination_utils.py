@@ -0,0 +1,41 @@
+import base64
+from typing import Any, Dict, Optional, Tuple
+from bson import json_util
+
+
+class PaginationUtils:
+    """معالجات مساعدة للترقيم بالمؤشر (keyset pagination)"""
+
+    @staticmethod
+    def encode_cursor(sort: str, value: Any, doc_id: Any) -> str:
+        """ترميز آخر (قيمة الترتيب، _id) في مؤشر نصي معتم"""
+        raw = json_util.dumps({"s": sort, "v": value, "id": doc_id})
+        return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+    @staticmethod
+    def decode_cursor(cursor: str, sort: str) -> Tuple[Any, Any]:
+        """فك ترميز المؤشر والتحقق من أنه يخص نفس حقل الترتيب"""
+        try:
+            padded = cursor + "=" * (-len(cursor) % 4)
+            data = json_util.loads(base64.urlsafe_b64decode(padded.encode("ascii")).decode("utf-8"))
+        except Exception:
+            raise ValueError("مؤشر الصفحة غير صالح")
+
+        if not isinstance(data, dict) or data.get("s") != sort or "id" not in data:
+            raise ValueError("مؤشر الصفحة لا يطابق حقل الترتيب")
+        return data.get("v"), data["id"]
+
+    @staticmethod
+    def keyset_query(sort: str, descending: bool, cursor: Optional[str]) -> Dict[str, Any]:
+        """شرط الصفحة التالية: ما بعد (قيمة الترتيب، _id) المرمّزة في المؤشر"""
+        if not cursor:
+            return {}
+
+        value, doc_id = PaginationUtils.decode_cursor(cursor, sort)
+        op = "$lt" if descending else "$gt"
+        return {
+            "$or": [
+                {sort: {op: value}},
+                {sort: value, "_id": {op: doc_id}},
+            ]
+        }
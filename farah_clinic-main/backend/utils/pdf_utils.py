@@ -0,0 +1,159 @@
+import functools
+import io
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+import arabic_reshaper
+from bidi.algorithm import get_display
+from reportlab.lib import colors
+from reportlab.lib.enums import TA_CENTER, TA_RIGHT
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.styles import ParagraphStyle
+from reportlab.lib.units import mm
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
+from reportlab.platypus import Paragraph, SimpleDocTemplate, Spacer, Table, TableStyle
+
+
+class PdfUtils:
+    """إنشاء كشوفات الحساب بصيغة PDF (دوال نقية تُستدعى داخل عمليات منفصلة)"""
+
+    # اسم الخط المسجّل في reportlab
+    FONT_NAME = "StatementArabic"
+
+    # خطوط تدعم العربية تُجرّب بالترتيب إذا لم يُحدد STATEMENT_FONT_PATH
+    FONT_CANDIDATES = (
+        "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+        "/usr/share/fonts/TTF/DejaVuSans.ttf",
+        "/Library/Fonts/Arial Unicode.ttf",
+        "C:\\Windows\\Fonts\\arial.ttf",
+        "C:\\Windows\\Fonts\\tahoma.ttf",
+    )
+
+    HEADER_BACKGROUND = colors.HexColor("#E8F1F8")
+
+    # عدد النصوص المشكّلة المحفوظة في كل عملية رسم (العناوين والحالات تتكرر في كل كشف)
+    RESHAPE_CACHE_SIZE = 4096
+
+    @staticmethod
+    def render_statement(data: Dict[str, Any], font_path: Optional[str] = None) -> bytes:
+        """كشف حساب مريض: البيانات، ملخص المبالغ، سجل الدفعات، وجدول الأقساط
+
+        data من StatementService.statement_data (قيم بسيطة فقط لتُنقل بين العمليات).
+        """
+        PdfUtils._register_font(font_path)
+
+        title_style = ParagraphStyle("title", fontName=PdfUtils.FONT_NAME, fontSize=16, alignment=TA_CENTER, leading=22)
+        heading_style = ParagraphStyle("heading", fontName=PdfUtils.FONT_NAME, fontSize=12, alignment=TA_RIGHT, leading=18)
+        text_style = ParagraphStyle("text", fontName=PdfUtils.FONT_NAME, fontSize=9, alignment=TA_RIGHT, leading=13)
+
+        def text(value: Any, style: ParagraphStyle = text_style) -> Paragraph:
+            return Paragraph(PdfUtils.arabic("" if value is None else str(value)), style)
+
+        patient = data["patient"]
+        story: List[Any] = [
+            text(data["clinic"], title_style),
+            text(f"كشف حساب المريض - {data['generated_at']}", heading_style),
+            Spacer(1, 4 * mm),
+        ]
+
+        details = [
+            ("اسم المريض", patient["name"]),
+            ("رقم الهاتف", patient["phone"]),
+            ("تاريخ التسجيل", patient["registration_date"]),
+            ("المبلغ الكلي", patient["total_amount"]),
+            ("مدة التقسيط", f"{patient['installments_months']} شهر"),
+            ("القسط الشهري", patient["monthly_installment"]),
+            ("المدفوع", patient["total_paid"]),
+            ("المتبقي", patient["remaining_amount"]),
+            ("الاستحقاق التالي", patient["next_payment_date"]),
+            ("الحالة", patient["status"]),
+        ]
+        if patient.get("notes"):
+            details.append(("ملاحظات", patient["notes"]))
+        story.append(PdfUtils._table([[text(value), text(label)] for label, value in details],
+                                     col_widths=[120 * mm, 50 * mm], header=False))
+
+        story += [Spacer(1, 6 * mm), text("سجل الدفعات", heading_style)]
+        payment_rows = [[text(row["notes"]), text(row["amount"]), text(row["date"]), text(row["number"])]
+                        for row in data["payments"]]
+        if payment_rows:
+            story.append(PdfUtils._table(
+                [[text("ملاحظات"), text("المبلغ"), text("التاريخ"), text("#")]] + payment_rows,
+                col_widths=[80 * mm, 40 * mm, 35 * mm, 15 * mm]
+            ))
+        else:
+            story.append(text("لا توجد دفعات"))
+
+        story += [Spacer(1, 6 * mm), text("جدول الأقساط", heading_style)]
+        story.append(PdfUtils._table(
+            [[text("الحالة"), text("المبلغ"), text("تاريخ الاستحقاق"), text("#")]] +
+            [[text(row["status"]), text(row["amount"]), text(row["date"]), text(row["number"])]
+             for row in data["schedule"]],
+            col_widths=[50 * mm, 50 * mm, 55 * mm, 15 * mm]
+        ))
+
+        output = io.BytesIO()
+        document = SimpleDocTemplate(
+            output, pagesize=A4, title=f"Statement {patient['id']}",
+            leftMargin=15 * mm, rightMargin=15 * mm, topMargin=15 * mm, bottomMargin=15 * mm
+        )
+        document.build(story)
+        return output.getvalue()
+
+    @staticmethod
+    def render_statements(
+        items: List[Tuple[str, Dict[str, Any]]], font_path: Optional[str] = None
+    ) -> List[Tuple[str, Optional[bytes], Optional[str]]]:
+        """رسم مجموعة كشوفات في استدعاء واحد (لتقليل كلفة النقل بين العمليات في الدفعات الكبيرة)
+
+        items: (اسم الملف، بيانات الكشف). يُرجع (اسم الملف، PDF، الخطأ) لكل كشف، فلا يُفشل
+        كشف واحد معطوب بقية المجموعة.
+        """
+        results = []
+        for name, data in items:
+            try:
+                results.append((name, PdfUtils.render_statement(data, font_path), None))
+            except Exception as e:
+                results.append((name, None, str(e)))
+        return results
+
+    @staticmethod
+    def arabic(value: str) -> str:
+        """تشكيل الحروف العربية وترتيبها للعرض من اليمين إلى اليسار (reportlab يرسم من اليسار)"""
+        return get_display(PdfUtils.reshape(value))
+
+    @staticmethod
+    @functools.lru_cache(maxsize=RESHAPE_CACHE_SIZE)
+    def reshape(value: str) -> str:
+        """تشكيل الحروف العربية مع حفظ النتيجة، فتشكيل النص الواحد مكلف والنصوص الثابتة تتكرر"""
+        return arabic_reshaper.reshape(value)
+
+    @staticmethod
+    def resolve_font_path(font_path: Optional[str] = None) -> str:
+        """مسار خط يدعم العربية: المحدد في الإعدادات أو أول خط متوفر من FONT_CANDIDATES"""
+        for candidate in ([font_path] if font_path else []) + list(PdfUtils.FONT_CANDIDATES):
+            if os.path.exists(candidate):
+                return candidate
+        raise RuntimeError("لم يُعثر على خط يدعم العربية، حدد مساره في STATEMENT_FONT_PATH")
+
+    @staticmethod
+    def _register_font(font_path: Optional[str]):
+        """تسجيل الخط مرة واحدة في كل عملية"""
+        if PdfUtils.FONT_NAME not in pdfmetrics.getRegisteredFontNames():
+            pdfmetrics.registerFont(TTFont(PdfUtils.FONT_NAME, PdfUtils.resolve_font_path(font_path)))
+
+    @staticmethod
+    def _table(rows: List[List[Any]], col_widths: List[float], header: bool = True) -> Table:
+        """جدول بحدود، الأعمدة مرتبة من اليمين إلى اليسار"""
+        table = Table(rows, colWidths=col_widths, repeatRows=1 if header else 0)
+        style = [
+            ("GRID", (0, 0), (-1, -1), 0.5, colors.grey),
+            ("VALIGN", (0, 0), (-1, -1), "MIDDLE"),
+        ]
+        if header:
+            style.append(("BACKGROUND", (0, 0), (-1, 0), PdfUtils.HEADER_BACKGROUND))
+        else:
+            style.append(("BACKGROUND", (-1, 0), (-1, -1), PdfUtils.HEADER_BACKGROUND))
+        table.setStyle(TableStyle(style))
+        return table
@@ -0,0 +1,128 @@
+import re
+from functools import lru_cache
+from typing import Any, Dict, FrozenSet, List, Optional, Tuple
+
+
+class SearchUtils:
+    """معالجات مساعدة للبحث (توحيد أرقام الهواتف والأسماء العربية)"""
+
+    # رمز الدولة للعراق
+    COUNTRY_CODE = "964"
+
+    # مصطلح بحث يتكون من أرقام وفواصل الهاتف فقط
+    PHONE_QUERY_PATTERN = re.compile(r"^\+?[\d\s\-()]+$")
+
+    # التشكيل والتطويل (تُحذف عند التوحيد)
+    TASHKEEL_PATTERN = re.compile(r"[\u064B-\u065F\u0670\u0640]")
+
+    # توحيد أشكال الحروف المتقاربة في الكتابة
+    ARABIC_LETTER_MAP = str.maketrans({
+        "أ": "ا", "إ": "ا", "آ": "ا", "ٱ": "ا",
+        "ى": "ي", "ئ": "ي",
+        "ة": "ه",
+        "ؤ": "و",
+    })
+
+    # طول المقاطع المستخدمة في البحث التقريبي
+    NGRAM_SIZE = 3
+
+    @staticmethod
+    def normalize_phone(phone: Optional[str]) -> str:
+        """توحيد رقم الهاتف إلى أرقام فقط بدون رمز الدولة أو الصفر البادئ
+
+        0770 123 4567 و +964 770 123 4567 و 00964770... كلها تصبح 7701234567.
+        """
+        digits = re.sub(r"\D", "", phone or "")
+        if digits.startswith("00" + SearchUtils.COUNTRY_CODE):
+            digits = digits[2 + len(SearchUtils.COUNTRY_CODE):]
+        elif digits.startswith(SearchUtils.COUNTRY_CODE):
+            digits = digits[len(SearchUtils.COUNTRY_CODE):]
+        return digits.lstrip("0")
+
+    @staticmethod
+    def is_phone_query(search_term: str) -> bool:
+        """هل مصطلح البحث رقم هاتف (أو جزء من بدايته)"""
+        return bool(SearchUtils.PHONE_QUERY_PATTERN.match(search_term.strip())) and any(
+            c.isdigit() for c in search_term
+        )
+
+    @staticmethod
+    def phone_prefix_query(search_term: str) -> Dict[str, Any]:
+        """استعلام بادئة مثبّت على الهاتف الموحّد (يستخدم الفهرس بدل مسح المجموعة)
+
+        يُرجع {} إذا لم يبقَ رقم مميز بعد التوحيد ("0" أو "+964")، حتى لا تطابق البادئة الفارغة كل المرضى.
+        """
+        phone = SearchUtils.normalize_phone(search_term)
+        if not phone:
+            return {}
+        return {"phone_normalized": {"$regex": "^" + re.escape(phone)}}
+
+    @staticmethod
+    def normalize_arabic(text: Optional[str]) -> str:
+        """توحيد النص العربي للبحث: حذف التشكيل، توحيد (أ/إ/آ/ا) و(ى/ي) و(ة/ه)، وأحرف صغيرة"""
+        text = SearchUtils.TASHKEEL_PATTERN.sub("", text or "")
+        text = text.translate(SearchUtils.ARABIC_LETTER_MAP).lower()
+        return " ".join(re.findall(r"\w+", text))
+
+    @staticmethod
+    def name_tokens(text: Optional[str]) -> List[str]:
+        """كلمات الاسم بعد التوحيد"""
+        return SearchUtils.normalize_arabic(text).split()
+
+    @staticmethod
+    def name_trigrams(tokens: List[str]) -> List[str]:
+        """المقاطع الثلاثية لكل كلمة (الكلمات الأقصر تُستخدم كما هي)"""
+        size = SearchUtils.NGRAM_SIZE
+        grams = set()
+        for token in tokens:
+            if len(token) <= size:
+                grams.add(token)
+            else:
+                grams.update(token[i:i + size] for i in range(len(token) - size + 1))
+        return sorted(grams)
+
+    @staticmethod
+    def name_search_fields(name: str) -> Dict[str, Any]:
+        """حقول البحث بالاسم المحسوبة عند الكتابة (المفتاح الموحّد، الكلمات، المقاطع الثلاثية)"""
+        tokens = SearchUtils.name_tokens(name)
+        return {
+            "name_search": " ".join(tokens),
+            "name_tokens": tokens,
+            "name_trigrams": SearchUtils.name_trigrams(tokens),
+        }
+
+    @staticmethod
+    def name_prefix_query(search_term: str) -> Dict[str, Any]:
+        """كل كلمة في البحث يجب أن تكون بداية لإحدى كلمات الاسم (استعلام مفهرس على name_tokens)"""
+        conditions = [
+            {"name_tokens": {"$regex": "^" + re.escape(token)}}
+            for token in SearchUtils.name_tokens(search_term)
+        ]
+        if not conditions:
+            return {}
+        return conditions[0] if len(conditions) == 1 else {"$and": conditions}
+
+    @staticmethod
+    def rank_name_match(search_term: str, name_search: str, name_trigrams: List[str]) -> float:
+        """درجة تطابق الاسم مع البحث: تشابه المقاطع الثلاثية مع مكافأة للتطابق التام أو بالبداية"""
+        term, term_grams = SearchUtils._query_key(search_term)
+        name_grams = set(name_trigrams or [])
+        if not term_grams or not name_grams:
+            return 0.0
+
+        # معامل Dice بين مجموعتي المقاطع
+        score = 2 * len(term_grams & name_grams) / (len(term_grams) + len(name_grams))
+        if name_search == term:
+            score += 1.0
+        elif name_search.startswith(term):
+            score += 0.5
+        elif all(any(word.startswith(token) for word in name_search.split()) for token in term.split()):
+            score += 0.25
+        return score
+
+    @staticmethod
+    @lru_cache(maxsize=256)
+    def _query_key(search_term: str) -> Tuple[str, FrozenSet[str]]:
+        """البحث بعد التوحيد مع مقاطعه الثلاثية (مخزّن لأن الترتيب يستدعيه لكل مرشح)"""
+        term = SearchUtils.normalize_arabic(search_term)
+        return term, frozenset(SearchUtils.name_trigrams(term.split()))
@@ -0,0 +1,171 @@
+import asyncio
+import csv
+import io
+import tempfile
+from datetime import datetime
+from typing import Any, AsyncIterator, BinaryIO, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import openpyxl
+
+
+class SpreadsheetUtils:
+    """معالجات مساعدة لقراءة وكتابة ملفات CSV و XLSX صفاً بصف (بذاكرة محدودة مهما كان حجم الملف)"""
+
+    # الامتدادات المدعومة
+    SUPPORTED_EXTENSIONS = (".csv", ".xlsx")
+
+    # أسماء الأعمدة المقبولة (بالعربية أو الإنجليزية) -> اسم الحقل
+    HEADER_ALIASES = {
+        "name": "name", "الاسم": "name", "اسم المريض": "name",
+        "phone": "phone", "الهاتف": "phone", "رقم الهاتف": "phone",
+        "total_amount": "total_amount", "المبلغ": "total_amount", "المبلغ الكلي": "total_amount",
+        "installments_months": "installments_months", "الأشهر": "installments_months",
+        "عدد الأشهر": "installments_months", "عدد أشهر التقسيط": "installments_months",
+        "registration_date": "registration_date", "تاريخ التسجيل": "registration_date",
+        "notes": "notes", "ملاحظات": "notes", "الملاحظات": "notes",
+    }
+
+    # حقول نصية قد تُقرأ من XLSX كأرقام (رقم الهاتف يفقد الصفر البادئ)
+    TEXT_FIELDS = ("name", "phone", "notes")
+
+    # حقول التاريخ، وصيغ التاريخ المقبولة غير ISO (كما تكتبها جداول الحسابات عادةً)
+    DATE_FIELDS = ("registration_date",)
+    DATE_FORMATS = ("%d/%m/%Y", "%d-%m-%Y", "%Y/%m/%d")
+
+    # أنواع المحتوى للتصدير
+    MEDIA_TYPES = {
+        "csv": "text/csv; charset=utf-8",
+        "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    }
+
+    # عدد الصفوف في كل جزء CSV مُرسل، وحجم كل جزء عند إرسال ملف XLSX (بالبايت)
+    CSV_ROWS_PER_CHUNK = 500
+    XLSX_BYTES_PER_CHUNK = 64 * 1024
+
+    @staticmethod
+    def check_extension(filename: Optional[str]) -> str:
+        """امتداد الملف إذا كان مدعوماً، وإلا ValueError"""
+        extension = "." + (filename or "").rsplit(".", 1)[-1].lower() if "." in (filename or "") else ""
+        if extension not in SpreadsheetUtils.SUPPORTED_EXTENSIONS:
+            raise ValueError(f"نوع الملف غير مدعوم، الأنواع المدعومة: {', '.join(SpreadsheetUtils.SUPPORTED_EXTENSIONS)}")
+        return extension
+
+    @staticmethod
+    def iter_rows(filename: str, stream: BinaryIO) -> Iterator[Tuple[int, Dict[str, Any]]]:
+        """المرور على صفوف الملف كـ (رقم الصف في الملف، {الحقل: القيمة}) بعد سطر العناوين
+
+        الأعمدة غير المعروفة والخلايا الفارغة تُتجاهل، والصفوف الفارغة تماماً تُتخطى.
+        """
+        extension = SpreadsheetUtils.check_extension(filename)
+        rows = SpreadsheetUtils._iter_csv(stream) if extension == ".csv" else SpreadsheetUtils._iter_xlsx(stream)
+
+        fields: Optional[List[Optional[str]]] = None
+        for row_number, values in enumerate(rows, start=1):
+            if fields is None:
+                fields = [SpreadsheetUtils.HEADER_ALIASES.get(str(value or "").strip().lower()) for value in values]
+                if "name" not in fields:
+                    raise ValueError("سطر العناوين لا يحتوي عمود الاسم")
+                continue
+
+            row = {}
+            for field, value in zip(fields, values):
+                if field is not None:
+                    value = SpreadsheetUtils._clean_value(field, value)
+                    if value not in (None, ""):
+                        row[field] = value
+            if row:
+                yield row_number, row
+
+    @staticmethod
+    def export_chunks(file_format: str, headers: Sequence[str], rows: AsyncIterator[Sequence[Any]]) -> AsyncIterator[bytes]:
+        """أجزاء ملف التصدير (csv أو xlsx) من مولّد صفوف غير متزامن"""
+        if file_format == "csv":
+            return SpreadsheetUtils.csv_chunks(headers, rows)
+        if file_format == "xlsx":
+            return SpreadsheetUtils.xlsx_chunks(headers, rows)
+        raise ValueError(f"صيغة التصدير غير مدعومة: {file_format}")
+
+    @staticmethod
+    async def csv_chunks(headers: Sequence[str], rows: AsyncIterator[Sequence[Any]]) -> AsyncIterator[bytes]:
+        """CSV متدفق: يُرسل كل CSV_ROWS_PER_CHUNK صف فور كتابتها (مع BOM ليقرأ Excel العربية)"""
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        buffer.write("\ufeff")
+        writer.writerow(headers)
+
+        count = 0
+        async for row in rows:
+            writer.writerow(row)
+            count += 1
+            if count % SpreadsheetUtils.CSV_ROWS_PER_CHUNK == 0:
+                yield buffer.getvalue().encode("utf-8")
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue().encode("utf-8")
+
+    @staticmethod
+    async def xlsx_chunks(headers: Sequence[str], rows: AsyncIterator[Sequence[Any]]) -> AsyncIterator[bytes]:
+        """XLSX بوضع الكتابة فقط: الصفوف تُكتب إلى ملف مؤقت على القرص ثم يُرسل الملف على أجزاء
+
+        ملف XLSX أرشيف zip لا يكتمل إلا في النهاية، لذلك لا يُرسل قبل انتهاء الصفوف، لكن الذاكرة
+        تبقى ثابتة لأن openpyxl في وضع write_only لا يحتفظ بالصفوف.
+        """
+        workbook = openpyxl.Workbook(write_only=True)
+        sheet = workbook.create_sheet()
+        sheet.append(list(headers))
+        async for row in rows:
+            sheet.append(list(row))
+
+        with tempfile.TemporaryFile() as output:
+            await asyncio.to_thread(workbook.save, output)
+            output.seek(0)
+            while True:
+                chunk = await asyncio.to_thread(output.read, SpreadsheetUtils.XLSX_BYTES_PER_CHUNK)
+                if not chunk:
+                    break
+                yield chunk
+
+    @staticmethod
+    def _iter_csv(stream: BinaryIO) -> Iterator[List[Any]]:
+        """صفوف CSV (UTF-8 مع أو بدون BOM كما يحفظه Excel)"""
+        text = io.TextIOWrapper(stream, encoding="utf-8-sig", newline="")
+        try:
+            yield from csv.reader(text)
+        finally:
+            # فصل الغلاف حتى لا يُغلق الملف الأصلي معه
+            text.detach()
+
+    @staticmethod
+    def _iter_xlsx(stream: BinaryIO) -> Iterator[Tuple[Any, ...]]:
+        """صفوف الورقة الأولى من XLSX في وضع القراءة فقط (دون تحميل الملف في الذاكرة)"""
+        workbook = openpyxl.load_workbook(stream, read_only=True, data_only=True)
+        try:
+            yield from workbook.worksheets[0].iter_rows(values_only=True)
+        finally:
+            workbook.close()
+
+    @staticmethod
+    def _clean_value(field: str, value: Any) -> Any:
+        """تنظيف قيمة خلية: حذف المسافات، وتحويل الأرقام في الحقول النصية إلى نص"""
+        if isinstance(value, str):
+            value = value.strip()
+            if field in SpreadsheetUtils.DATE_FIELDS and value:
+                return SpreadsheetUtils._parse_date(value)
+            return value
+        if field in SpreadsheetUtils.TEXT_FIELDS and isinstance(value, (int, float)):
+            return str(int(value)) if float(value).is_integer() else str(value)
+        return value
+
+    @staticmethod
+    def _parse_date(value: str) -> Any:
+        """تحويل نص التاريخ (ISO أو يوم/شهر/سنة) إلى datetime، أو إرجاعه كما هو ليرفضه التحقق"""
+        try:
+            return datetime.fromisoformat(value)
+        except ValueError:
+            pass
+        for date_format in SpreadsheetUtils.DATE_FORMATS:
+            try:
+                return datetime.strptime(value, date_format)
+            except ValueError:
+                continue
+        return value
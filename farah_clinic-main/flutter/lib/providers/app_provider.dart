@@ -17,6 +17,7 @@ class AppProvider with ChangeNotifier {
   List<Patient> _patients = [];
   List<Payment> _payments = [];
   Statistics? _statistics;
+  int? _syncCursor; // مؤشر آخر مزامنة تفاضلية مع الخادم
 
   // تتبع الإشعارات التي تم التبليغ عنها لإخفائها لاحقاً
   final Set<String> _dismissedNotifications = <String>{};
@@ -100,6 +101,7 @@ class AppProvider with ChangeNotifier {
     _currentUser = null;
     _patients.clear();
     _payments.clear();
+    _syncCursor = null;
 
     // حذف حالة تسجيل الدخول
     final prefs = await SharedPreferences.getInstance();
@@ -207,11 +209,8 @@ class AppProvider with ChangeNotifier {
       await checkApiConnection();
 
       if (_isApiConnected) {
-        // جلب جميع البيانات دفعة واحدة فقط
-        final bootstrap = await ApiService.getBootstrapData();
-        _patients = bootstrap.patients;
-        _payments = bootstrap.payments;
-        _statistics = bootstrap.statistics;
+        // جلب جميع البيانات بشكل متدفق مع العرض التدريجي
+        await _loadBootstrapStream();
         await _loadDismissed();
       } else {
         throw Exception('لا يمكن الاتصال بالخادم');
@@ -238,6 +237,69 @@ class AppProvider with ChangeNotifier {
     notifyListeners();
   }
 
+  // عدد السجلات المستلمة بين كل تحديث للواجهة أثناء التحميل المتدفق
+  static const int _streamNotifyEvery = 200;
+
+  // تحميل البيانات من /bootstrap/stream وعرضها تدريجياً أثناء وصولها
+  // عند التحديث مع وجود بيانات سابقة تبقى القائمة الحالية معروضة حتى اكتمال البث
+  Future<void> _loadBootstrapStream() async {
+    final List<Patient> patients = [];
+    final List<Payment> payments = [];
+    final bool progressive = _patients.isEmpty;
+    Statistics? statistics;
+    int? cursor;
+    bool completed = false;
+    int sinceNotify = 0;
+
+    try {
+      await for (final record in ApiService.getBootstrapStream()) {
+        final data = record['data'];
+        switch (record['type']) {
+          case 'patient':
+            patients.add(Patient.fromJson(data as Map<String, dynamic>));
+            break;
+          case 'payment':
+            payments.add(Payment.fromJson(data as Map<String, dynamic>));
+            break;
+          case 'statistics':
+            statistics = Statistics.fromJson(data as Map<String, dynamic>);
+            break;
+          case 'end':
+            completed = true;
+            cursor = (data as Map<String, dynamic>)['cursor'] as int?;
+            break;
+        }
+
+        if (progressive && ++sinceNotify >= _streamNotifyEvery) {
+          sinceNotify = 0;
+          _patients = patients;
+          _payments = payments;
+          // إخفاء مؤشر التحميل بمجرد وصول أول دفعة (القفل _isFetching يبقى فعّالاً)
+          _isLoading = false;
+          notifyListeners();
+        }
+      }
+    } catch (e) {
+      if (e.toString().contains('UNAUTHORIZED')) rethrow;
+      debugPrint('تعذر التحميل المتدفق، استخدام bootstrap العادي: $e');
+    }
+
+    if (!completed) {
+      // الخادم لا يدعم البث أو انقطع قبل الاكتمال: جلب البيانات دفعة واحدة
+      final bootstrap = await ApiService.getBootstrapData();
+      _patients = bootstrap.patients;
+      _payments = bootstrap.payments;
+      _statistics = bootstrap.statistics;
+      _syncCursor = bootstrap.cursor;
+      return;
+    }
+
+    _patients = patients;
+    _payments = payments;
+    _statistics = statistics ?? _statistics;
+    _syncCursor = cursor;
+  }
+
   // تحميل/حفظ حالة الإشعارات المبلّغ عنها
   Future<void> _loadDismissed() async {
     final prefs = await SharedPreferences.getInstance();
@@ -322,7 +384,7 @@ class AppProvider with ChangeNotifier {
         throw Exception('غير مصرح: لا يوجد اتصال أو توكن');
       }
       await ApiService.updatePatient(patient.id!, patient);
-      await loadData(); // إعادة تحميل البيانات
+      await refreshData(); // جلب التغييرات فقط
       return true;
     } catch (e) {
       _errorMessage = e.toString();
@@ -339,7 +401,7 @@ class AppProvider with ChangeNotifier {
         throw Exception('غير مصرح: لا يوجد اتصال أو توكن');
       }
       await ApiService.deletePatient(patientId);
-      await loadData(); // إعادة تحميل البيانات
+      await refreshData(); // جلب التغييرات فقط
       return true;
     } catch (e) {
       _errorMessage = e.toString();
@@ -369,7 +431,7 @@ class AppProvider with ChangeNotifier {
         paymentDate: paymentDate,
         notes: notes,
       );
-      await loadData(force: true);
+      await refreshData();
       return true;
     } catch (e) {
       _errorMessage = e.toString();
@@ -393,7 +455,7 @@ class AppProvider with ChangeNotifier {
       }
       await ApiService.deletePayment(
           patientId: patientId, paymentId: paymentId);
-      await loadData(force: true);
+      await refreshData();
       return true;
     } catch (e) {
       _errorMessage = e.toString();
@@ -410,7 +472,7 @@ class AppProvider with ChangeNotifier {
         throw Exception('غير مصرح: لا يوجد اتصال أو توكن');
       }
       await ApiService.addPayment(payment);
-      await loadData(force: true); // إعادة تحميل البيانات
+      await refreshData(); // جلب التغييرات فقط
       return true;
     } catch (e) {
       _errorMessage = e.toString();
@@ -489,10 +551,85 @@ class AppProvider with ChangeNotifier {
     }
   }
 
-  // تحديث البيانات
+  // تحديث البيانات: مزامنة تفاضلية عبر /sync، مع تحميل كامل إذا لم يتوفر مؤشر
   Future<void> refreshData() async {
-    if (_isLoggedIn) {
+    if (!_isLoggedIn) return;
+    if (_syncCursor == null) {
+      await loadData(force: true);
+      return;
+    }
+    if (_isFetching) return;
+    _isFetching = true;
+
+    try {
+      final changes = await ApiService.getSyncChanges(_syncCursor!);
+      _applySync(changes);
+      _isFetching = false;
+      notifyListeners();
+    } catch (e) {
+      _isFetching = false;
+      debugPrint('تعذرت المزامنة التفاضلية، إعادة التحميل الكامل: $e');
       await loadData(force: true);
     }
   }
+
+  // دمج التغييرات في القوائم المحلية مع الحفاظ على الترتيب الحالي
+  void _applySync(SyncData changes) {
+    final Set<String> deletedPatients = changes.deletedPatientIds.toSet();
+    final Set<String> deletedPayments = changes.deletedPaymentIds.toSet();
+
+    final Map<String, Patient> changedPatients = {
+      for (final p in changes.patients)
+        if (p.id != null) p.id!: p
+    };
+    final Map<String, Payment> changedPayments = {
+      for (final p in changes.payments)
+        if (p.id != null) p.id!: p
+    };
+
+    if (changes.full) {
+      _patients = changes.patients;
+      _payments = changes.payments;
+    } else {
+      final List<Patient> patients = [];
+      for (final p in _patients) {
+        if (p.id != null && deletedPatients.contains(p.id)) continue;
+        final updated = p.id != null ? changedPatients.remove(p.id) : null;
+        patients.add(updated ?? p);
+      }
+      patients.addAll(changedPatients.values);
+
+      // أسماء المرضى المعدّلة تنعكس على دفعاتهم (تُستخدم للبحث المحلي)
+      final Map<String, String> names = {
+        for (final p in changes.patients)
+          if (p.id != null) p.id!: p.name
+      };
+      final List<Payment> payments = [];
+      for (final p in _payments) {
+        if (p.id != null && deletedPayments.contains(p.id)) continue;
+        if (deletedPatients.contains(p.patientId)) continue;
+        Payment payment =
+            (p.id != null ? changedPayments.remove(p.id) : null) ?? p;
+        final String? name = names[payment.patientId];
+        if (name != null && name != payment.patientName) {
+          payment = Payment(
+            id: payment.id,
+            patientId: payment.patientId,
+            patientName: name,
+            amount: payment.amount,
+            paymentDate: payment.paymentDate,
+            notes: payment.notes,
+          );
+        }
+        payments.add(payment);
+      }
+      payments.addAll(changedPayments.values);
+
+      _patients = patients;
+      _payments = payments;
+    }
+
+    _statistics = changes.statistics ?? _statistics;
+    _syncCursor = changes.cursor;
+  }
 }
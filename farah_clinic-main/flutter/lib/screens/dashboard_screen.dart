@@ -1714,8 +1714,8 @@ class _DashboardScreenState extends State<DashboardScreen> {
               ElevatedButton.icon(
                 onPressed: () async {
                   try {
-                    // إعادة تحميل البيانات للتأكد من مزامنة التعديلات عبر التطبيق
-                    await app.loadData(force: true);
+                    // مزامنة التعديلات عبر التطبيق (تفاضلياً عبر /sync)
+                    await app.refreshData();
                     if (context.mounted) Navigator.pop(context);
                     if (context.mounted)
                       ScaffoldMessenger.of(context).showSnackBar(
@@ -169,6 +169,62 @@ class ApiService {
     }
   }
 
+  // المزامنة التفاضلية: جلب ما تغيّر بعد المؤشر فقط
+  static Future<SyncData> getSyncChanges(int since) async {
+    try {
+      final response = await http
+          .get(
+            Uri.parse('$baseUrl/sync?since=$since'),
+            headers: headers,
+          )
+          .timeout(const Duration(seconds: 15));
+
+      final data = _handleResponse(response);
+      return SyncData.fromJson(data as Map<String, dynamic>);
+    } catch (e) {
+      throw Exception('فشل في مزامنة البيانات: $e');
+    }
+  }
+
+  // جلب جميع البيانات بشكل متدفق (NDJSON): كل سطر سجل يصل فور قراءته على الخادم
+  // أنواع السجلات: patient، payment، statistics، ثم end عند اكتمال البث
+  static Stream<Map<String, dynamic>> getBootstrapStream() async* {
+    final client = http.Client();
+    try {
+      final request = http.Request('GET', Uri.parse('$baseUrl/bootstrap/stream'))
+        ..headers.addAll({...headers, 'Accept': 'application/x-ndjson'});
+      final response =
+          await client.send(request).timeout(const Duration(seconds: 15));
+
+      if (response.statusCode < 200 || response.statusCode >= 300) {
+        final body = await response.stream.bytesToString();
+        if (response.statusCode == 401 || response.statusCode == 403) {
+          throw HttpException(
+            'UNAUTHORIZED: ${response.statusCode}: $body',
+            uri: request.url,
+          );
+        }
+        throw HttpException(
+          'HTTP ${response.statusCode}: $body',
+          uri: request.url,
+        );
+      }
+
+      await for (final line in response.stream
+          .transform(utf8.decoder)
+          .transform(const LineSplitter())) {
+        if (line.trim().isEmpty) continue;
+        final record = json.decode(line) as Map<String, dynamic>;
+        if (record['type'] == 'error') {
+          throw Exception(record['data']?['detail'] ?? 'خطأ في بث البيانات');
+        }
+        yield record;
+      }
+    } finally {
+      client.close();
+    }
+  }
+
   // البحث عن مريض بالاسم
   static Future<Patient?> searchPatientByName(String name) async {
     try {
@@ -497,11 +553,13 @@ class BootstrapData {
   final List<Patient> patients;
   final List<Payment> payments;
   final Statistics statistics;
+  final int? cursor; // مؤشر المزامنة التفاضلية التالي
 
   BootstrapData({
     required this.patients,
     required this.payments,
     required this.statistics,
+    this.cursor,
   });
 
   factory BootstrapData.fromJson(Map<String, dynamic> json) {
@@ -514,6 +572,7 @@ class BootstrapData {
           .toList(),
       statistics:
           Statistics.fromJson(json['statistics'] as Map<String, dynamic>),
+      cursor: json['cursor'] as int?,
     );
   }
 
@@ -521,5 +580,50 @@ class BootstrapData {
         'patients': patients.map((p) => p.toJson()).toList(),
         'payments': payments.map((p) => p.toJson()).toList(),
         'statistics': statistics.toJson(),
+        'cursor': cursor,
       };
 }
+
+// نموذج بيانات المزامنة التفاضلية (/sync)
+class SyncData {
+  final int cursor;
+  final bool full;
+  final List<Patient> patients;
+  final List<Payment> payments;
+  final List<String> deletedPatientIds;
+  final List<String> deletedPaymentIds;
+  final Statistics? statistics;
+
+  SyncData({
+    required this.cursor,
+    required this.full,
+    required this.patients,
+    required this.payments,
+    this.deletedPatientIds = const [],
+    this.deletedPaymentIds = const [],
+    this.statistics,
+  });
+
+  factory SyncData.fromJson(Map<String, dynamic> json) {
+    final deleted = json['deleted'] as Map<String, dynamic>? ?? {};
+    return SyncData(
+      cursor: json['cursor'] as int,
+      full: json['full'] as bool? ?? false,
+      patients: (json['patients'] as List<dynamic>)
+          .map((e) => Patient.fromJson(e as Map<String, dynamic>))
+          .toList(),
+      payments: (json['payments'] as List<dynamic>)
+          .map((e) => Payment.fromJson(e as Map<String, dynamic>))
+          .toList(),
+      deletedPatientIds: (deleted['patients'] as List<dynamic>? ?? [])
+          .map((e) => e as String)
+          .toList(),
+      deletedPaymentIds: (deleted['payments'] as List<dynamic>? ?? [])
+          .map((e) => e as String)
+          .toList(),
+      statistics: json['statistics'] != null
+          ? Statistics.fromJson(json['statistics'] as Map<String, dynamic>)
+          : null,
+    );
+  }
+}